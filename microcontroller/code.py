@@ -17,25 +17,77 @@
 '''
 
 import board
+import struct
 import time
 import digitalio
 import usb_cdc
+import motion
 
 # Global variables
-delay = 1  # Delay between steps of the stepper motor in seconds
+start_speed = 50  # Speed of the first and last step of a move in full steps per second
 
 #################################################################
 #                   Serial Communication Protocol               #
 #################################################################
 '''
-All signals are sent in bytes
+All signals are sent in bytes.
+
+Version 1:
 A single signal consists of 3 bytes, the first indicating the axis of movement
 the second indicating the direction of adjustment, and the third indicating the
-number of steps
+number of steps. Once the move is finished a single byte is sent back.
+
+Version 2:
+A frame is SYNC (0xA5), VERSION (2), COMMAND, a 2 byte big endian LENGTH, LENGTH
+bytes of PAYLOAD and a CHECKSUM byte, the sum modulo 256 of every byte from
+VERSION to the end of PAYLOAD. Axes are never 0xA5, so the first byte tells the
+two versions apart.
+
+MOVE_BATCH (0x01): the payload is any number of 7 byte moves, each an axis byte,
+a signed 4 byte big endian number of steps and a 2 byte big endian dwell in ms
+to wait after the move. The moves are executed in order.
+
+Every frame is answered with a frame of the same layout whose COMMAND is the
+request COMMAND | 0x80 and whose PAYLOAD is a status byte followed by any
+command specific reply, for MOVE_BATCH the 2 byte number of moves completed.
+
+SET_PROFILE (0x02): the payload is an axis byte, a 2 byte big endian maximum
+speed in full steps per second, a 2 byte big endian acceleration in full steps
+per second squared and a microsteps per full step byte. Step counts in moves
+are always full steps. Microsteps must match the driver's microstep pins.
+
+MOVE_COORDINATED (0x03): the payload is up to one 5 byte move per axis, each an
+axis byte and a signed 4 byte big endian number of steps. All the axes start and
+finish together, with the axis making the most steps following its motion
+profile, slowed if needed so that no axis exceeds its own maximum speed.
 '''
 
 # steps are given as an integer
 # direction is given as a bool
+SYNC = 0xA5
+PROTOCOL_VERSION = 2
+REPLY_FLAG = 0x80
+MAX_PAYLOAD = 4096
+DRAIN_TIMEOUT = 0.1  # Seconds without a byte after which the rest of a rejected frame is given up on
+
+CMD_MOVE_BATCH = 0x01
+MOVE_FORMAT = ">BiH"
+MOVE_SIZE = struct.calcsize(MOVE_FORMAT)
+
+CMD_SET_PROFILE = 0x02
+PROFILE_FORMAT = ">BHHB"
+
+CMD_MOVE_COORDINATED = 0x03
+AXIS_MOVE_FORMAT = ">Bi"
+AXIS_MOVE_SIZE = struct.calcsize(AXIS_MOVE_FORMAT)
+
+STATUS_OK = 0
+STATUS_BAD_CHECKSUM = 1
+STATUS_UNKNOWN_COMMAND = 2
+STATUS_BAD_AXIS = 3
+STATUS_BAD_LENGTH = 4
+STATUS_BAD_VERSION = 5
+STATUS_BAD_VALUE = 6
 #################################################################
 #                 End Serial Communication Protocol             #
 #################################################################
@@ -54,13 +106,6 @@ coarse_dir_pin = board.GP16
 coarse_step_pin = board.GP17
 enable_pin = board.GP9
 
-motor_axes = {
-    0: (x_dir_pin, x_step_pin),
-    1: (y_dir_pin, y_step_pin),
-    2: (fine_dir_pin, fine_step_pin),
-    3: (coarse_dir_pin, coarse_step_pin)
-}
-
 # Set up input pins for stepper motor
 x_dir = digitalio.DigitalInOut(x_dir_pin)
 x_dir.direction = digitalio.Direction.OUTPUT
@@ -89,46 +134,261 @@ coarse_step.direction = digitalio.Direction.OUTPUT
 enable = digitalio.DigitalInOut(enable_pin)
 enable.direction = digitalio.Direction.OUTPUT
 
+motor_axes = {
+    0: (x_dir, x_step),
+    1: (y_dir, y_step),
+    2: (fine_dir, fine_step),
+    3: (coarse_dir, coarse_step)
+}
+
+# Motion profile of each axis as [max speed in full steps/s, acceleration in full steps/s^2, microsteps]
+profiles = {
+    0: [200, 400, 1],
+    1: [200, 400, 1],
+    2: [100, 200, 1],
+    3: [100, 200, 1]
+}
+
+
+def wait_until(deadline_ns: int) -> None:
+    '''Busy waits until time.monotonic_ns() reaches deadline_ns.'''
+    while time.monotonic_ns() < deadline_ns:
+        pass
 
-def step_motor(dir_pin: digitalio.DigitalInOut, step_pin: digitalio.DigitalInOut, steps: int, direction: bool) -> None:
+
+def step_motor(axis: int, steps: int, direction: bool) -> None:
     '''Moves the specified motor by the given number of steps in the given direction.
 
-    :dir_pin: the pin corresponding to the direction of rotation of the specified motor.
-    :step_pin: the pin corresponding to the step of the specified motor
-    :steps: an integer number of steps to be taken by the specified motor
+    :axis: the index of the motor to move.
+    :steps: an integer number of full steps to be taken by the specified motor
     :direction: boolean indicating the direction.
     :returns: None
     '''
-    dir_pin.value = direction
+    step_motors([(axis, steps if direction else -steps)])
+
+
+def step_motors(moves) -> None:
+    '''Moves several motors together so they start and finish at the same time.
+
+    The axis making the most microsteps follows its trapezoidal motion profile and
+    the other axes are stepped alongside it Bresenham style. The profile is scaled
+    down so no axis goes faster or accelerates harder than its own profile allows.
+    Pulses are timed against deadlines rather than with sleeps so timing errors
+    do not add up over long moves.
+
+    :moves: a list of (axis, steps) pairs, where the sign of steps is the direction.
+    :returns: None
+    '''
+    # Each entry is [step pin, microsteps to take, max speed, acceleration, start speed, error]
+    axes = []
+    for axis, steps in moves:
+        if steps == 0:
+            continue
+        dir_pin, step_pin = motor_axes[axis]
+        max_speed, accel, microsteps = profiles[axis]
+        dir_pin.value = steps > 0
+        axes.append([
+            step_pin,
+            abs(steps) * microsteps,
+            max_speed * microsteps,
+            accel * microsteps,
+            start_speed * microsteps,
+            0
+        ])
+
+    if not axes:
+        return
+
+    n = max(a[1] for a in axes)
+    max_speed = min(a[2] * n / a[1] for a in axes)
+    accel = min(a[3] * n / a[1] for a in axes)
+    first_speed = min(a[4] * n / a[1] for a in axes)
+
     enable.value = False
-    for step in range(steps):
-        step_pin.value = True
-        time.sleep(delay)
-        step_pin.value = False
-        time.sleep(delay)
+    deadline = time.monotonic_ns()
+    for interval in motion.step_intervals(n, max_speed, accel, first_speed):
+        half_interval = int(interval * 500000000)
+        for a in axes:
+            a[5] += a[1]
+            if 2 * a[5] >= n:
+                a[5] -= n
+                a[0].value = True
+        deadline += half_interval
+        wait_until(deadline)
+        for a in axes:
+            a[0].value = False
+        deadline += half_interval
+        wait_until(deadline)
     enable.value = True
     return
 
 
-def receive_signal():
-    '''Receives and decodes the incoming serial signal
+def read_exact(n: int) -> bytes:
+    '''Blocks until n bytes have been read from serial.
+
+    :n: the number of bytes to read.
+    :returns: the bytes read.
+    '''
+    data = b""
+    while len(data) < n:
+        waiting = uart.in_waiting
+        if waiting:
+            data += uart.read(min(waiting, n - len(data)))
+    return data
+
+
+def discard(n: int) -> None:
+    '''Reads and drops n bytes from serial without keeping them in memory.
+
+    Stops early once no byte has arrived for DRAIN_TIMEOUT seconds, so a
+    corrupted length cannot leave the controller waiting for bytes that never come.
+
+    :n: the number of bytes to drop.
+    :returns: None
+    '''
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while n > 0 and time.monotonic() < deadline:
+        waiting = uart.in_waiting
+        if waiting:
+            n -= len(uart.read(min(waiting, n, 64)))
+            deadline = time.monotonic() + DRAIN_TIMEOUT
 
+
+def checksum(data: bytes) -> int:
+    '''Checksum of a version 2 frame, the sum of its bytes modulo 256.'''
+    return sum(data) & 0xFF
+
+
+def send_reply(command: int, status: int, payload: bytes = b"") -> None:
+    '''Sends a version 2 reply frame.
+
+    :command: the command being replied to.
+    :status: the status of the command.
+    :payload: any command specific reply following the status byte.
+    :returns: None
+    '''
+    body = struct.pack(">BBHB", PROTOCOL_VERSION, command | REPLY_FLAG, len(payload) + 1, status) + payload
+    uart.write(bytes([SYNC]) + body + bytes([checksum(body)]))
+
+
+def receive_signal(axis: int):
+    '''Receives and decodes the rest of an incoming version 1 signal
+
+    :axis: the first byte of the signal.
     :returns: tuple with the decoded signal
     '''
-    while uart.in_waiting < 3:  # Wait for serial input
-        continue
+    direction, steps = read_exact(2)
+
+    return(axis, direction, steps)
+
+
+def receive_frame():
+    '''Receives the rest of an incoming version 2 frame after its sync byte.
+
+    :returns: tuple of the command, payload and status of the frame.
+    '''
+    version, command, length = struct.unpack(">BBH", read_exact(4))
+    if length > MAX_PAYLOAD:
+        # Drop the payload and checksum so no 0xA5 inside them is taken for the start of a frame.
+        discard(length + 1)
+        return command, b"", STATUS_BAD_LENGTH
+
+    payload = read_exact(length)
+    check = read_exact(1)[0]
+
+    if checksum(struct.pack(">BBH", version, command, length) + payload) != check:
+        return command, payload, STATUS_BAD_CHECKSUM
+    if version != PROTOCOL_VERSION:
+        return command, payload, STATUS_BAD_VERSION
+    return command, payload, STATUS_OK
+
+
+def move_batch(payload: bytes) -> None:
+    '''Executes a MOVE_BATCH payload and replies once every move has finished.
+
+    :payload: the payload of the frame.
+    :returns: None
+    '''
+    if len(payload) % MOVE_SIZE:
+        send_reply(CMD_MOVE_BATCH, STATUS_BAD_LENGTH, struct.pack(">H", 0))
+        return
+
+    moves = [struct.unpack_from(MOVE_FORMAT, payload, i) for i in range(0, len(payload), MOVE_SIZE)]
+    for axis, _, _ in moves:
+        if axis not in motor_axes:
+            send_reply(CMD_MOVE_BATCH, STATUS_BAD_AXIS, struct.pack(">H", 0))
+            return
+
+    for axis, steps, dwell_ms in moves:
+        step_motor(axis, abs(steps), steps > 0)
+        if dwell_ms:
+            time.sleep(dwell_ms / 1000)
+
+    send_reply(CMD_MOVE_BATCH, STATUS_OK, struct.pack(">H", len(moves)))
+
+
+def move_coordinated(payload: bytes) -> None:
+    '''Executes a MOVE_COORDINATED payload and replies once the move has finished.
+
+    :payload: the payload of the frame.
+    :returns: None
+    '''
+    if len(payload) % AXIS_MOVE_SIZE or len(payload) > AXIS_MOVE_SIZE * len(motor_axes):
+        send_reply(CMD_MOVE_COORDINATED, STATUS_BAD_LENGTH)
+        return
+
+    moves = [struct.unpack_from(AXIS_MOVE_FORMAT, payload, i) for i in range(0, len(payload), AXIS_MOVE_SIZE)]
+    axes = [axis for axis, _ in moves]
+    if any(axis not in motor_axes for axis in axes) or len(set(axes)) != len(axes):
+        send_reply(CMD_MOVE_COORDINATED, STATUS_BAD_AXIS)
+        return
+
+    step_motors(moves)
+    send_reply(CMD_MOVE_COORDINATED, STATUS_OK)
+
+
+def set_profile(payload: bytes) -> None:
+    '''Executes a SET_PROFILE payload.
+
+    :payload: the payload of the frame.
+    :returns: None
+    '''
+    if len(payload) != struct.calcsize(PROFILE_FORMAT):
+        send_reply(CMD_SET_PROFILE, STATUS_BAD_LENGTH)
+        return
 
-    axis = uart.read(1)
-    direction = int.from_bytes(uart.read(1), "big")
-    steps = int.from_bytes(uart.read(1), "big")
+    axis, max_speed, accel, microsteps = struct.unpack(PROFILE_FORMAT, payload)
+    if axis not in profiles:
+        send_reply(CMD_SET_PROFILE, STATUS_BAD_AXIS)
+    elif max_speed == 0 or accel == 0 or microsteps == 0:
+        send_reply(CMD_SET_PROFILE, STATUS_BAD_VALUE)
+    else:
+        profiles[axis] = [max_speed, accel, microsteps]
+        send_reply(CMD_SET_PROFILE, STATUS_OK)
 
-    # Decode the axis
-    dir_pin, step_pin = motor_axes[int.from_bytes(axis, byteorder="big")]
 
-    return(dir_pin, step_pin, direction, steps)
+def handle_frame() -> None:
+    '''Receives a version 2 frame and executes its command.'''
+    command, payload, status = receive_frame()
+    if status != STATUS_OK:
+        send_reply(command, status)
+    elif command == CMD_MOVE_BATCH:
+        move_batch(payload)
+    elif command == CMD_SET_PROFILE:
+        set_profile(payload)
+    elif command == CMD_MOVE_COORDINATED:
+        move_coordinated(payload)
+    else:
+        send_reply(command, STATUS_UNKNOWN_COMMAND)
 
 
 enable.value = True
 while True:
-    dir_pin, step_pin, direction, steps = receive_signal()
-    step_motor(dir_pin, step_pin, steps, direction)
+    first = read_exact(1)[0]
+    if first == SYNC:
+        handle_frame()
+    elif first in motor_axes:
+        axis, direction, steps = receive_signal(first)
+        step_motor(axis, steps, direction)
+        # Acknowledge the version 1 signal once the move has finished
+        uart.write(b"\x00")
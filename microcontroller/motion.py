@@ -0,0 +1,56 @@
+'''
+    Stepper motion profiles for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# This module only depends on math so the step timing can be checked on a host
+# computer without the CircuitPython board and digitalio modules.
+import math
+
+
+def step_intervals(steps: int, max_speed: float, accel: float, start_speed: float):
+    '''Generates the time between consecutive step pulses of a trapezoidal motion profile.
+
+    The speed ramps up from start_speed at a constant acceleration, cruises at
+    max_speed and ramps back down symmetrically. Moves too short to reach
+    max_speed follow a triangular profile peaking halfway through the move.
+    Each interval is the time the profile takes to cover that step, so the
+    intervals add up to the duration api.move_time estimates on the host.
+
+    :steps: the number of steps in the move.
+    :max_speed: the cruising speed in steps per second.
+    :accel: the acceleration in steps per second squared.
+    :start_speed: the speed in steps per second of the first and last step.
+    :returns: a generator of step intervals in seconds.
+    '''
+    start_speed = min(start_speed, max_speed)
+    start_squared = start_speed * start_speed
+    ramp_steps = (max_speed * max_speed - start_squared) / (2 * accel)
+
+    def ramp_time(distance):
+        # Time to cover a distance in steps accelerating from start_speed.
+        if distance <= ramp_steps:
+            return (math.sqrt(start_squared + 2 * accel * distance) - start_speed) / accel
+        return (max_speed - start_speed) / accel + (distance - ramp_steps) / max_speed
+
+    half = steps / 2
+    total = 2 * ramp_time(half)
+    previous = 0.0
+    for step in range(1, steps + 1):
+        # The deceleration mirrors the acceleration about the middle of the move.
+        now = ramp_time(step) if step <= half else total - ramp_time(steps - step)
+        yield now - previous
+        previous = now
@@ -16,19 +16,23 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from typing import Tuple, Sequence
+import contextlib
+import struct
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple, Sequence
 import numpy as np
 import serial
-#import matlab.engine
-#import image_processing
+import cameras
+import edf
+import image_processing
+import tracing
 
 # Type hint for opencv image
 OpenCVImage = np.ndarray
 
-# Serial port for pico
-ser = serial.Serial()
-ser.baudrate = 115200
-ser.port = 'COM9'  # Set COM port
+# Serial port of the pico on the default widget.
+default_port = 'COM9'
 
 # Assignment for motor_ids
 motor_axes = {
@@ -38,56 +42,525 @@ motor_axes = {
     "focus_coarse": int(3).to_bytes(1, byteorder="big")
 }
 
-###############################################################################
-#                           Camera Controller API                             #
-###############################################################################
-#eng = matlab.engine.start_matlab()
-camera_num = 0
+# Serial protocol version used to talk to stepper controllers, see microcontroller/code.py.
+# Version 1 sends one 3 byte packet per move of at most 255 steps, version 2 sends framed batches.
+protocol_version = 2
+
+# Protocol version 2 framing.
+_sync = 0xA5
+_cmd_move_batch = 0x01
+_cmd_set_profile = 0x02
+_cmd_move_coordinated = 0x03
+_reply_flag = 0x80
+_move_format = ">BiH"  # axis, signed steps, dwell in ms
+_profile_format = ">BHHB"  # axis, max speed, acceleration, microsteps
+_axis_move_format = ">Bi"  # axis, signed steps
+_reply_header_format = ">BBBH"  # sync, version, command, payload length
+_status_messages = {
+    0: "OK",
+    1: "bad checksum",
+    2: "unknown command",
+    3: "bad axis",
+    4: "bad length",
+    5: "unsupported version",
+    6: "bad value",
+}
 
+# Distance in mm per degree of rotation for the x and y axes.
+x_dist_factor = 0.087/1.8
+y_dist_factor = 0.1388/1.8
 
-def camera_controller_init() -> None:
-    "Initialize the camera connection."
+# Size of a step in degrees. 200 steps per revolution.
+step_degrees = 1.8
 
-    try:
-        eng.LucamConnect(camera_num)
-        print("Success connecting to camera number: ", camera_num)
-    except matlab.engine.EngineError:
-        print("Error connecting to camera number:", camera_num)
+# Motion profile of each axis as (max speed in steps/s, acceleration in steps/s^2, microsteps per step).
+# These mirror the defaults in microcontroller/code.py, and each StepperController starts from them.
+default_motion_profiles = {
+    "x": (200, 400, 1),
+    "y": (200, 400, 1),
+    "focus_fine": (100, 200, 1),
+    "focus_coarse": (100, 200, 1)
+}
 
+# Speed of the first and last step of every move in steps/s, fixed in the firmware.
+start_speed = 50
+
+# Seconds to wait for the stepper controller's reply beyond how long the commanded moves should take.
+reply_timeout = 30.0
+
+
+class StepperControllerError(Exception):
+    "Raised when the stepper controller rejects a command or sends a malformed reply."
 
-def take_image() -> OpenCVImage:
-    "Take an image from the microscope camera. This call blocks until the image is ready."
-    try:
-        if eng.LucamIsConnected(camera_num):
-            data = eng.LucamTakeSnapshot(camera_num)
-            return np.array(data)
-    except(
-        matlab.engine.MatlabExcecutionError,
-        matlab.engine.RejectedExecutionError,
-        SyntaxError,
-        TypeError
-    ) as e:
-        print(f"Error taking snapshot. {e}")
-        raise e
 
+def move_time(steps, max_speed: float, accel: float, start: float = start_speed):
+    '''The duration of a move under a trapezoidal motion profile, as timed by microcontroller/motion.py.
+
+    :param steps: the number of full steps, or an ndarray of them. The sign is ignored.
+    :param max_speed: the cruising speed in full steps per second.
+    :param accel: the acceleration and deceleration in full steps per second squared.
+    :param start: the speed in full steps per second of the first and last step.
+    :returns: the duration of the move in seconds, as a float or an ndarray matching steps.
+    '''
+    steps = np.abs(np.asarray(steps, dtype=float))
+
+    v0 = min(start, max_speed)
+    ramp_steps = (max_speed ** 2 - v0 ** 2) / (2 * accel)
+    # Moves too short to reach max_speed follow a triangular profile.
+    peak = np.sqrt(v0 ** 2 + accel * steps)
+    t = np.where(
+        2 * ramp_steps >= steps,
+        2 * (peak - v0) / accel,
+        2 * (max_speed - v0) / accel + (steps - 2 * ramp_steps) / max_speed
+    )
+    t = np.where(steps == 0, 0.0, t)
+    return t if t.ndim else float(t)
 
 ###############################################################################
 #                          Stepper Controller API                             #
 ###############################################################################
 
 
-def stepper_controller_init() -> None:
-    "Initializes the serial connection to the stepper controller."
-    ser.open()
-    ser.timeout = 10
+class StepperController:
+    '''The stepper controller of one widget, on its own serial port.
 
+    Tracks the absolute position of every axis. Every move is rounded to whole steps against the
+    position the moves so far asked for rather than on its own, so the fractions of a step left over
+    carry into later moves instead of adding up to drift over a long scan.
+    '''
 
-# Distance in mm per degree of rotation for the x and y axes.
-x_dist_factor = 0.087/1.8
-y_dist_factor = 0.1388/1.8
+    def __init__(self, port: Optional[str] = None, version: int = protocol_version):
+        '''
+        :param port: the serial port of the controller, or None for default_port.
+        :param version: the serial protocol version the controller's firmware speaks.
+        '''
+        self.ser = serial.Serial()
+        self.ser.baudrate = 115200
+        self.ser.port = port or default_port
+        self.protocol_version = version
+        self.reply_timeout = reply_timeout
+        # Updated by set_motion_profile.
+        self.motion_profiles = dict(default_motion_profiles)
+
+        # Position of each axis in whole steps from the origin, as commanded to the controller.
+        self.position_steps = {axis: 0 for axis in motor_axes}
+        # Position of each axis in degrees the moves so far asked for.
+        self._target_degrees = {axis: 0.0 for axis in motor_axes}
+        # Relative moves in degrees queued by queue_move which have not been sent yet.
+        self._queued_degrees = {axis: 0.0 for axis in motor_axes}
+
+    def open(self, port: Optional[str] = None, position: Optional[Tuple[float, float, float]] = None) -> None:
+        '''Initializes the serial connection to the stepper controller.
+
+        :param port: the serial port to open instead of ser.port, such as a simulator.SimulatedStage port.
+        :param position: the (x mm, y mm, fine focus degrees) the axes are at relative to the origin of
+        move_to and get_position, such as where an interrupted scan left them. None makes the current
+        position the origin.
+        '''
+        if port is not None:
+            self.ser.port = port
+        self.ser.open()
+        self.ser.timeout = 10
+
+        x_mm, y_mm, focus_deg = position or (0.0, 0.0, 0.0)
+        degrees = {"x": _axis_degrees("x", x_mm), "y": _axis_degrees("y", y_mm), "focus_fine": focus_deg}
+        for axis in motor_axes:
+            self._target_degrees[axis] = degrees.get(axis, 0.0)
+            self.position_steps[axis] = round(self._target_degrees[axis] / step_degrees)
+            self._queued_degrees[axis] = 0.0
+
+    def close(self) -> None:
+        "Close the serial connection."
+        self.ser.close()
+
+    def set_motion_profile(self, axis: str, max_speed: int, accel: int, microsteps: int = 1) -> None:
+        '''Set the speed and acceleration the stepper controller moves an axis with.
+
+        :param axis: the axis to configure, a key of motor_axes.
+        :param max_speed: the cruising speed in full steps per second.
+        :param accel: the acceleration and deceleration in full steps per second squared.
+        :param microsteps: the microsteps per full step the axis' driver is configured for.
+        :returns: None
+        :raises NotImplementedError: when the protocol version is below 2.
+        :raises StepperControllerError: when the controller rejects the profile.
+        '''
+        if self.protocol_version < 2:
+            raise NotImplementedError("Motion profiles require protocol version 2.")
+
+        self._send_frame(
+            _cmd_set_profile, struct.pack(_profile_format, motor_axes[axis][0], max_speed, accel, microsteps)
+        )
+        self.motion_profiles[axis] = (max_speed, accel, microsteps)
+
+    def estimate_move_time(self, axis: str, steps):
+        '''Estimate how long the stepper controller takes to move an axis by a number of steps.
+
+        :param axis: the axis being moved, a key of motor_axes.
+        :param steps: the number of full steps, or an ndarray of them. The sign is ignored.
+        :returns: the duration of the move in seconds under the axis' trapezoidal motion profile, as a float
+        or an ndarray matching steps.
+        '''
+        max_speed, accel, _ = self.motion_profiles[axis]
+        return move_time(steps, max_speed, accel)
+
+    def move_x_axis(self, distance_mm: float, err_tol: float = 1) -> None:
+        '''Move the x axis by a specified distance in mm.
+
+        :param distance_mm: the distance to move the axis in mm.
+        :param err_tol: the maximum relative error between the commanded movement.
+        and the movement rounded to the nearest step size.
+        :returns: None
+        :raises ValueError: when the relative error is greater than err_tol.
+        '''
+
+        degrees = distance_mm / x_dist_factor
+        if _calculate_error(degrees) > err_tol:
+            raise ValueError(
+                "Error in commanded step too high. Commanded step was"
+                f"{degrees}, relative error was {_calculate_error(degrees)}."
+            )
+
+        self._send_moves({"x": degrees})
+
+    def move_y_axis(self, distance_mm: float, err_tol: float = 1) -> None:
+        '''Move the y axis by a specified distance in mm.
+
+        :param distance_mm: the distance to move the axis in mm.
+        :param err_tol: the maximum relative error between the commanded movement.
+        and the movement rounded to the nearest step size.
+        :returns: None
+        :raises ValueError: when the relative error is greater than err_tol.
+        '''
+
+        degrees = distance_mm / y_dist_factor
+        if _calculate_error(degrees) > err_tol:
+            raise ValueError(
+                "Error in commanded step too high. Commanded step was"
+                f"{degrees}, relative error was {_calculate_error(degrees)}."
+            )
+
+        self._send_moves({"y": degrees})
+
+    def move_fine_focus(self, degrees: float, err_tol: float = 1) -> None:
+        '''Move the fine focus knob by a specified distance in degrees.
+
+        :param distance_mm: the distance to move the fine focus in degrees.
+        :param err_tol: the maximum relative error between the commanded movement.
+        and the movement rounded to the nearest step size.
+        :returns: None
+        :raises ValueError: when the relative error is greater than err_tol.
+        '''
+
+        if _calculate_error(degrees) > err_tol:
+            raise ValueError(
+                "Error in commanded step too high. Commanded step was"
+                f"{degrees}, relative error was {_calculate_error(degrees)}."
+            )
+
+        self._send_moves({"focus_fine": degrees})
+
+    def move_coarse_focus(self, degrees: float, err_tol: float = 1) -> None:
+        '''Move the coarse focus knob by a specified distance in degrees. Not Implemented.
+
+        :param distance_mm: the distance to move the coarse focus in degrees.
+        :param err_tol: the maximum relative error between the commanded movement.
+        and the movement rounded to the nearest step size.
+        :returns: None
+        :raises ValueError: when the relative error is greater than err_tol
+        :raises NotImplementedError: always
+        '''
+        raise NotImplementedError("Coarse focus adjustment not supported.")
+
+        '''
+        if _calculate_error(degrees) > err_tol:
+            raise ValueError(
+                "Error in commanded step too high. Commanded step was"
+                f"{degrees}, relative error was {_calculate_error(degrees)}."
+            )
+
+        self._send_moves({"focus_coarse": degrees})
+        '''
+
+    def move_xyz(self, dx_mm: float, dy_mm: float, dfocus_deg: float) -> None:
+        '''Move the x, y and fine focus axes together so the move takes as long as the slowest axis.
+
+        :param dx_mm: the distance to move the x axis in mm.
+        :param dy_mm: the distance to move the y axis in mm.
+        :param dfocus_deg: the distance to move the fine focus knob in degrees.
+        :returns: None
+        :raises StepperControllerError: when the controller rejects the move.
+
+        With protocol version 1 the axes are moved one after the other instead.
+        '''
+        self._send_moves({
+            "x": _axis_degrees("x", dx_mm), "y": _axis_degrees("y", dy_mm), "focus_fine": dfocus_deg
+        })
+
+    def move_to(
+        self,
+        x_mm: Optional[float] = None,
+        y_mm: Optional[float] = None,
+        focus_deg: Optional[float] = None
+    ) -> None:
+        '''Move the x, y and fine focus axes together to absolute positions.
+
+        Positions are relative to the origin set by open. Queued moves are folded into this move, so
+        each axis makes a single move straight to its position.
+
+        :param x_mm: the position to move the x axis to in mm, or None to leave it where it is.
+        :param y_mm: the position to move the y axis to in mm, or None to leave it where it is.
+        :param focus_deg: the position to move the fine focus knob to in degrees, or None to leave it where it is.
+        :returns: None
+        :raises StepperControllerError: when the controller rejects the move.
+        '''
+        targets = [("x", x_mm), ("y", y_mm), ("focus_fine", focus_deg)]
+        self._send_moves({
+            axis: _axis_degrees(axis, amount) - self._target_degrees[axis] - self._queued_degrees[axis]
+            for axis, amount in targets if amount is not None
+        })
+
+    def get_position(self) -> Tuple[float, float, float]:
+        '''Return the position the x, y and fine focus axes were last commanded to, not counting queued moves.
+
+        :returns: the x and y positions in mm and the fine focus position in degrees, relative to the
+        origin set by open.
+        '''
+        return (
+            self.position_steps["x"] * step_degrees * x_dist_factor,
+            self.position_steps["y"] * step_degrees * y_dist_factor,
+            self.position_steps["focus_fine"] * step_degrees
+        )
 
-# Size of a step in degrees. 200 steps per revolution.
-step_degrees = 1.8
+    def queue_move(self, axis: str, amount: float) -> None:
+        '''Queue a relative move of an axis to be sent together with the next move or image.
+
+        Queued moves of an axis add up, and the next move, flush_moves or Widget.take_image sends them as
+        one move of the net distance of each axis. A return to the centre of a z-stack followed by the
+        move to the next field is then a single move, and moves which cancel out are never made.
+
+        :param axis: the axis to move, a key of motor_axes.
+        :param amount: the distance to move in mm for the x and y axes and degrees for the focus axes.
+        :returns: None
+        '''
+        self._queued_degrees[axis] += _axis_degrees(axis, amount)
+
+    def flush_moves(self) -> None:
+        '''Send the queued moves. Nothing is sent when no axis has a whole step to move.
+
+        :returns: None
+        :raises StepperControllerError: when the controller rejects the move.
+        '''
+        self._send_moves({})
+
+    def move_sequence(self, moves: Sequence[Tuple[str, float]], dwell_s: float = 0) -> None:
+        '''Send several moves to the stepper controller as a single batch which is executed in order.
+
+        :param moves: (axis, amount) pairs where axis is a key of motor_axes and amount is in mm for the x
+        and y axes and degrees for the focus axes.
+        :param dwell_s: how long the controller waits after each move in seconds.
+        :returns: None
+        :raises StepperControllerError: when the controller rejects the batch.
+
+        With protocol version 2 the whole batch is one frame answered by one reply, otherwise each move
+        is sent and acknowledged on its own. Queued moves are sent first, since the order of the moves matters.
+        '''
+        if self.protocol_version < 2:
+            self.flush_moves()
+            for axis, amount in moves:
+                self._send_motor_control_packet(motor_axes[axis], self._take_steps(axis, _axis_degrees(axis, amount)))
+            return
+
+        payload = self._move_sequence_payload(moves, dwell_s)
+        self._send_frame(_cmd_move_batch, payload, self._batch_duration(payload))
+
+    def _send_moves(self, degrees: Dict[str, float]) -> None:
+        '''Add moves in degrees to the queued moves and send the net move of every axis as one command.
+
+        Axes which round to no steps are left out, and nothing is sent when every axis does.
+        '''
+        steps = self._take_queued_steps(degrees)
+        if not steps:
+            return
+        if self.protocol_version < 2 or len(steps) == 1:
+            for axis, n in steps:
+                self._send_motor_control_packet(motor_axes[axis], n)
+        else:
+            self._send_frame(_cmd_move_coordinated, self._coordinated_payload(steps))
+
+    def _take_queued_steps(self, degrees: Dict[str, float]) -> List[Tuple[str, int]]:
+        '''Add moves in degrees to the queued moves, empty the queue and commit to the steps of each axis.
+
+        :returns: (axis, steps) pairs of the axes with whole steps to move, in the order of motor_axes.
+        '''
+        for axis, amount in degrees.items():
+            self._queued_degrees[axis] += amount
+
+        steps = []
+        for axis in motor_axes:
+            if self._queued_degrees[axis]:
+                n = self._take_steps(axis, self._queued_degrees[axis])
+                self._queued_degrees[axis] = 0.0
+                if n:
+                    steps.append((axis, n))
+        return steps
+
+    @staticmethod
+    def _coordinated_payload(steps: Sequence[Tuple[str, int]]) -> bytes:
+        "Build the payload of a MOVE_COORDINATED frame from (axis, steps) pairs."
+        return b"".join(struct.pack(_axis_move_format, motor_axes[axis][0], n) for axis, n in steps)
+
+    def _move_xyz_payload(self, dx_mm: float, dy_mm: float, dfocus_deg: float) -> bytes:
+        "Build the payload of a MOVE_COORDINATED frame with the queued moves folded in."
+        return self._coordinated_payload(self._take_queued_steps({
+            "x": _axis_degrees("x", dx_mm), "y": _axis_degrees("y", dy_mm), "focus_fine": dfocus_deg
+        }))
+
+    def _move_sequence_payload(self, moves: Sequence[Tuple[str, float]], dwell_s: float = 0) -> bytes:
+        "Build the payload of a MOVE_BATCH frame which starts with the queued moves, made without a dwell."
+        queued = b"".join(
+            struct.pack(_move_format, motor_axes[axis][0], n, 0) for axis, n in self._take_queued_steps({})
+        )
+        return queued + b"".join(
+            struct.pack(
+                _move_format,
+                motor_axes[axis][0],
+                self._take_steps(axis, _axis_degrees(axis, amount)),
+                int(dwell_s * 1000)
+            )
+            for axis, amount in moves
+        )
+
+    def _batch_duration(self, payload: bytes) -> float:
+        "Estimate how long the stepper controller takes to execute a MOVE_BATCH payload, dwells included."
+        axes = {axis_byte[0]: axis for axis, axis_byte in motor_axes.items()}
+        return sum(
+            self.estimate_move_time(axes[axis], steps) + dwell_ms / 1000
+            for axis, steps, dwell_ms in struct.iter_unpack(_move_format, payload)
+        )
+
+    def _take_steps(self, axis: str, degrees: float) -> int:
+        '''Advance the target position of an axis by degrees and commit to the steps which move it there.
+
+        :returns: the signed number of whole steps from the axis' position to the step nearest its target.
+        '''
+        self._target_degrees[axis] += degrees
+        steps = round(self._target_degrees[axis] / step_degrees) - self.position_steps[axis]
+        self.position_steps[axis] += steps
+        tracing.count("steps_commanded", abs(steps))
+        return steps
+
+    def _send_motor_control_packet(self, motor_axis: bytes, steps: int) -> None:
+        '''Send a motor control packet.
+
+        :param motor_axis: the index of the motor the packet is commanding.
+        :param steps: the signed number of whole steps to move that axis.
+        :returns: None
+
+        An internal implementation function which directly sends motor control
+        packets to the stepper controller. With protocol version 1 each packet is 3 bytes
+        and moves at most 255 steps, with version 2 the move is sent as a single frame.
+        This does not do error checking or axis translation and should only be
+        used to implement the above API functions.
+        '''
+
+        if self.protocol_version >= 2:
+            payload = struct.pack(_move_format, motor_axis[0], steps, 0)
+            self._send_frame(_cmd_move_batch, payload)
+            return
+
+        if steps > 0:
+            direction_packet = 1
+        else:
+            direction_packet = 0
+
+        steps_full = abs(steps)
+
+        packets = []
+        while steps_full > 255:
+            steps_full -= 255
+            packets.append(motor_axis + bytes([direction_packet, 255]))
+        packets.append(motor_axis + bytes([direction_packet, steps_full]))
+        data = b"".join(packets)
+        with tracing.span("serial_write"):
+            self.ser.write(data)
+        tracing.count("bytes_sent", len(data))
+
+        # The controller acknowledges each packet with one byte once it has finished moving.
+        with tracing.span("ack_wait"):
+            for _ in packets:
+                self._wait_for_reply(1)
+
+    def _wait_for_reply(self, n: int, expected_s: float = 0.0) -> bytes:
+        '''Block until n bytes are read from the stepper controller.
+
+        The controller only replies once it has finished moving, so the first byte is waited for as long
+        as the moves should take plus reply_timeout. The rest of the reply must follow within the serial
+        timeout.
+
+        :param n: the number of bytes to read.
+        :param expected_s: how long the commanded moves should take in seconds.
+        :raises StepperControllerError: when the reply does not arrive in time.
+        '''
+        deadline = time.monotonic() + expected_s + self.reply_timeout
+        first = b""
+        while not first:
+            if time.monotonic() > deadline:
+                raise StepperControllerError("Timed out waiting for the stepper controller to reply.")
+            first = self.ser.read(1)
+
+        rest = self.ser.read(n - 1) if n > 1 else b""
+        if len(rest) != n - 1:
+            raise StepperControllerError("Timed out reading reply from stepper controller.")
+        return first + rest
+
+    def _encode_frame(self, command: int, payload: bytes) -> bytes:
+        "Build a protocol version 2 frame."
+        body = struct.pack(">BBH", self.protocol_version, command, len(payload)) + payload
+        return bytes([_sync]) + body + bytes([_checksum(body)])
+
+    def _read_reply(self, first: bytes) -> Tuple[int, int, bytes]:
+        '''Read the rest of a protocol version 2 reply frame whose first byte has already been read.
+
+        :param first: the first byte of the reply.
+        :returns: the command replied to, the reply status and the reply payload after the status byte.
+        :raises StepperControllerError: when the reply is malformed or does not arrive within the serial timeout.
+        '''
+        header_size = struct.calcsize(_reply_header_format)
+        header = first + self.ser.read(header_size - 1)
+        if len(header) != header_size:
+            raise StepperControllerError("Timed out reading reply from stepper controller.")
+
+        sync, version, reply_command, length = struct.unpack(_reply_header_format, header)
+        if sync != _sync or not reply_command & _reply_flag or length < 1:
+            raise StepperControllerError(f"Malformed reply header from stepper controller: {header.hex()}.")
+
+        reply = self.ser.read(length + 1)
+        if len(reply) != length + 1 or _checksum(header[1:] + reply[:-1]) != reply[-1]:
+            raise StepperControllerError("Corrupt reply from stepper controller.")
+
+        return reply_command & ~_reply_flag, reply[0], reply[1:-1]
+
+    def _send_frame(self, command: int, payload: bytes, expected_s: float = 0.0) -> bytes:
+        '''Send a protocol version 2 frame and wait for its reply.
+
+        :param command: the command byte of the frame.
+        :param payload: the payload of the frame.
+        :param expected_s: how long the frame's moves should take in seconds, see _wait_for_reply.
+        :returns: the reply payload after the status byte.
+        :raises StepperControllerError: when the reply is malformed, late or its status is not OK.
+        '''
+        frame = self._encode_frame(command, payload)
+        with tracing.span("serial_write", command=command):
+            self.ser.write(frame)
+        tracing.count("bytes_sent", len(frame))
+
+        with tracing.span("ack_wait", command=command):
+            reply_command, status, data = self._read_reply(self._wait_for_reply(1, expected_s))
+        if reply_command != command:
+            raise StepperControllerError(f"Received a reply to command {reply_command} instead of {command}.")
+        _check_status(command, status)
+
+        return data
 
 
 def _calculate_error(degrees: float) -> float:
@@ -99,133 +572,220 @@ def _calculate_error(degrees: float) -> float:
     )
 
 
-def move_x_axis(distance_mm: float, err_tol: float = 1) -> None:
-    '''Move the x axis by a specified distance in mm.
+def _axis_degrees(axis: str, amount: float) -> float:
+    "Convert a movement in the units of the move_ functions for the named axis to degrees."
+    if axis == "x":
+        return amount / x_dist_factor
+    if axis == "y":
+        return amount / y_dist_factor
+    return amount
+
+
+def _checksum(data: bytes) -> int:
+    "Checksum of a protocol version 2 frame, the sum of its bytes modulo 256."
+    return sum(data) & 0xFF
 
-    :param distance_mm: the distance to move the axis in mm.
-    :param err_tol: the maximum relative error between the commanded movement.
-    and the movement rounded to the nearest step size.
-    :returns: None
-    :raises ValueError: when the relative error is greater than err_tol.
-    '''
 
-    degrees = distance_mm / x_dist_factor
-    if _calculate_error(degrees) > err_tol:
-        raise ValueError(
-            "Error in commanded step too high. Commanded step was"
-            f"{degrees}, relative error was {_calculate_error(degrees)}."
+def _check_status(command: int, status: int) -> None:
+    "Raise a StepperControllerError if a reply status is not OK."
+    if status != 0:
+        raise StepperControllerError(
+            f"Stepper controller rejected command {command}: {_status_messages.get(status, status)}."
         )
 
-    _send_motor_control_packet(motor_axes["x"], degrees)
+###############################################################################
+#                                 Widgets                                     #
+###############################################################################
 
 
-def move_y_axis(distance_mm: float, err_tol: float = 1) -> None:
-    '''Move the y axis by a specified distance in mm.
+class Widget:
+    '''One microscope widget: a stepper controller and a camera.
 
-    :param distance_mm: the distance to move the axis in mm.
-    :param err_tol: the maximum relative error between the commanded movement.
-    and the movement rounded to the nearest step size.
-    :returns: None
-    :raises ValueError: when the relative error is greater than err_tol.
+    Several widgets can be driven from one process, each by its own thread. The module level functions
+    below act on the widget made current for the calling thread with using, or default_widget.
     '''
 
-    degrees = distance_mm / y_dist_factor
-    if _calculate_error(degrees) > err_tol:
-        raise ValueError(
-            "Error in commanded step too high. Commanded step was"
-            f"{degrees}, relative error was {_calculate_error(degrees)}."
-        )
+    def __init__(
+        self,
+        port: Optional[str] = None,
+        camera: Optional[cameras.CameraBackend] = None,
+        camera_num: int = 0,
+        version: int = protocol_version
+    ):
+        '''
+        :param port: the serial port of the stepper controller, or None for default_port.
+        :param camera: the camera, such as a simulator.SyntheticCamera, or None for the Lumenera camera
+        camera_num driven through MATLAB.
+        :param camera_num: the Lucam camera number, used when camera is None.
+        :param version: the serial protocol version the stepper controller's firmware speaks.
+        '''
+        self.stepper = StepperController(port, version)
+        self.camera = camera if camera is not None else cameras.MatlabCamera(camera_num)
+
+    def camera_controller_init(self) -> None:
+        "Initialize the camera connection."
+        self.camera.connect()
+
+    def take_image(self) -> OpenCVImage:
+        "Take an image from the microscope camera once any queued moves are sent. This call blocks until the image is ready."
+        self.stepper.flush_moves()
+        return self._capture()
+
+    def _capture(self) -> OpenCVImage:
+        "Take an image from the microscope camera without touching the stepper controller."
+        with tracing.span("capture"):
+            image = self.camera.snapshot()
+        tracing.count("frames_captured")
+        return image
+
+    def take_image_into(self, out: OpenCVImage) -> OpenCVImage:
+        '''Take an image from the microscope camera into a preallocated array once any queued moves are sent.
+        This call blocks until the image is ready.
+
+        :param out: a contiguous uint8 array with the shape of the camera's images.
+        :returns: out, holding the image.
+        '''
+        self.stepper.flush_moves()
+        with tracing.span("capture"):
+            self.camera.snapshot_into(out)
+        tracing.count("frames_captured")
+        return out
+
+    def start_camera_stream(self, n_slots: int = 4) -> cameras.CameraStream:
+        '''Start capturing images continuously into a ring of n_slots preallocated frames.
+
+        :param n_slots: the number of frames kept in the ring.
+        :returns: the running stream. Call stop() on it, or use it as a context manager, to stop capturing.
+        Do not call take_image while a stream is running.
+        '''
+        return cameras.CameraStream(self.camera, n_slots)
+
+
+# The widget used by threads which have not been given one with using.
+default_widget = Widget()
+
+_local = threading.local()
+
+
+def current() -> Widget:
+    "Return the widget the module level functions act on in the calling thread."
+    return getattr(_local, "widget", None) or default_widget
+
+
+@contextlib.contextmanager
+def using(widget: Optional[Widget]) -> Iterator[Widget]:
+    '''Make the module level functions act on a widget in the calling thread for the duration of a with block.
+
+    :param widget: the widget, or None to keep the current one.
+    :returns: a context manager which yields the widget made current.
+    '''
+    previous = getattr(_local, "widget", None)
+    _local.widget = widget or current()
+    try:
+        yield _local.widget
+    finally:
+        _local.widget = previous
 
-    _send_motor_control_packet(motor_axes["y"], degrees)
+###############################################################################
+#                           Camera Controller API                             #
+###############################################################################
 
 
-def move_fine_focus(degrees: float, err_tol: float = 1) -> None:
-    '''Move the fine focus knob by a specified distance in degrees.
+def camera_controller_init() -> None:
+    "Initialize the camera connection."
+    current().camera_controller_init()
 
-    :param distance_mm: the distance to move the fine focus in degrees.
-    :param err_tol: the maximum relative error between the commanded movement.
-    and the movement rounded to the nearest step size.
-    :returns: None
-    :raises ValueError: when the relative error is greater than err_tol.
-    '''
 
-    if _calculate_error(degrees) > err_tol:
-        raise ValueError(
-            "Error in commanded step too high. Commanded step was"
-            f"{degrees}, relative error was {_calculate_error(degrees)}."
-        )
+def take_image() -> OpenCVImage:
+    "Take an image from the microscope camera once any queued moves are sent. This call blocks until the image is ready."
+    return current().take_image()
 
-    _send_motor_control_packet(motor_axes["focus_fine"], degrees)
 
+def take_image_into(out: OpenCVImage) -> OpenCVImage:
+    '''Take an image from the microscope camera into a preallocated array, see Widget.take_image_into.'''
+    return current().take_image_into(out)
 
-def move_coarse_focus(degrees: float, err_tol: float = 1) -> None:
-    '''Move the coarse focus knob by a specified distance in degrees. Not Implemented.
-
-    :param distance_mm: the distance to move the coarse focus in degrees.
-    :param err_tol: the maximum relative error between the commanded movement.
-    and the movement rounded to the nearest step size.
-    :returns: None
-    :raises ValueError: when the relative error is greater than err_tol
-    :raises NotImplementedError: always
-    '''
-    raise NotImplementedError("Coarse focus adjustment not supported.")
 
-    '''
-    if _calculate_error(degrees) > err_tol:
-        raise ValueError(
-            "Error in commanded step too high. Commanded step was"
-            f"{degrees}, relative error was {_calculate_error(degrees)}."
-        )
+def start_camera_stream(n_slots: int = 4) -> cameras.CameraStream:
+    '''Start capturing images continuously, see Widget.start_camera_stream.'''
+    return current().start_camera_stream(n_slots)
 
-    _send_motor_control_packet(motor_axes["focus_coarse"], degrees)
-    '''
+###############################################################################
+#                          Stepper Controller API                             #
+###############################################################################
 
 
-def _send_motor_control_packet(motor_axis: bytes, degrees: float) -> None:
-    '''Send a motor control packet.
+def stepper_controller_init(port: Optional[str] = None, position: Optional[Tuple[float, float, float]] = None) -> None:
+    '''Initializes the serial connection to the stepper controller, see StepperController.open.'''
+    current().stepper.open(port, position)
 
-    :param motor_axis: the index of the motor the packet is commanding.
-    :param degrees: the number of degrees to move that axis.
-    :returns: None
 
-    An internal implementation function which directly sends motor control
-    packets to the stepper controller. The packet size is 1 byte.
-    This does not do error checking or axis translation and should only be
-    used to implement the above API functions.
-    '''
+def set_motion_profile(axis: str, max_speed: int, accel: int, microsteps: int = 1) -> None:
+    '''Set the speed and acceleration the stepper controller moves an axis with, see StepperController.set_motion_profile.'''
+    current().stepper.set_motion_profile(axis, max_speed, accel, microsteps)
 
-    if degrees > 1:
-        direction_packet = 1
-    else:
-        direction_packet = 0
 
-    # Round down to integer
-    steps_full = int(abs(degrees/step_degrees)+0.3)
-    print(steps_full)
+def estimate_move_time(axis: str, steps):
+    '''Estimate how long the stepper controller takes to move an axis, see StepperController.estimate_move_time.'''
+    return current().stepper.estimate_move_time(axis, steps)
 
-    while steps_full > 255:
-        steps_full -= 255
-        ser.write(motor_axis)
-        ser.write(direction_packet.to_bytes(1, byteorder="big"))
-        ser.write(int(255).to_bytes(1, byteorder="big"))
 
-    ser.write(motor_axis)
-    ser.write(direction_packet.to_bytes(1, byteorder="big"))
-    ser.write(steps_full.to_bytes(1, byteorder="big"))
-    print(steps_full.to_bytes(1, byteorder="big"))
+def move_x_axis(distance_mm: float, err_tol: float = 1) -> None:
+    '''Move the x axis by a specified distance in mm, see StepperController.move_x_axis.'''
+    current().stepper.move_x_axis(distance_mm, err_tol)
 
-    # Wait until task completed
-    while ser.in_waiting < 1:
-        continue
 
-    _ = ser.read(1)
+def move_y_axis(distance_mm: float, err_tol: float = 1) -> None:
+    '''Move the y axis by a specified distance in mm, see StepperController.move_y_axis.'''
+    current().stepper.move_y_axis(distance_mm, err_tol)
 
-    return
+
+def move_fine_focus(degrees: float, err_tol: float = 1) -> None:
+    '''Move the fine focus knob by a specified distance in degrees, see StepperController.move_fine_focus.'''
+    current().stepper.move_fine_focus(degrees, err_tol)
+
+
+def move_coarse_focus(degrees: float, err_tol: float = 1) -> None:
+    '''Move the coarse focus knob by a specified distance in degrees. Not Implemented.'''
+    current().stepper.move_coarse_focus(degrees, err_tol)
+
+
+def move_xyz(dx_mm: float, dy_mm: float, dfocus_deg: float) -> None:
+    '''Move the x, y and fine focus axes together, see StepperController.move_xyz.'''
+    current().stepper.move_xyz(dx_mm, dy_mm, dfocus_deg)
+
+
+def move_to(x_mm: Optional[float] = None, y_mm: Optional[float] = None, focus_deg: Optional[float] = None) -> None:
+    '''Move the x, y and fine focus axes together to absolute positions, see StepperController.move_to.'''
+    current().stepper.move_to(x_mm, y_mm, focus_deg)
+
+
+def get_position() -> Tuple[float, float, float]:
+    '''Return the position the axes were last commanded to, see StepperController.get_position.'''
+    return current().stepper.get_position()
+
+
+def queue_move(axis: str, amount: float) -> None:
+    '''Queue a relative move of an axis to be sent with the next move or image, see StepperController.queue_move.'''
+    current().stepper.queue_move(axis, amount)
+
+
+def flush_moves() -> None:
+    '''Send the queued moves, see StepperController.flush_moves.'''
+    current().stepper.flush_moves()
+
+
+def move_sequence(moves: Sequence[Tuple[str, float]], dwell_s: float = 0) -> None:
+    '''Send several moves as a single batch which is executed in order, see StepperController.move_sequence.'''
+    current().stepper.move_sequence(moves, dwell_s)
 
 ###############################################################################
 #                            Computer Vision API                              #
 ###############################################################################
 
+# Streaming z-stack analyzer, see create_z_stack_analyzer.
+ZStackAnalyzer = image_processing.ZStackAnalyzer
+
 
 def analyze_z_stack(images: Sequence[OpenCVImage]) -> Tuple[np.ndarray, int]:
     '''Analyze a stack of images at varying level of focus to determine most in focus image.
@@ -238,3 +798,23 @@ def analyze_z_stack(images: Sequence[OpenCVImage]) -> Tuple[np.ndarray, int]:
     ix, ranks, metrics = image_processing.analyze_z_stack(images)
 
     return metrics, ix
+
+
+def fuse_z_stack(images: Sequence[OpenCVImage]) -> Tuple[OpenCVImage, np.ndarray]:
+    '''Fuse a stack of images at varying level of focus into one image which is in focus everywhere.
+
+    :param images: A sequence of images of the same microscope field taken at varying levels of focus.
+    :returns: The fused image and a float32 depth map of the index of the image each pixel was taken
+    from, see edf.fuse.
+    '''
+    return edf.fuse(images)
+
+
+def create_z_stack_analyzer(n_images: int) -> ZStackAnalyzer:
+    '''Create an analyzer which scores the images of a z-stack one at a time as they are captured.
+
+    :param n_images: the number of images expected in the z-stack.
+    :returns: A ZStackAnalyzer. Push each image to it as it is captured, then call result() for the
+    metrics and ranks of the stack and read best_image for the most in-focus image.
+    '''
+    return image_processing.ZStackAnalyzer(n_images)
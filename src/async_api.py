@@ -0,0 +1,204 @@
+'''
+    Asynchronous interoperability layer for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Optional, Sequence, Tuple
+import api
+
+
+class AsyncStage:
+    '''asyncio interface to the stepper controller.
+
+    Each command is written straight away and returns a future which resolves with the controller's
+    reply once the move has finished, so moves can be queued and other work awaited while they run.
+    A reader task waits for replies on a background thread with a blocking serial read instead of
+    polling. The controller executes commands in order, so each reply resolves the oldest outstanding
+    future. Moves queued with api.queue_move are folded into the next command sent, as they are by the
+    blocking API. Requires protocol version 2 and a stepper controller opened with api.stepper_controller_init.
+    An AsyncStage can be started again once closed.
+    '''
+
+    def __init__(self, stepper: Optional[api.StepperController] = None):
+        '''
+        :param stepper: the stepper controller to drive, or None for the current widget's.
+        '''
+        self.stepper = stepper or api.current().stepper
+        self._pending: Deque[Tuple[int, asyncio.Future]] = collections.deque()
+        self._reader: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._closing = False
+
+    async def __aenter__(self) -> "AsyncStage":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    def start(self) -> None:
+        '''Start the reader task. Must be called from a running event loop.
+
+        :raises NotImplementedError: when the stepper controller's protocol version is below 2.
+        '''
+        if self.stepper.protocol_version < 2:
+            raise NotImplementedError("The asynchronous API requires protocol version 2.")
+
+        if self._reader is None:
+            self._closing = False
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stage-reader")
+            self._reader = asyncio.get_running_loop().create_task(self._read_replies())
+
+    async def close(self) -> None:
+        '''Wait for every outstanding command to finish, then stop the reader task. Does nothing when not started.'''
+        if self._reader is None:
+            return
+        if self._pending:
+            await asyncio.gather(*(future for _, future in list(self._pending)), return_exceptions=True)
+
+        self._closing = True
+        self.stepper.ser.cancel_read()
+        await self._reader
+        self._reader = None
+        self._executor.shutdown()
+        self._executor = None
+
+    def move_x(self, distance_mm: float) -> asyncio.Future:
+        '''Move the x axis by a specified distance in mm.
+
+        :param distance_mm: the distance to move the axis in mm.
+        :returns: a future which resolves when the move has finished.
+        '''
+        return self.move_sequence([("x", distance_mm)])
+
+    def move_y(self, distance_mm: float) -> asyncio.Future:
+        '''Move the y axis by a specified distance in mm.
+
+        :param distance_mm: the distance to move the axis in mm.
+        :returns: a future which resolves when the move has finished.
+        '''
+        return self.move_sequence([("y", distance_mm)])
+
+    def move_fine_focus(self, degrees: float) -> asyncio.Future:
+        '''Move the fine focus knob by a specified distance in degrees.
+
+        :param degrees: the distance to move the fine focus in degrees.
+        :returns: a future which resolves when the move has finished.
+        '''
+        return self.move_sequence([("focus_fine", degrees)])
+
+    def move_xyz(self, dx_mm: float, dy_mm: float, dfocus_deg: float) -> asyncio.Future:
+        '''Move the x, y and fine focus axes together, see api.move_xyz. Queued moves are made with this move.
+
+        :returns: a future which resolves when the move has finished.
+        '''
+        return self._send(api._cmd_move_coordinated, self.stepper._move_xyz_payload(dx_mm, dy_mm, dfocus_deg))
+
+    def move_sequence(self, moves: Sequence[Tuple[str, float]], dwell_s: float = 0) -> asyncio.Future:
+        '''Send several moves as a single batch which is executed in order, see api.move_sequence. The batch
+        starts with the queued moves.
+
+        :returns: a future which resolves when every move has finished.
+        '''
+        return self._send(api._cmd_move_batch, self.stepper._move_sequence_payload(moves, dwell_s))
+
+    def _send(self, command: int, payload: bytes) -> asyncio.Future:
+        if self._reader is None:
+            raise RuntimeError("AsyncStage.start must be called before sending commands.")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((command, future))
+        self.stepper.ser.write(self.stepper._encode_frame(command, payload))
+        return future
+
+    def _read_one(self) -> Optional[Tuple[int, int, bytes]]:
+        '''Block until a reply arrives, or return None once the stage is closing. Runs on the reader thread.'''
+        while True:
+            first = self.stepper.ser.read(1)
+            if first:
+                return self.stepper._read_reply(first)
+            if self._closing:
+                return None
+
+    async def _read_replies(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                reply = await loop.run_in_executor(self._executor, self._read_one)
+            except api.StepperControllerError as e:
+                # Replies can no longer be matched to commands, so fail everything outstanding.
+                print(f"Error reading reply from stepper controller. {e}")
+                while self._pending:
+                    _, future = self._pending.popleft()
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            if reply is None:
+                return
+
+            command, status, data = reply
+            if not self._pending:
+                print(f"Unexpected reply to command {command} from stepper controller.")
+                continue
+
+            expected, future = self._pending.popleft()
+            if future.done():
+                # The caller cancelled the future, but the command still ran.
+                continue
+
+            try:
+                if command != expected:
+                    raise api.StepperControllerError(
+                        f"Received a reply to command {command} instead of {expected}."
+                    )
+                api._check_status(command, status)
+            except api.StepperControllerError as e:
+                future.set_exception(e)
+            else:
+                future.set_result(data)
+
+
+class AsyncCamera:
+    '''asyncio interface to the camera.
+
+    Snapshots run on a single worker thread, since the camera controller handles one request at a time.
+    Unlike api.take_image, a snapshot never sends queued moves, since the stepper controller's replies are
+    read by an AsyncStage. Send them with an AsyncStage move before snapping.
+    '''
+
+    def __init__(self, widget: Optional[api.Widget] = None):
+        '''
+        :param widget: the widget whose camera to drive, or None for the current widget.
+        '''
+        self.widget = widget or api.current()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="camera")
+
+    async def snap(self) -> api.OpenCVImage:
+        '''Take an image from the microscope camera without blocking the event loop.
+
+        :raises RuntimeError: when moves are queued, since the image would be taken before they are made.
+        '''
+        if any(self.widget.stepper._queued_degrees.values()):
+            raise RuntimeError("Send the queued moves with an AsyncStage move before taking an image.")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.widget._capture)
+
+    def close(self) -> None:
+        '''Wait for any snapshot in progress and stop the worker thread.'''
+        self._executor.shutdown()
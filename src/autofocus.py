@@ -0,0 +1,220 @@
+'''
+    Closed-loop autofocus for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from dataclasses import dataclass, field
+from time import sleep
+from typing import List, Optional
+import api
+import image_processing
+import settle
+import tracing
+
+# Ratio used to place the probes of a golden-section search.
+_inv_phi = (5 ** 0.5 - 1) / 2
+
+
+@dataclass
+class AutofocusResult:
+    '''The result of an autofocus search.
+
+    :param image: the most in-focus image captured.
+    :param metric: the focus metric of that image.
+    :param focus: the fine focus position in degrees the search finished at, relative to where it started.
+    :param positions: the fine focus position of every capture, relative to where the search started.
+    :param metrics: the focus metric of every capture.
+    '''
+    image: api.OpenCVImage
+    metric: float
+    focus: float
+    positions: List[float] = field(default_factory=list)
+    metrics: List[float] = field(default_factory=list)
+
+    @property
+    def n_captures(self) -> int:
+        return len(self.positions)
+
+
+class _Search:
+    '''Tracks the fine focus position and every capture made during a search.'''
+
+    def __init__(
+        self,
+        algorithm: str,
+        movement_sleep: float,
+        settle_detector: Optional[settle.SettleDetector],
+        max_captures: Optional[int]
+    ):
+        self.algorithm = algorithm
+        self.movement_sleep = movement_sleep
+        self.settle_detector = settle_detector
+        self.max_captures = max_captures
+        self.position = 0.0
+        self.result = None
+
+    @property
+    def spent(self) -> bool:
+        "Whether the search has made as many captures as it may."
+        return self.max_captures is not None and self.result.n_captures >= self.max_captures
+
+    def move_to(self, position: float) -> None:
+        if position != self.position:
+            api.move_fine_focus(position - self.position)
+            if self.settle_detector is None:
+                with tracing.span("settle"):
+                    sleep(self.movement_sleep)
+            self.position = position
+
+    def capture(self) -> float:
+        if self.settle_detector is None:
+            image = api.take_image()
+        else:
+            image, _, _ = self.settle_detector.wait()
+        metric = image_processing.score_image(image, self.algorithm)
+
+        if self.result is None:
+            self.result = AutofocusResult(image, metric, self.position)
+        elif metric > self.result.metric:
+            self.result.image = image
+            self.result.metric = metric
+
+        self.result.positions.append(self.position)
+        self.result.metrics.append(metric)
+        return metric
+
+    def probe(self, position: float) -> float:
+        self.move_to(position)
+        return self.capture()
+
+
+def search(
+    z_step_size: float,
+    max_steps: int = 10,
+    method: str = "parabolic",
+    min_step: float = api.step_degrees,
+    algorithm: str = "normed_var",
+    movement_sleep: float = 0.5,
+    settle_detector: Optional[settle.SettleDetector] = None,
+    max_captures: Optional[int] = None
+) -> AutofocusResult:
+    '''Search for the best focused plane, scoring each image as it is captured.
+
+    Assumes the microscope is initially near the best focus. The search hill-climbs in steps of
+    z_step_size until the peak of the focus metric is bracketed, then refines the peak inside the
+    bracket and finishes at the best plane, so no return trip is needed afterwards. With max_captures,
+    the search stops at the best plane found so far once it has captured that many images, so it never
+    takes more images than a z-stack of that size would.
+
+    :param z_step_size: the number of degrees to turn the fine focus knob per hill-climbing step.
+    :param max_steps: the maximum number of hill-climbing steps before giving up on bracketing the peak.
+    :param method: "parabolic" moves to the vertex of a parabola through the bracket, "golden" narrows
+    the bracket with a golden-section search down to min_step.
+    :param min_step: the smallest fine focus movement in degrees worth making.
+    :param algorithm: the name of the focus metric in image_processing.algorithms.
+    :param movement_sleep: how long to wait after moving to take an image in seconds.
+    :param settle_detector: if given, wait for each move to settle with it and use its frames as the
+    captures instead of sleeping for movement_sleep and calling api.take_image.
+    :param max_captures: the most images to capture, at least 3, or None for no limit.
+    :returns: the search result, with focus holding the position the fine focus was left at.
+    :raises ValueError: when method is unknown or max_captures is below 3.
+    '''
+    if method not in ("parabolic", "golden"):
+        raise ValueError(f"Unknown autofocus method {method}.")
+    if max_captures is not None and max_captures < 3:
+        raise ValueError("An autofocus search needs at least 3 captures to bracket the peak.")
+
+    s = _Search(algorithm, movement_sleep, settle_detector, max_captures)
+    f_centre = s.capture()
+    f_up = s.probe(z_step_size)
+
+    # Climb in whichever direction improves the metric.
+    if f_up > f_centre:
+        direction = 1
+        a, fa, b, fb = 0.0, f_centre, z_step_size, f_up
+    else:
+        f_down = s.probe(-z_step_size)
+        if f_down <= f_centre:
+            # Already bracketed by the first two probes.
+            a, fa, b, fb, c, fc = -z_step_size, f_down, 0.0, f_centre, z_step_size, f_up
+            return _refine(s, a, fa, b, fb, c, fc, method, min_step)
+        direction = -1
+        a, fa, b, fb = 0.0, f_centre, -z_step_size, f_down
+
+    for _ in range(max_steps):
+        if s.spent:
+            break
+        c = b + direction * z_step_size
+        fc = s.probe(c)
+        if fc <= fb:
+            return _refine(s, a, fa, b, fb, c, fc, method, min_step)
+        a, fa, b, fb = b, fb, c, fc
+
+    # The peak was never bracketed, stop at the best plane seen.
+    print(f"Autofocus did not bracket the peak within {s.result.n_captures} captures.")
+    s.move_to(b)
+    s.result.focus = s.position
+    return s.result
+
+
+def _refine(
+    s: _Search,
+    a: float, fa: float,
+    b: float, fb: float,
+    c: float, fc: float,
+    method: str,
+    min_step: float
+) -> AutofocusResult:
+    '''Refine a bracketed peak fa <= fb >= fc and leave the fine focus at the best plane.'''
+
+    if method == "parabolic":
+        # Vertex of the parabola through the three equally spaced points.
+        denominator = fa - 2 * fb + fc
+        offset = 0.0 if denominator == 0 else 0.5 * (fa - fc) / denominator * (c - b)
+        vertex = b + offset
+
+        if abs(offset) >= min_step and not s.spent:
+            f_vertex = s.probe(vertex)
+            s.move_to(vertex if f_vertex >= fb else b)
+        else:
+            s.move_to(b)
+    else:
+        lo, hi = min(a, c), max(a, c)
+        best, f_best = b, fb
+        while hi - lo > min_step and not s.spent:
+            # Probe the golden-section point of the larger side of the bracket.
+            if hi - best > best - lo:
+                x = best + (1 - _inv_phi) * (hi - best)
+            else:
+                x = best - (1 - _inv_phi) * (best - lo)
+            if abs(x - best) < min_step:
+                break
+
+            fx = s.probe(x)
+            if fx > f_best:
+                if x > best:
+                    lo = best
+                else:
+                    hi = best
+                best, f_best = x, fx
+            elif x > best:
+                hi = x
+            else:
+                lo = x
+        s.move_to(best)
+
+    s.result.focus = s.position
+    return s.result
@@ -0,0 +1,388 @@
+'''
+    Focus metric benchmark for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Collection, Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+import cv2
+import image_processing
+import reanalyze
+import synthetic
+
+# (height, width) of the synthetic stacks.
+default_resolutions = [(480, 640), (960, 1280)]
+
+# Numbers of planes in the synthetic stacks.
+default_depths = [5, 9, 17]
+
+# Gaussian blur sigma in pixels per plane from the in-focus plane of the synthetic stacks. Shallow
+# enough that the neighbours of the in-focus plane are hard to tell from it.
+default_blur_per_plane = 0.3
+
+# Standard deviation of the sensor noise of the synthetic stacks in grey levels.
+default_noise = 4.0
+
+
+@dataclass
+class Result:
+    '''How one focus metric did on one set of z-stacks.
+
+    :param source: "synthetic" or "stored".
+    :param algorithm: the name of the focus metric in image_processing.algorithms.
+    :param height: the height of the stacks in pixels, or 0 when they differ.
+    :param width: the width of the stacks in pixels, or 0 when they differ.
+    :param depth: the number of planes of the stacks, or 0 when they differ.
+    :param roi_fraction: the fraction of each side of the image, centred, the metric used.
+    :param downsample: the metric used every downsample-th pixel in each direction.
+    :param chunk_size: the number of planes the metric was calculated on at once, or None for every plane.
+    :param n_stacks: the number of stacks.
+    :param stacks_per_s: the stacks analyzed per second.
+    :param mpix_per_s: the millions of pixels, counting every plane, analyzed per second.
+    :param peak_memory_bytes: the most memory allocated at once analyzing one stack, not counting the stack.
+    :param n_scored: the number of stacks with a ground truth plane.
+    :param mean_abs_error: the mean distance in planes of the chosen plane from the ground truth plane.
+    :param max_abs_error: the largest distance in planes of the chosen plane from the ground truth plane.
+    :param accuracy: the fraction of stacks in which the ground truth plane was chosen.
+    '''
+    source: str
+    algorithm: str
+    height: int
+    width: int
+    depth: int
+    roi_fraction: float
+    downsample: int
+    n_stacks: int
+    stacks_per_s: float
+    mpix_per_s: float
+    peak_memory_bytes: int
+    n_scored: int = 0
+    mean_abs_error: Optional[float] = None
+    max_abs_error: Optional[int] = None
+    accuracy: Optional[float] = None
+    chunk_size: Optional[int] = None
+
+    def key(self) -> tuple:
+        "What identifies the result when comparing runs."
+        return (
+            self.source, self.algorithm, self.height, self.width, self.depth, self.roi_fraction, self.downsample,
+            self.chunk_size
+        )
+
+
+def synthetic_stacks(
+    n_stacks: int,
+    depth: int,
+    shape: Tuple[int, int],
+    blur_per_plane: float = default_blur_per_plane,
+    noise: float = default_noise,
+    seed: int = 0
+) -> Tuple[List[np.ndarray], List[int]]:
+    '''Render z-stacks of a synthetic blood film with a known in-focus plane.
+
+    Each stack images a different part of the slide, and each plane is blurred in proportion to its
+    distance from a randomly chosen in-focus plane, then given sensor noise.
+
+    :param n_stacks: the number of stacks.
+    :param depth: the number of planes of each stack.
+    :param shape: the (height, width) of each plane in pixels.
+    :param blur_per_plane: the Gaussian blur sigma in pixels per plane from the in-focus plane.
+    :param noise: the standard deviation of the sensor noise in grey levels.
+    :param seed: the random seed.
+    :returns: the (depth, height, width, 3) uint8 RGB stacks and the index of the in-focus plane of each.
+    '''
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    slide = synthetic.make_slide(2 * h, 2 * w, seed=seed)
+
+    stacks, truth = [], []
+    for _ in range(n_stacks):
+        y, x = int(rng.integers(h)), int(rng.integers(w))
+        sharp = slide[y:y + h, x:x + w]
+        best = int(rng.integers(depth))
+        stack = np.empty((depth, h, w, 3), dtype=np.uint8)
+        for k in range(depth):
+            sigma = blur_per_plane * abs(k - best)
+            plane = cv2.GaussianBlur(sharp, (0, 0), sigma) if sigma > 0 else sharp
+            stack[k] = np.clip(plane + rng.normal(0, noise, plane.shape), 0, 255)
+        stacks.append(stack)
+        truth.append(best)
+    return stacks, truth
+
+
+@dataclass
+class StoredStacks:
+    '''The z-stacks under a directory, read one at a time each time they are iterated.
+
+    Only the stack being analyzed is held, memory-mapped where reanalyze.read_stack can, so a set of
+    reference stacks larger than memory can be benchmarked.
+    '''
+    stacks: List[reanalyze.StackRef]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for stack in self.stacks:
+            yield reanalyze.read_stack(stack)
+
+    def __len__(self) -> int:
+        return len(self.stacks)
+
+
+def stored_stacks(root: Path, truth_path: Optional[Path] = None) -> Tuple[StoredStacks, List[Optional[int]]]:
+    '''Find every z-stack under a directory, such as the reference z-stacks, see reanalyze.find_stacks.
+
+    :param root: the directory.
+    :param truth_path: a JSON file of the index of the in-focus plane of each stack by name, or None.
+    Stacks without one are timed but not scored.
+    :returns: the stacks, read as they are analyzed, and the index of the in-focus plane of each or None.
+    '''
+    truth = json.loads(Path(truth_path).read_text()) if truth_path is not None else {}
+    stacks = list(reanalyze.find_stacks(root))
+    return StoredStacks(stacks), [truth.get(stack.name) for stack in stacks]
+
+
+def _roi(shape: Tuple[int, int], fraction: float) -> Optional[image_processing.Roi]:
+    if fraction >= 1:
+        return None
+    h, w = shape
+    rw, rh = max(1, int(w * fraction)), max(1, int(h * fraction))
+    return (w - rw) // 2, (h - rh) // 2, rw, rh
+
+
+def measure(
+    source: str,
+    stacks: Collection[np.ndarray],
+    truth: Sequence[Optional[int]],
+    algorithm: str,
+    roi_fraction: float = 1.0,
+    downsample: int = 1,
+    repeats: int = 3,
+    chunk_size: Optional[int] = None
+) -> Result:
+    '''Time one focus metric on a set of z-stacks, measure its peak memory and score its choices.
+
+    Each stack is analyzed repeats times and the fastest time of each kept, so the throughput is not
+    thrown off by whatever else the machine is doing. Peak memory is measured with tracemalloc on a
+    separate pass, since tracing allocations slows them down.
+
+    :param source: where the stacks came from, recorded in the result.
+    :param stacks: the (N, H, W, 3) RGB or (N, H, W) greyscale stacks, such as StoredStacks, which are
+    iterated once.
+    :param truth: the index of the in-focus plane of each stack, or None where it is not known.
+    :param algorithm: the name of the focus metric in image_processing.algorithms.
+    :param roi_fraction: the fraction of each side of the image, centred, to use.
+    :param downsample: use every downsample-th pixel in each direction.
+    :param repeats: how many times to analyze each stack.
+    :param chunk_size: the number of planes to calculate the metric of at once, see
+    image_processing.chunked_metric, or None for every plane.
+    :returns: the result.
+    '''
+    times, errors, peak = [], [], 0
+    shapes, pixels = set(), 0
+    for stack, best in zip(stacks, truth):
+        from_rgb = stack.ndim == 4
+        roi = _roi(stack.shape[1:3], roi_fraction)
+
+        fastest = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            index, _, _ = image_processing.analyze_z_stack(stack, algorithm, from_rgb, roi, downsample, chunk_size)
+            fastest = min(fastest, time.perf_counter() - start)
+        times.append(fastest)
+        if best is not None:
+            errors.append(abs(int(index) - best))
+
+        tracemalloc.start()
+        image_processing.analyze_z_stack(stack, algorithm, from_rgb, roi, downsample, chunk_size)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        shapes.add(stack.shape[:3])
+        pixels += int(np.prod(stack.shape[:3]))
+
+    depth, height, width = shapes.pop() if len(shapes) == 1 else (0, 0, 0)
+    total = sum(times)
+    return Result(
+        source, algorithm, height, width, depth, roi_fraction, downsample, len(stacks),
+        len(stacks) / total, pixels / total / 1e6, peak, len(errors),
+        float(np.mean(errors)) if errors else None, int(max(errors)) if errors else None,
+        float(np.mean([error == 0 for error in errors])) if errors else None, chunk_size
+    )
+
+
+def run(
+    output_path: Path,
+    algorithms: Optional[Sequence[str]] = None,
+    resolutions: Sequence[Tuple[int, int]] = default_resolutions,
+    depths: Sequence[int] = default_depths,
+    n_stacks: int = 8,
+    roi_fractions: Sequence[float] = (1.0,),
+    downsamples: Sequence[int] = (1,),
+    repeats: int = 3,
+    stored_root: Optional[Path] = None,
+    truth_path: Optional[Path] = None,
+    blur_per_plane: float = default_blur_per_plane,
+    noise: float = default_noise,
+    chunk_size: Optional[int] = None
+) -> List[Result]:
+    '''Benchmark focus metrics on synthetic z-stacks and, optionally, stored ones.
+
+    Every metric is run with every combination of ROI fraction and downsampling on synthetic stacks of
+    every resolution and depth, then on the stored stacks. The results are written to output_path as
+    JSON along with the settings of the run and the versions of the libraries and the machine they
+    were measured on.
+
+    :param output_path: the JSON file to write the results to.
+    :param algorithms: the names of the focus metrics in image_processing.algorithms, or None for all.
+    :param resolutions: the (height, width) of the synthetic stacks.
+    :param depths: the numbers of planes of the synthetic stacks.
+    :param n_stacks: the number of synthetic stacks of each resolution and depth.
+    :param roi_fractions: the fractions of each side of the image, centred, to use.
+    :param downsamples: the downsampling factors to use.
+    :param repeats: how many times to analyze each stack when timing.
+    :param stored_root: a directory of stored stacks, see stored_stacks, or None.
+    :param truth_path: the in-focus plane of each stored stack, see stored_stacks.
+    :param blur_per_plane: the defocus of the synthetic stacks, see synthetic_stacks.
+    :param noise: the sensor noise of the synthetic stacks, see synthetic_stacks.
+    :param chunk_size: the number of planes to calculate the metric of at once, see measure.
+    :returns: the results.
+    '''
+    algorithms = list(algorithms or image_processing.algorithms)
+    unknown = set(algorithms) - set(image_processing.algorithms)
+    if unknown:
+        raise ValueError(f"Unknown focus metrics {sorted(unknown)}.")
+
+    sources = []
+    for shape in resolutions:
+        for depth in depths:
+            sources.append(("synthetic",) + synthetic_stacks(n_stacks, depth, shape, blur_per_plane, noise))
+    if stored_root is not None:
+        sources.append(("stored",) + stored_stacks(stored_root, truth_path))
+
+    results = []
+    for source, stacks, truth in sources:
+        for algorithm in algorithms:
+            for roi_fraction in roi_fractions:
+                for downsample in downsamples:
+                    result = measure(
+                        source, stacks, truth, algorithm, roi_fraction, downsample, repeats, chunk_size
+                    )
+                    results.append(result)
+                    _print_result(result)
+
+    Path(output_path).write_text(json.dumps({
+        "settings": {
+            "n_stacks": n_stacks,
+            "repeats": repeats,
+            "blur_per_plane": blur_per_plane,
+            "noise": noise,
+            "stored_root": str(stored_root) if stored_root is not None else None,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "time": time.time(),
+        },
+        "results": [asdict(result) for result in results],
+    }, indent=2))
+    print(f"Results written to {output_path}.")
+    return results
+
+
+def _print_result(result: Result) -> None:
+    error = f"{result.mean_abs_error:.2f}" if result.mean_abs_error is not None else "-"
+    print(
+        f"{result.source:9} {result.algorithm:13} {result.width:5}x{result.height:<5} depth {result.depth:3} "
+        f"roi {result.roi_fraction:.2f} ds {result.downsample} | {result.stacks_per_s:8.1f} stacks/s "
+        f"{result.mpix_per_s:8.1f} MPix/s {result.peak_memory_bytes / 2 ** 20:7.1f} MiB | error {error}"
+    )
+
+
+def read(path: Path) -> List[Result]:
+    '''Read the results written by run.'''
+    return [Result(**result) for result in json.loads(Path(path).read_text())["results"]]
+
+
+def compare(baseline_path: Path, results_path: Path) -> Dict[tuple, Tuple[float, Optional[float]]]:
+    '''Compare two runs, such as before and after a change to a focus metric.
+
+    :param baseline_path: the results of the earlier run.
+    :param results_path: the results of the later run.
+    :returns: for each result in both runs, the ratio of its throughput to the baseline's and the change
+    in its mean error in planes, or None when either is not scored.
+    '''
+    baseline = {result.key(): result for result in read(baseline_path)}
+    changes = {}
+    for result in read(results_path):
+        old = baseline.get(result.key())
+        if old is None:
+            continue
+        error = None
+        if result.mean_abs_error is not None and old.mean_abs_error is not None:
+            error = result.mean_abs_error - old.mean_abs_error
+        changes[result.key()] = (result.stacks_per_s / old.stacks_per_s, error)
+        print(
+            f"{' '.join(map(str, result.key()))}: {changes[result.key()][0]:.2f}x throughput"
+            + (f", error {error:+.2f} planes" if error is not None else "")
+        )
+
+    if changes:
+        print(f"Median throughput {statistics.median(ratio for ratio, _ in changes.values()):.2f}x the baseline.")
+    return changes
+
+
+def _resolution(text: str) -> Tuple[int, int]:
+    height, width = text.lower().split("x")
+    return int(height), int(width)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the speed, memory and accuracy of the focus metrics.")
+    parser.add_argument("--output", default="benchmark.json", help="The JSON file to write the results to.")
+    parser.add_argument("--algorithms", nargs="+", choices=list(image_processing.algorithms))
+    parser.add_argument("--resolutions", nargs="+", type=_resolution, default=default_resolutions,
+                        help="HEIGHTxWIDTH of the synthetic stacks.")
+    parser.add_argument("--depths", nargs="+", type=int, default=default_depths)
+    parser.add_argument("--stacks", type=int, default=8, help="Synthetic stacks per resolution and depth.")
+    parser.add_argument("--roi-fractions", nargs="+", type=float, default=[1.0])
+    parser.add_argument("--downsamples", nargs="+", type=int, default=[1])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--blur-per-plane", type=float, default=default_blur_per_plane)
+    parser.add_argument("--noise", type=float, default=default_noise)
+    parser.add_argument("--stored", help="A directory of stored z-stacks, such as the reference z-stacks.")
+    parser.add_argument("--truth", help="A JSON file of the in-focus plane of each stored stack by name.")
+    parser.add_argument("--chunk-size", type=int, help="Planes per stack converted to float32 at once, all by default.")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare the results with an earlier run.")
+    args = parser.parse_args()
+
+    run(
+        Path(args.output), args.algorithms, args.resolutions, args.depths, args.stacks, args.roi_fractions,
+        args.downsamples, args.repeats, args.stored, args.truth, args.blur_per_plane, args.noise, args.chunk_size
+    )
+    if args.compare is not None:
+        compare(Path(args.compare), Path(args.output))
@@ -0,0 +1,246 @@
+'''
+    Camera backends for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import threading
+import time
+from typing import Optional, Tuple
+import numpy as np
+
+# Type hint for opencv image
+OpenCVImage = np.ndarray
+
+
+class CameraBackend:
+    '''A camera which can take images into caller provided buffers.
+
+    Backends implement connect and snapshot_into. snapshot_into should write straight into out when it
+    is given, so callers can reuse preallocated buffers such as the slots of a FrameRingBuffer.
+    '''
+
+    def connect(self) -> None:
+        "Initialize the camera connection."
+        raise NotImplementedError
+
+    def snapshot_into(self, out: Optional[OpenCVImage] = None) -> OpenCVImage:
+        '''Take an image. This call blocks until the image is ready.
+
+        :param out: a contiguous uint8 array with the shape of the camera's images to write the image
+        into, or None to allocate a new array.
+        :returns: the array holding the image, which is out when it was given.
+        '''
+        raise NotImplementedError
+
+    def snapshot(self) -> OpenCVImage:
+        "Take an image into a new array. This call blocks until the image is ready."
+        return self.snapshot_into(None)
+
+
+# The MATLAB engine shared by every MatlabCamera in the process, started by the first to connect.
+# Calls into it are serialized by the lock, since one engine runs one command at a time.
+_matlab_engine = None
+_matlab_lock = threading.Lock()
+
+
+class MatlabCamera(CameraBackend):
+    '''Lumenera camera driven through the Lucam SDK in the MATLAB engine.
+
+    The MATLAB engine is only imported and started on connect, so the rest of the software can be used
+    without MATLAB installed, for example with the simulated camera in simulator.py. Every camera in
+    the process shares one engine, so several widgets can be driven without a MATLAB instance each.
+    '''
+
+    def __init__(self, camera_num: int = 0):
+        self.camera_num = camera_num
+        self.eng = None
+
+    def connect(self) -> None:
+        "Start the shared MATLAB engine if needed and connect to the camera."
+        global _matlab_engine
+        import matlab.engine
+
+        with _matlab_lock:
+            if _matlab_engine is None:
+                _matlab_engine = matlab.engine.start_matlab()
+            self.eng = _matlab_engine
+
+            try:
+                self.eng.LucamConnect(self.camera_num)
+                print("Success connecting to camera number: ", self.camera_num)
+            except matlab.engine.EngineError:
+                print("Error connecting to camera number:", self.camera_num)
+
+    def snapshot_into(self, out: Optional[OpenCVImage] = None) -> OpenCVImage:
+        import matlab.engine
+
+        try:
+            with _matlab_lock:
+                connected = self.eng.LucamIsConnected(self.camera_num)
+                data = self.eng.LucamTakeSnapshot(self.camera_num) if connected else None
+            if connected:
+                frame = _matlab_array_view(data)
+                if out is None:
+                    return np.ascontiguousarray(frame)
+                np.copyto(out, frame)
+                return out
+        except(
+            matlab.engine.MatlabExecutionError,
+            matlab.engine.RejectedExecutionError,
+            SyntaxError,
+            TypeError
+        ) as e:
+            print(f"Error taking snapshot. {e}")
+            raise e
+
+
+def _matlab_array_view(data) -> np.ndarray:
+    '''View a MATLAB numeric array as an ndarray without converting it element by element.
+
+    MATLAB arrays store their elements column-major in a flat buffer, so the view is Fortran ordered.
+    Copying it into a C ordered array is a single strided copy rather than a Python level conversion.
+    '''
+    buffer = getattr(data, "_data", None)
+    if buffer is None:
+        return np.asarray(data)
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(data.size, order="F")
+
+
+class FrameRingBuffer:
+    '''A fixed set of preallocated frames which are filled in turn and reused.
+
+    Frames returned by latest and wait_for are views of the ring, and are overwritten once n_slots more
+    frames have been published. Copy a frame to keep it longer.
+    '''
+
+    def __init__(self, shape: Tuple[int, ...], n_slots: int = 4, dtype=np.uint8):
+        '''
+        :param shape: the shape of each frame.
+        :param n_slots: the number of frames in the ring.
+        :param dtype: the dtype of each frame.
+        '''
+        self.frames = np.empty((n_slots,) + tuple(shape), dtype=dtype)
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def write_slot(self) -> np.ndarray:
+        '''Return the slot the next frame should be written into. Call publish once it is written.'''
+        return self.frames[self._count % len(self.frames)]
+
+    def publish(self) -> int:
+        '''Mark the frame in the write slot as ready.
+
+        :returns: the sequence number of the published frame, counting from 1.
+        '''
+        with self._condition:
+            self._count += 1
+            self._condition.notify_all()
+            return self._count
+
+    def latest(self) -> Tuple[int, Optional[np.ndarray]]:
+        '''Return the sequence number and a view of the most recently published frame.
+
+        :returns: (0, None) if no frame has been published yet.
+        '''
+        with self._condition:
+            if self._count == 0:
+                return 0, None
+            return self._count, self.frames[(self._count - 1) % len(self.frames)]
+
+    def wait_for(self, after: int, timeout: Optional[float] = None) -> Tuple[int, Optional[np.ndarray]]:
+        '''Block until a frame newer than sequence number after is published.
+
+        :param after: the sequence number of the last frame seen.
+        :param timeout: the maximum time to wait in seconds, or None to wait indefinitely.
+        :returns: the sequence number and a view of the newest frame, or (after, None) on timeout.
+        '''
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._count > after, timeout):
+                return after, None
+            return self._count, self.frames[(self._count - 1) % len(self.frames)]
+
+
+class CameraStream:
+    '''Continuously captures images from a camera into a FrameRingBuffer on a background thread.
+
+    The ring is allocated once the first image shows the camera's image shape. After that every image
+    is written straight into a ring slot, so streaming does not allocate memory per frame and images
+    can be taken while the stage is moving.
+    '''
+
+    def __init__(self, camera: CameraBackend, n_slots: int = 4):
+        '''
+        :param camera: the camera to capture from.
+        :param n_slots: the number of frames kept in the ring.
+        '''
+        self.camera = camera
+        self.n_slots = n_slots
+        self.ring: Optional[FrameRingBuffer] = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "CameraStream":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def stop(self) -> None:
+        '''Stop capturing once the image in progress is finished.'''
+        self._stop.set()
+        self._thread.join()
+
+    def latest(self) -> Tuple[int, Optional[np.ndarray]]:
+        '''Return the sequence number and a view of the newest image, see FrameRingBuffer.latest.'''
+        self._raise_if_failed()
+        if self.ring is None:
+            return 0, None
+        return self.ring.latest()
+
+    def wait_for(self, after: int = 0, timeout: Optional[float] = None) -> Tuple[int, Optional[np.ndarray]]:
+        '''Block until an image newer than sequence number after is captured, see FrameRingBuffer.wait_for.
+
+        timeout covers the wait for the first image too, so the call never blocks for longer than it.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._ready.wait(timeout):
+            self._raise_if_failed()
+            return after, None
+        self._raise_if_failed()
+        return self.ring.wait_for(after, None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Camera stream failed.") from self._error
+
+    def _run(self) -> None:
+        try:
+            first = self.camera.snapshot_into(None)
+            self.ring = FrameRingBuffer(first.shape, self.n_slots, first.dtype)
+            np.copyto(self.ring.write_slot(), first)
+            self.ring.publish()
+            self._ready.set()
+
+            while not self._stop.is_set():
+                self.camera.snapshot_into(self.ring.write_slot())
+                self.ring.publish()
+        except Exception as e:
+            print(f"Error streaming from camera. {e}")
+            self._error = e
+            self._ready.set()
@@ -0,0 +1,401 @@
+'''
+    Red blood cell and parasite detection for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+import cv2
+import image_writer
+import jsonl
+import tracing
+
+# Name of the detection results file in a scan's output directory.
+file_name = "detections.jsonl"
+
+
+@dataclass(frozen=True)
+class DetectionParams:
+    '''Settings of the detector, in image pixels.
+
+    :param cell_radius_px: the typical radius of a red blood cell.
+    :param min_cell_fraction: the smallest cell counted, as a fraction of the area of a typical cell.
+    :param min_darkness: how much darker than the typical cell a pixel must be to belong to a stained
+    inclusion, as a fraction.
+    :param min_inclusion_area_px: the smallest inclusion scored, in pixels.
+    :param min_score: the score from which an inclusion is a parasite candidate, see find_candidates.
+    :param crop_size_px: the side of the square crop kept of each candidate.
+    '''
+    cell_radius_px: float = 18.0
+    min_cell_fraction: float = 0.25
+    min_darkness: float = 0.35
+    min_inclusion_area_px: int = 4
+    min_score: float = 0.6
+    crop_size_px: int = 32
+
+
+@dataclass
+class Candidate:
+    '''A stained inclusion which may be a parasite.
+
+    :param x: the x position of its centre in pixels.
+    :param y: the y position of its centre in pixels.
+    :param area: its area in pixels.
+    :param score: how strongly it is stained, see find_candidates.
+    :param cell: the label of the red blood cell it lies in, or -1 when it lies outside every cell.
+    '''
+    x: float
+    y: float
+    area: int
+    score: float
+    cell: int
+
+
+@dataclass
+class FieldDetection:
+    '''The cells and parasite candidates found in one field.
+
+    :param name: the name the field's image is written with.
+    :param n_cells: the number of red blood cells.
+    :param n_infected: the number of red blood cells holding at least one candidate.
+    :param candidates: the parasite candidates.
+    :param crops: the name in the output directory of the file holding a crop of each candidate in
+    the order of candidates, or "" when there are none.
+    '''
+    name: str
+    n_cells: int
+    n_infected: int
+    candidates: List[Candidate] = field(default_factory=list)
+    crops: str = ""
+
+
+@dataclass
+class SlideSummary:
+    '''The totals over every field of a scan.
+
+    :param n_fields: the number of fields.
+    :param n_cells: the number of red blood cells.
+    :param n_infected: the number of red blood cells holding a parasite candidate.
+    :param n_candidates: the number of parasite candidates, in cells or not.
+    '''
+    n_fields: int = 0
+    n_cells: int = 0
+    n_infected: int = 0
+    n_candidates: int = 0
+
+    @property
+    def parasitemia(self) -> float:
+        "The fraction of red blood cells infected, or 0 when no cells were found."
+        return self.n_infected / self.n_cells if self.n_cells else 0.0
+
+    def add(self, detection: FieldDetection) -> None:
+        self.n_fields += 1
+        self.n_cells += detection.n_cells
+        self.n_infected += detection.n_infected
+        self.n_candidates += len(detection.candidates)
+
+
+def segment_cells(image: np.ndarray, params: DetectionParams = DetectionParams()) -> Tuple[np.ndarray, int]:
+    '''Segment the red blood cells of a field, splitting cells which touch or overlap.
+
+    Cells are separated from the glass by an Otsu threshold of the green channel, in which they are
+    darkest, and their pale centres filled in. Each peak of the distance transform of the cells which
+    lies at least half a typical radius from the glass seeds a watershed, which floods the cells from
+    every seed at once so touching cells are split where the floods meet.
+
+    :param image: an RGB image of a field.
+    :param params: the detector settings.
+    :returns: the int32 label image, in which the glass is 1, the lines between cells are -1 and each
+    cell is a label from 2, and the number of cells counted.
+    '''
+    r = params.cell_radius_px
+    cell_area = np.pi * r ** 2
+    green = cv2.GaussianBlur(image[:, :, 1], (0, 0), 2)
+    _, mask = cv2.threshold(green, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+    # Fill holes smaller than a cell, such as pale centres, but not the glass between cells.
+    _, holes, stats, _ = cv2.connectedComponentsWithStats(255 - mask, connectivity=4)
+    mask[(stats[:, cv2.CC_STAT_AREA] < 0.5 * cell_area)[holes]] = 255
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+
+    dist = cv2.distanceTransform(mask, cv2.DIST_L2, 5)
+    smoothed = cv2.GaussianBlur(dist, (0, 0), 1.0)
+    size = int(0.7 * r) | 1
+    peaks = (smoothed >= cv2.dilate(smoothed, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))) \
+        & (dist > 0.5 * r)
+    # Join the pixels of a flat peak into one seed.
+    peaks = cv2.dilate(peaks.astype(np.uint8), cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+
+    _, markers = cv2.connectedComponents(peaks)
+    markers += 1
+    markers[(mask > 0) & (peaks == 0)] = 0
+    # Every cell pixel looks the same to the watershed, so each seed floods outwards at the same rate.
+    with tracing.span("watershed"):
+        labels = cv2.watershed(cv2.merge([255 - mask] * 3), markers)
+
+    areas = np.bincount(np.maximum(labels, 0).ravel())
+    return labels, int(np.count_nonzero(areas[2:] >= params.min_cell_fraction * cell_area))
+
+
+def find_candidates(
+    image: np.ndarray,
+    labels: np.ndarray,
+    params: DetectionParams = DetectionParams()
+) -> List[Candidate]:
+    '''Find the stained inclusions of a field which may be parasites.
+
+    Stained parasite chromatin is much darker than the cells it lies in, and bluer. Each group of pixels
+    darker than the typical cell by params.min_darkness is scored with the mean of its darkness plus
+    the mean of its blueness, (blue - green) / (blue + green). Groups scoring at least params.min_score
+    are candidates.
+
+    :param image: an RGB image of a field.
+    :param labels: the cells of the field, see segment_cells.
+    :param params: the detector settings.
+    :returns: the candidates.
+    '''
+    cells = labels > 1
+    if not cells.any():
+        return []
+
+    green = image[:, :, 1].astype(np.float32)
+    blue = image[:, :, 2].astype(np.float32)
+    darkness = 1 - green / max(float(np.median(green[cells])), 1.0)
+    blueness = (blue - green) / (blue + green + 1)
+
+    # Inclusions on the lines between cells count too.
+    dark = ((darkness > params.min_darkness) & (labels != 1)).astype(np.uint8)
+    n, groups, stats, centroids = cv2.connectedComponentsWithStats(dark)
+    areas = stats[:, cv2.CC_STAT_AREA]
+    scores = (
+        np.bincount(groups.ravel(), darkness.ravel(), n) + np.bincount(groups.ravel(), blueness.ravel(), n)
+    ) / np.maximum(areas, 1)
+
+    keep = np.flatnonzero((areas >= params.min_inclusion_area_px) & (scores >= params.min_score))
+    keep = keep[keep > 0]
+    h, w = labels.shape
+    cx = np.clip(np.rint(centroids[keep, 0]).astype(int), 0, w - 1)
+    cy = np.clip(np.rint(centroids[keep, 1]).astype(int), 0, h - 1)
+    cell = labels[cy, cx]
+    cell = np.where(cell > 1, cell, -1)
+    return [
+        Candidate(float(x), float(y), int(a), float(s), int(c))
+        for x, y, a, s, c in zip(centroids[keep, 0], centroids[keep, 1], areas[keep], scores[keep], cell)
+    ]
+
+
+def crop_candidates(image: np.ndarray, candidates: List[Candidate], size: int) -> np.ndarray:
+    '''Cut a square of the image around each candidate, shifted inwards at the edges of the image.
+
+    Along a side of the image shorter than size, the crop holds the whole side and is padded with zeros
+    after it.
+
+    :returns: an (N, size, size, 3) array of the crops.
+    '''
+    h, w = image.shape[:2]
+    crops = np.zeros((len(candidates), size, size) + image.shape[2:], dtype=image.dtype)
+    for k, candidate in enumerate(candidates):
+        x = min(max(int(candidate.x) - size // 2, 0), max(w - size, 0))
+        y = min(max(int(candidate.y) - size // 2, 0), max(h - size, 0))
+        crop = image[y:y + size, x:x + size]
+        crops[k, :crop.shape[0], :crop.shape[1]] = crop
+    return crops
+
+
+def detect(
+    name: str,
+    image: np.ndarray,
+    params: DetectionParams = DetectionParams()
+) -> Tuple[FieldDetection, np.ndarray]:
+    '''Count the red blood cells of a field and find the parasite candidates in them.
+
+    :param name: the name the field's image is written with.
+    :param image: an RGB image of the field.
+    :param params: the detector settings.
+    :returns: what was found, without the name of the crops file, and the crop of each candidate.
+    '''
+    with tracing.span("segment"):
+        labels, n_cells = segment_cells(image, params)
+    with tracing.span("candidates"):
+        candidates = find_candidates(image, labels, params)
+    infected = {candidate.cell for candidate in candidates if candidate.cell > 0}
+    return FieldDetection(name, n_cells, len(infected), candidates), \
+        crop_candidates(image, candidates, params.crop_size_px)
+
+
+class Detector:
+    '''Detects cells and parasite candidates in the best focused image of each field on a pool of
+    worker threads, while the scan goes on.
+
+    Each field's counts and candidates are appended to the detections.jsonl file in the output
+    directory as one JSON line, flushed and fsync'd, once the crops of its candidates have been
+    written as <name>_candidates.npy, or into the container, by the scan's image writer. The totals of the scan are appended
+    on close. A resumed scan appends to the file of the scan it continues, and its totals include the
+    fields detected before it was interrupted. At most max_pending fields are queued or being detected.
+    '''
+
+    def __init__(
+        self,
+        output_dir: Path,
+        writer: image_writer.ImageWriter,
+        n_workers: int = 2,
+        max_pending: int = 4,
+        params: DetectionParams = DetectionParams()
+    ):
+        '''
+        :param output_dir: the directory to write the results to.
+        :param writer: the writer the crops are written with.
+        :param n_workers: the number of worker threads.
+        :param max_pending: the maximum number of fields queued or being detected.
+        :param params: the detector settings.
+        '''
+        self.path = Path(output_dir) / file_name
+        self.writer = writer
+        self.params = params
+        self._fields: Dict[str, FieldDetection] = read(self.path)[1] if self.path.exists() else {}
+        self._file = jsonl.open_for_append(self.path)
+        self._executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="detector")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+        self._error: Optional[BaseException] = None
+        self.summary: Optional[SlideSummary] = None
+
+    def __enter__(self) -> "Detector":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(raise_errors=exc_type is None)
+
+    def submit(self, name: str, image: np.ndarray) -> None:
+        '''Queue the best focused image of a field for detection. Blocks while max_pending are queued.
+
+        The image must not be modified until it has been detected and written.
+
+        :param name: the name the field's image is written with.
+        :param image: the RGB image.
+        :raises RuntimeError: when an earlier detection failed.
+        '''
+        self._raise_if_failed()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._detect, name, image)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def close(self, raise_errors: bool = True) -> SlideSummary:
+        '''Finish every queued detection and append the totals of the scan.
+
+        Crops are written by the image writer, so close the detector before the writer.
+
+        :param raise_errors: whether to raise if a detection failed.
+        :returns: the totals of the scan, which are also kept as summary.
+        :raises RuntimeError: when a detection failed and raise_errors is set.
+        '''
+        self._executor.shutdown()
+        # The last fields are recorded once the writer has written their crops.
+        try:
+            self.writer.flush()
+        except RuntimeError:
+            if raise_errors:
+                raise
+        with self._lock:
+            summary = SlideSummary()
+            for detection in self._fields.values():
+                summary.add(detection)
+        self._append({"event": "summary", **asdict(summary), "parasitemia": summary.parasitemia})
+        self._file.close()
+        self.summary = summary
+        if raise_errors:
+            self._raise_if_failed()
+        return summary
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Detector failed.") from self._error
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+        error = future.exception()
+        with self._lock:
+            if error is not None and self._error is None:
+                print(f"Error detecting parasites. {error}")
+                self._error = error
+
+    def _detect(self, name: str, image: np.ndarray) -> None:
+        with tracing.span("detect"):
+            detection, crops = detect(name, image, self.params)
+
+        def written() -> None:
+            with self._lock:
+                self._fields[name] = detection
+            self._append({"event": "field", **asdict(detection)})
+
+        if len(crops):
+            array_format = "container" if self.writer.image_format == "container" else "npy"
+            detection.crops = self.writer.file_name(f"{name}_candidates", array_format)
+            self.writer.write(f"{name}_candidates", crops, array_format, written)
+        else:
+            written()
+
+    def _append(self, event: dict) -> None:
+        event["time"] = time.time()
+        line = json.dumps(event) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+def read(path: Path) -> Tuple[SlideSummary, Dict[str, FieldDetection]]:
+    '''Read back the detections of a scan.
+
+    A torn last line, left by a crash while it was being written, is ignored. A field detected again
+    after a resume replaces its earlier detection.
+
+    :param path: the detections.jsonl file.
+    :returns: the totals over the fields in the file, and the detection of each field by name.
+    '''
+    fields = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.pop("event") == "field":
+                event.pop("time")
+                candidates = [Candidate(**candidate) for candidate in event.pop("candidates")]
+                fields[event["name"]] = FieldDetection(candidates=candidates, **event)
+
+    summary = SlideSummary()
+    for detection in fields.values():
+        summary.add(detection)
+    return summary, fields
@@ -0,0 +1,189 @@
+'''
+    Extended depth of field fusion for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Sequence, Tuple
+import numpy as np
+import cv2
+
+
+def fuse(
+    images: Sequence[np.ndarray],
+    window: int = 9,
+    block_size: int = 1,
+    smoothing: int = 5,
+    pyramid_levels: int = 0,
+    tile_size: int = 512,
+    from_rgb=True
+) -> Tuple[np.ndarray, np.ndarray]:
+    '''Fuse a z-stack into a single image which is in focus everywhere.
+
+    Each pixel is taken from the plane where the local energy of the Laplacian is highest. The chosen
+    planes form a depth map, which is median filtered so that noise in flat regions does not pick
+    scattered planes. With pyramid_levels, planes are blended in a Laplacian pyramid instead of being
+    copied pixel by pixel, which hides the seams between regions taken from different planes.
+
+    The field is processed in tiles with enough overlap that the result does not depend on tile_size,
+    so only one tile of the stack is converted to float32 at a time. Tiles start on the grid of blocks
+    and of the coarsest pyramid level, so every tile sees the blocks and pyramid of the whole field.
+
+    :param images: the z-stack, ordered from the top of the stack down.
+    :param window: the side of the window the Laplacian energy is averaged over, in pixels.
+    :param block_size: choose planes per block of this many pixels square instead of per pixel. Blocks
+    start at the top left corner of the field, and those along the bottom and right edges may be smaller.
+    :param smoothing: the side of the median filter applied to the depth map, or 1 for none.
+    :param pyramid_levels: the number of Laplacian pyramid levels to blend in, or 0 to copy pixels.
+    :param tile_size: the side of the tiles the field is processed in, in pixels, rounded up to a
+    multiple of block_size and of 2 ** pyramid_levels.
+    :param from_rgb: whether the images are RGB, in which case planes are chosen on their greyscale.
+    :returns: the fused image, with the shape and dtype of the input images, and the depth map, a
+    float32 array of the index of the plane each pixel was taken from.
+    '''
+    h, w = images[0].shape[:2]
+    fused = np.empty_like(images[0])
+    depth = np.empty((h, w), dtype=np.float32)
+
+    # Tiles and their halos are whole blocks and whole pixels of the coarsest pyramid level.
+    unit = np.lcm(block_size, 1 << pyramid_levels)
+    tile_size = -(-tile_size // unit) * unit
+    # The Laplacian energy is exact window // 2 + 1 pixels in from the edge of a tile, the depth map
+    # smoothing // 2 blocks further in, and the pyramid blend reaches 8 << pyramid_levels pixels.
+    halo = window // 2 + 1 + block_size * (smoothing // 2) + (8 << pyramid_levels if pyramid_levels else 0)
+    halo = -(-halo // unit) * unit
+    for r0 in range(0, h, tile_size):
+        for c0 in range(0, w, tile_size):
+            r1, c1 = min(r0 + tile_size, h), min(c0 + tile_size, w)
+            rr0, cc0 = max(r0 - halo, 0), max(c0 - halo, 0)
+            rr1, cc1 = min(r1 + halo, h), min(c1 + halo, w)
+
+            stack = np.stack([image[rr0:rr1, cc0:cc1] for image in images])
+            tile, tile_depth = _fuse_tile(stack, window, block_size, smoothing, pyramid_levels, from_rgb)
+            fused[r0:r1, c0:c1] = tile[r0 - rr0:r1 - rr0, c0 - cc0:c1 - cc0]
+            depth[r0:r1, c0:c1] = tile_depth[r0 - rr0:r1 - rr0, c0 - cc0:c1 - cc0]
+
+    return fused, depth
+
+
+def _fuse_tile(
+    stack: np.ndarray, window: int, block_size: int, smoothing: int, pyramid_levels: int, from_rgb: bool
+) -> Tuple[np.ndarray, np.ndarray]:
+    n, h, w = stack.shape[:3]
+    energy = np.empty((n, h, w), dtype=np.float32)
+    for k in range(n):
+        grey = cv2.cvtColor(stack[k], cv2.COLOR_RGB2GRAY) if from_rgb else stack[k]
+        lap = cv2.Laplacian(grey.astype(np.float32), cv2.CV_32F)
+        energy[k] = cv2.boxFilter(lap * lap, -1, (window, window))
+
+    if block_size > 1:
+        # Total energy of each block. Every plane's block has the same area, so totals compare like means.
+        blocks = np.add.reduceat(energy, np.arange(0, h, block_size), axis=1)
+        blocks = np.add.reduceat(blocks, np.arange(0, w, block_size), axis=2)
+        index = blocks.argmax(axis=0).astype(np.uint8)
+        if smoothing > 1:
+            index = cv2.medianBlur(index, smoothing)
+        index = np.repeat(np.repeat(index, block_size, axis=0), block_size, axis=1)[:h, :w]
+    else:
+        index = energy.argmax(axis=0).astype(np.uint8)
+        if smoothing > 1:
+            index = cv2.medianBlur(index, smoothing)
+
+    if pyramid_levels == 0:
+        picked = index[np.newaxis, ..., np.newaxis] if stack.ndim == 4 else index[np.newaxis]
+        fused = np.take_along_axis(stack, picked, axis=0)[0]
+    else:
+        fused = _pyramid_blend(stack, index, pyramid_levels)
+        if np.issubdtype(stack.dtype, np.integer):
+            info = np.iinfo(stack.dtype)
+            fused = np.clip(np.rint(fused), info.min, info.max)
+        fused = fused.astype(stack.dtype)
+
+    return fused, index.astype(np.float32)
+
+
+def _pyramid_blend(stack: np.ndarray, index: np.ndarray, levels: int) -> np.ndarray:
+    '''Blend the planes of a stack by the Gaussian pyramid of each plane's mask in its Laplacian pyramid.'''
+    blended: List[np.ndarray] = []
+    for k in range(len(stack)):
+        image = stack[k].astype(np.float32)
+        mask = (index == k).astype(np.float32)
+
+        for level in range(levels + 1):
+            if level < levels:
+                down = cv2.pyrDown(image)
+                band = image - cv2.pyrUp(down, dstsize=(image.shape[1], image.shape[0]))
+            else:
+                band = image
+            weighted = band * (mask[..., np.newaxis] if band.ndim == 3 else mask)
+
+            if k == 0:
+                blended.append(weighted)
+            else:
+                blended[level] += weighted
+
+            if level < levels:
+                image, mask = down, cv2.pyrDown(mask)
+
+    out = blended[-1]
+    for band in reversed(blended[:-1]):
+        out = cv2.pyrUp(out, dstsize=(band.shape[1], band.shape[0])) + band
+    return out
+
+
+class EdfPool:
+    '''Fuses z-stacks on a pool of worker threads so fusion keeps up with acquisition.
+
+    OpenCV and NumPy release the GIL in the heavy parts of fuse, so threads run in parallel. At most
+    max_pending stacks are queued or being fused at once, and submit blocks once that many are, so
+    the z-stacks waiting for fusion cannot use up memory when the workers fall behind.
+    '''
+
+    def __init__(self, n_workers: int = 2, max_pending: int = 4, **fuse_kwargs):
+        '''
+        :param n_workers: the number of worker threads.
+        :param max_pending: the maximum number of stacks queued or being fused.
+        :param fuse_kwargs: keyword arguments for fuse.
+        '''
+        self.fuse_kwargs = fuse_kwargs
+        self._executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="edf")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def __enter__(self) -> "EdfPool":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def submit(self, images: Sequence[np.ndarray]) -> Future:
+        '''Queue a z-stack for fusion. Blocks while max_pending stacks are already queued.
+
+        :param images: the z-stack, ordered from the top of the stack down.
+        :returns: a future which resolves to the fused image and depth map, see fuse.
+        '''
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fuse, images, **self.fuse_kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def close(self) -> None:
+        '''Wait for every queued stack to be fused and stop the workers.'''
+        self._executor.shutdown()
@@ -0,0 +1,179 @@
+'''
+    Persistent focus index for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+# Default location of the index, shared by every scan run from the same directory.
+default_path = "focus_index.sqlite"
+
+# How far in mm a field may be from where it was imaged before for its prior to still apply.
+position_tolerance_mm = 1e-3
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS fields (
+    slide_id TEXT NOT NULL,
+    i INTEGER NOT NULL,
+    j INTEGER NOT NULL,
+    x_mm REAL NOT NULL,
+    y_mm REAL NOT NULL,
+    focus REAL NOT NULL,
+    metrics BLOB NOT NULL,
+    checksum TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (slide_id, i, j)
+)
+'''
+
+
+@dataclass
+class FocusPrior:
+    '''What the last scan of a slide found at one field.
+
+    :param slide_id: the slide.
+    :param i: the index of the field in the x direction.
+    :param j: the index of the field in the y direction.
+    :param x_mm: the x position of the field in mm relative to the start of the scan.
+    :param y_mm: the y position of the field in mm relative to the start of the scan.
+    :param focus: the best focused fine focus position in degrees relative to the start of the scan.
+    :param metrics: the focus metric of every image taken of the field.
+    :param checksum: the checksum of the best focused image, see checksum.
+    :param updated: when the field was imaged, in seconds since the epoch.
+    '''
+    slide_id: str
+    i: int
+    j: int
+    x_mm: float
+    y_mm: float
+    focus: float
+    metrics: List[float] = field(default_factory=list)
+    checksum: str = ""
+    updated: float = 0.0
+
+
+def checksum(image: np.ndarray) -> str:
+    '''A checksum of an image's pixels, to tell whether a tile has changed between scans.'''
+    return hashlib.blake2b(np.ascontiguousarray(image).tobytes(), digest_size=16).hexdigest()
+
+
+class FocusIndex:
+    '''An on-disk index of the best focus of every field of every slide scanned, kept in SQLite.
+
+    Scans of the same slide look up each field's best focus from the last scan, and only need a short
+    stack to confirm it. The index can be shared by scans in several threads or processes.
+    '''
+
+    def __init__(self, path: Path = default_path):
+        '''
+        :param path: the index file, created if it does not exist.
+        '''
+        self.path = Path(path)
+        self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            # Readers are not blocked while another scan records fields.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(_schema)
+
+    def __enter__(self) -> "FocusIndex":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def get(self, slide_id: str, i: int, j: int) -> Optional[FocusPrior]:
+        '''Return what the last scan of a slide found at a field, or None if it was never imaged.'''
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM fields WHERE slide_id = ? AND i = ? AND j = ?", (slide_id, i, j)
+            ).fetchone()
+        return None if row is None else _prior(row)
+
+    def priors(
+        self,
+        slide_id: str,
+        fields: Iterable[Tuple[int, int, float, float]],
+        max_age_s: float
+    ) -> Dict[Tuple[int, int], FocusPrior]:
+        '''Find the fresh priors of the fields of a scan.
+
+        A prior is fresh when it was recorded at most max_age_s ago, at the same position the field is
+        now at.
+
+        :param slide_id: the slide.
+        :param fields: the (i, j, x_mm, y_mm) of each field to be imaged.
+        :param max_age_s: the age in seconds past which a prior is stale.
+        :returns: the fresh priors by (i, j).
+        '''
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM fields WHERE slide_id = ? AND updated >= ?", (slide_id, time.time() - max_age_s)
+            ).fetchall()
+        found = {(prior.i, prior.j): prior for prior in map(_prior, rows)}
+
+        fresh = {}
+        for i, j, x_mm, y_mm in fields:
+            prior = found.get((i, j))
+            if prior is not None and math.isclose(prior.x_mm, x_mm, abs_tol=position_tolerance_mm) \
+                    and math.isclose(prior.y_mm, y_mm, abs_tol=position_tolerance_mm):
+                fresh[(i, j)] = prior
+        return fresh
+
+    def put(self, prior: FocusPrior) -> None:
+        '''Record what a scan found at a field, replacing what an earlier scan found there.'''
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO fields VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    prior.slide_id, prior.i, prior.j, prior.x_mm, prior.y_mm, prior.focus,
+                    np.asarray(prior.metrics, dtype=np.float32).tobytes(), prior.checksum,
+                    prior.updated or time.time()
+                )
+            )
+
+    def after_write(self, prior: FocusPrior, image: np.ndarray) -> Callable[[], None]:
+        '''Return a callback which records a field, with the checksum of its image, once the image is written.
+
+        :param prior: what the scan found at the field.
+        :param image: the best focused image of the field.
+        :returns: a callback to pass as on_written to image_writer.ImageWriter.write, so the checksum is
+        taken on the writer's thread rather than the scan's.
+        '''
+        def written() -> None:
+            prior.checksum = checksum(image)
+            self.put(prior)
+
+        return written
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def _prior(row: tuple) -> FocusPrior:
+    slide_id, i, j, x_mm, y_mm, focus, metrics, digest, updated = row
+    return FocusPrior(
+        slide_id, i, j, x_mm, y_mm, focus, np.frombuffer(metrics, dtype=np.float32).tolist(), digest, updated
+    )
@@ -0,0 +1,145 @@
+'''
+    Focus surface prediction for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import math
+from typing import List, Tuple
+import numpy as np
+
+
+class FocusMap:
+    '''Predicts the best focus of a field from the best focus found at fields already imaged.
+
+    Slide tilt makes the best focus drift smoothly across the slide, so a plane (order 1) or quadratic
+    surface (order 2) is fitted to the best focus of every field imaged so far. The fit uses iteratively
+    reweighted least squares with Huber weights, so a few fields focused on debris or empty glass do not
+    drag the surface. The order is lowered automatically until there are enough fields to fit it.
+    '''
+
+    def __init__(self, order: int = 1, min_sigma: float = 1.8, huber_k: float = 1.345, n_iterations: int = 10):
+        '''
+        :param order: the order of the fitted surface, 1 for a plane or 2 for a quadratic.
+        :param min_sigma: the smallest residual scale in degrees, usually the focus measurement resolution.
+        :param huber_k: the Huber threshold in units of the residual scale.
+        :param n_iterations: the number of reweighting iterations per fit.
+        '''
+        if order not in (1, 2):
+            raise ValueError(f"Unsupported focus map order {order}.")
+
+        self.order = order
+        self.min_sigma = min_sigma
+        self.huber_k = huber_k
+        self.n_iterations = n_iterations
+
+        self._x: List[float] = []
+        self._y: List[float] = []
+        self._z: List[float] = []
+        self._order = -1
+        self._coef = np.zeros(1)
+        self._cov = np.zeros((1, 1))
+        self._sigma = math.inf
+
+    def __len__(self) -> int:
+        return len(self._z)
+
+    def add(self, x_mm: float, y_mm: float, z_deg: float) -> None:
+        '''Record the best focus of an imaged field and refit the surface.
+
+        :param x_mm: the x position of the field in mm.
+        :param y_mm: the y position of the field in mm.
+        :param z_deg: the best fine focus position at the field in degrees.
+        '''
+        self._x.append(x_mm)
+        self._y.append(y_mm)
+        self._z.append(z_deg)
+        self._fit()
+
+    def predict(self, x_mm: float, y_mm: float) -> Tuple[float, float]:
+        '''Predict the best focus at a position.
+
+        :param x_mm: the x position in mm.
+        :param y_mm: the y position in mm.
+        :returns: the predicted best fine focus position in degrees and its standard uncertainty in
+        degrees, which is infinite until at least two fields have been added.
+        '''
+        if not self._z:
+            return 0.0, math.inf
+
+        a = self._design(np.array([x_mm]), np.array([y_mm]), self._order)[0]
+        z = float(a @ self._coef)
+        if math.isinf(self._sigma):
+            return z, math.inf
+        return z, math.sqrt(self._sigma ** 2 + float(a @ self._cov @ a))
+
+    def stack_size(self, x_mm: float, y_mm: float, z_step_size: float, n_max: int, n_min: int = 3,
+                   confidence: float = 2.5) -> int:
+        '''Choose how many images a z-stack centred on the predicted focus needs to contain the best focus.
+
+        :param x_mm: the x position of the field in mm.
+        :param y_mm: the y position of the field in mm.
+        :param z_step_size: the number of degrees the fine focus knob turns per z-step.
+        :param n_max: the largest z-stack to take.
+        :param n_min: the smallest z-stack to take.
+        :param confidence: how many standard uncertainties either side of the prediction the stack covers.
+        :returns: the number of images in the z-stack, between n_min and n_max.
+        '''
+        _, sigma = self.predict(x_mm, y_mm)
+        if math.isinf(sigma):
+            return n_max
+        n = 2 * math.ceil(confidence * sigma / z_step_size) + 1
+        return max(n_min, min(n_max, n))
+
+    @staticmethod
+    def _design(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+        columns = [np.ones_like(x)]
+        if order >= 1:
+            columns += [x, y]
+        if order >= 2:
+            columns += [x * x, x * y, y * y]
+        return np.stack(columns, axis=-1)
+
+    def _fit(self) -> None:
+        x, y, z = np.array(self._x), np.array(self._y), np.array(self._z)
+        n = len(z)
+
+        # Use the highest order with at least one more field than it has coefficients.
+        order = self.order
+        while order > 0 and n < {1: 4, 2: 7}[order]:
+            order -= 1
+
+        X = self._design(x, y, order)
+        w = np.ones(n)
+        scale = math.inf
+        for _ in range(self.n_iterations):
+            sw = np.sqrt(w)
+            coef = np.linalg.lstsq(X * sw[:, np.newaxis], z * sw, rcond=None)[0]
+            r = z - X @ coef
+            if n <= X.shape[1]:
+                break
+
+            # Robust scale from the median absolute deviation of the residuals.
+            scale = max(self.min_sigma, 1.4826 * float(np.median(np.abs(r - np.median(r)))))
+            u = np.abs(r) / (self.huber_k * scale)
+            w = np.where(u <= 1, 1.0, 1.0 / np.maximum(u, 1e-12))
+
+        self._order = order
+        self._coef = coef
+        self._sigma = scale
+        if math.isinf(scale):
+            self._cov = np.zeros((X.shape[1], X.shape[1]))
+        else:
+            self._cov = scale ** 2 * np.linalg.pinv((X * w[:, np.newaxis]).T @ X)
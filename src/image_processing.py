@@ -16,56 +16,363 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from typing import Sequence, Tuple
+from typing import Optional, Sequence, Tuple
 import numpy as np
 import cv2
+import tracing
 
 Image = np.ndarray
 
+# Region of interest as an OpenCV style (x, y, width, height) rectangle.
+Roi = Tuple[int, int, int, int]
 
-def normed_var(images: np.ndarray) -> np.ndarray:
+
+def _prepare(images: np.ndarray, roi: Optional[Roi] = None, downsample: int = 1) -> np.ndarray:
+    '''Crop and downsample an (N, H, W) stack of greyscale images and convert it to float32.
+
+    :param images: An (N, H, W) ndarray of greyscale images.
+    :param roi: An optional (x, y, width, height) region of each image to keep.
+    :param downsample: Keep every downsample-th pixel in each direction.
+    :returns: An (N, H', W') float32 ndarray.
+    '''
+    if roi is not None:
+        x, y, w, h = roi
+        images = images[:, y:y + h, x:x + w]
+    if downsample > 1:
+        images = images[:, ::downsample, ::downsample]
+    return images.astype(np.float32, copy=False)
+
+
+def normed_var(images: np.ndarray, roi: Optional[Roi] = None, downsample: int = 1) -> np.ndarray:
     '''Normed variance calculation.
 
     :param images: An (N, H, W) ndarray of greyscale images.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
     :returns: A (N,) ndarray of the calculated metric.
     '''
+    images = _prepare(images, roi, downsample)
     mu = images.mean(axis=(1, 2))
     v = images.var(axis=(1, 2)) / mu
     return v
 
 
+def laplacian_var(images: np.ndarray, roi: Optional[Roi] = None, downsample: int = 1) -> np.ndarray:
+    '''Variance of the 4-neighbour Laplacian.
+
+    :param images: An (N, H, W) ndarray of greyscale images.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :returns: A (N,) ndarray of the calculated metric.
+    '''
+    images = _prepare(images, roi, downsample)
+    lap = 4 * images[:, 1:-1, 1:-1]
+    lap -= images[:, :-2, 1:-1]
+    lap -= images[:, 2:, 1:-1]
+    lap -= images[:, 1:-1, :-2]
+    lap -= images[:, 1:-1, 2:]
+    return lap.var(axis=(1, 2))
+
+
+def tenengrad(images: np.ndarray, roi: Optional[Roi] = None, downsample: int = 1) -> np.ndarray:
+    '''Tenengrad, the mean squared magnitude of the Sobel gradient.
+
+    :param images: An (N, H, W) ndarray of greyscale images.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :returns: A (N,) ndarray of the calculated metric.
+    '''
+    images = _prepare(images, roi, downsample)
+
+    # The Sobel kernels are separable into a [1, 2, 1] smoothing and a [-1, 0, 1] difference.
+    smooth_y = images[:, :-2, :] + 2 * images[:, 1:-1, :] + images[:, 2:, :]
+    gx = smooth_y[:, :, 2:] - smooth_y[:, :, :-2]
+    del smooth_y
+    smooth_x = images[:, :, :-2] + 2 * images[:, :, 1:-1] + images[:, :, 2:]
+    gy = smooth_x[:, 2:, :] - smooth_x[:, :-2, :]
+    del smooth_x
+
+    gx *= gx
+    gy *= gy
+    gx += gy
+    return gx.mean(axis=(1, 2))
+
+
+def brenner(images: np.ndarray, roi: Optional[Roi] = None, downsample: int = 1) -> np.ndarray:
+    '''Brenner gradient, the mean squared difference between pixels two columns apart.
+
+    :param images: An (N, H, W) ndarray of greyscale images.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :returns: A (N,) ndarray of the calculated metric.
+    '''
+    images = _prepare(images, roi, downsample)
+    d = images[:, :, 2:] - images[:, :, :-2]
+    d *= d
+    return d.mean(axis=(1, 2))
+
+
+def fft_energy(
+    images: np.ndarray,
+    roi: Optional[Roi] = None,
+    downsample: int = 1,
+    cutoff: float = 0.25
+) -> np.ndarray:
+    '''Fraction of the spectral energy above a cutoff spatial frequency.
+
+    :param images: An (N, H, W) ndarray of greyscale images.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :param cutoff: The cutoff frequency as a fraction of the Nyquist frequency.
+    :returns: A (N,) ndarray of the calculated metric.
+    '''
+    images = _prepare(images, roi, downsample)
+    images = images - images.mean(axis=(1, 2), keepdims=True)
+
+    power = np.abs(np.fft.rfft2(images)) ** 2
+    fy = np.fft.fftfreq(images.shape[1])[:, np.newaxis]
+    fx = np.fft.rfftfreq(images.shape[2])[np.newaxis, :]
+    high = np.hypot(fx, fy) > cutoff * 0.5
+
+    total = power.sum(axis=(1, 2))
+    return power[:, high].sum(axis=1) / np.maximum(total, np.finfo(np.float32).tiny)
+
+
+def vollath_f4(images: np.ndarray, roi: Optional[Roi] = None, downsample: int = 1) -> np.ndarray:
+    '''Vollath's F4 autocorrelation metric, normalized by the number of pixels.
+
+    :param images: An (N, H, W) ndarray of greyscale images.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :returns: A (N,) ndarray of the calculated metric.
+    '''
+    images = _prepare(images, roi, downsample)
+    f1 = (images[:, :, :-2] * images[:, :, 1:-1]).mean(axis=(1, 2))
+    f2 = (images[:, :, :-2] * images[:, :, 2:]).mean(axis=(1, 2))
+    return f1 - f2
+
+
 algorithms = {
     "normed_var": normed_var,
+    "laplacian_var": laplacian_var,
+    "tenengrad": tenengrad,
+    "brenner": brenner,
+    "fft_energy": fft_energy,
+    "vollath_f4": vollath_f4,
 }
 
 
+def chunked_metric(
+    images: np.ndarray,
+    algorithm: str = "normed_var",
+    roi: Optional[Roi] = None,
+    downsample: int = 1,
+    chunk_size: Optional[int] = None
+) -> np.ndarray:
+    '''Calculate a focus metric over a stack, optionally chunk_size whole images at a time.
+
+    Every metric is calculated independently per image, so a stack too large to convert to float32
+    at once, such as an np.memmap of a z-stack on disk, can be processed in chunks of images with the
+    same result. Chunks only split the stack, never an image: metrics such as normed_var and
+    fft_energy need every pixel of an image at once, so at least one whole image is converted at a time.
+
+    :param images: An (N, H, W) ndarray of greyscale images.
+    :param algorithm: The name of the focus metric in algorithms.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :param chunk_size: The number of images to process at once, or None for the whole stack.
+    :returns: A (N,) ndarray of the calculated metric.
+    '''
+    metric = algorithms[algorithm]
+    if chunk_size is None or chunk_size >= len(images):
+        return metric(images, roi, downsample)
+
+    out = np.empty(len(images), dtype=np.float32)
+    for start in range(0, len(images), chunk_size):
+        out[start:start + chunk_size] = metric(images[start:start + chunk_size], roi, downsample)
+    return out
+
+
+def score_image(
+    image: np.ndarray,
+    algorithm: str = "normed_var",
+    from_rgb=True,
+    roi: Optional[Roi] = None,
+    downsample: int = 1
+) -> float:
+    '''Calculate the focus metric of a single image.
+
+    :param image: An image of a microscope field.
+    :param algorithm: The name of the focus metric in algorithms.
+    :param from_rgb: Whether the image is RGB and must be converted to greyscale first.
+    :param roi: An optional (x, y, width, height) region of the image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :returns: The focus metric, where a higher value represents a better focused image.
+    '''
+    if from_rgb:
+        with tracing.span("grayscale"):
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+    with tracing.span("metric", algorithm=algorithm):
+        return float(algorithms[algorithm](image[np.newaxis], roi, downsample)[0])
+
+
+def thumbnail(image: np.ndarray, downsample: int = 8, from_rgb=True) -> np.ndarray:
+    '''Shrink an image by area averaging for cheap whole-field measurements.
+
+    :param image: An image of a microscope field.
+    :param downsample: The factor to shrink each side by.
+    :param from_rgb: Whether the image is RGB and must be converted to greyscale first.
+    :returns: A greyscale uint8 image downsample times smaller in each direction.
+    '''
+    h, w = image.shape[:2]
+    small = cv2.resize(image, (max(1, w // downsample), max(1, h // downsample)), interpolation=cv2.INTER_AREA)
+    if from_rgb:
+        small = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+    return small
+
+
+def occupancy(images: np.ndarray, background: float, contrast: float = 0.1) -> np.ndarray:
+    '''Fraction of each image covered by sample, counted as pixels darker than the glass background.
+
+    Blank glass scores close to 0 and thick, overlapping regions close to 1.
+
+    :param images: An (N, H, W) ndarray of greyscale images, usually thumbnails.
+    :param background: The grey level of empty glass.
+    :param contrast: How much darker than the background a pixel must be to count, as a fraction.
+    :returns: A (N,) ndarray of occupancies between 0 and 1.
+    '''
+    return (images < background * (1 - contrast)).mean(axis=(1, 2))
+
+
 def analyze_z_stack(
     images: Sequence[np.ndarray],
     algorithm: str = "normed_var",
-    from_rgb=True
+    from_rgb=True,
+    roi: Optional[Roi] = None,
+    downsample: int = 1,
+    chunk_size: Optional[int] = None
 ) -> Tuple[int, np.ndarray, np.ndarray]:
     '''Analyze a stack of images at varying level of focus to determine most in focus image.
 
     :param images: A sequence of images of the same microscope field taken at varying levels of focus.
+    :param algorithm: The name of the focus metric in algorithms.
+    :param from_rgb: Whether the images are RGB and must be converted to greyscale first.
+    :param roi: An optional (x, y, width, height) region of each image to use.
+    :param downsample: Use every downsample-th pixel in each direction.
+    :param chunk_size: The number of images to calculate the metric of at once, see chunked_metric, or
+    None for the whole stack.
     :returns: The first int is the index of the most in focus array.
     The first ndarray is the list of ranks, with the lowest ranked index representing the most in focus image.
     The second ndarray represents the raw metric calculated per image
     '''
 
     N = len(images)
-    H, W = images[0].shape
+    H, W = images[0].shape[:2]
 
     if from_rgb:
-        images = np.array(
-            cv2.cvtcolor(image, cv2.COLOR_RGB2GRAY) for image in images
-        ).reshape(N, H, W)
+        # Convert straight into one preallocated stack rather than building and copying a new array.
+        with tracing.span("grayscale"):
+            stack = np.empty((N, H, W), dtype=images[0].dtype)
+            for k, image in enumerate(images):
+                cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=stack[k])
+        images = stack
     else:
-        images = np.array(images).reshape(N, H, W)
+        images = np.asarray(images)
+
+    with tracing.span("metric", algorithm=algorithm):
+        metric = chunked_metric(images, algorithm, roi, downsample, chunk_size)
+    ranks = _rank(metric)
+
+    return np.argmin(ranks), ranks, metric
 
-    metric = algorithms[algorithm](images)
 
+def _rank(metric: np.ndarray) -> np.ndarray:
+    '''Rank a focus metric so that the lowest rank is the most in focus image.'''
     order = metric.argsort()
     ranks = order.argsort()
-    ranks = ranks.max() - ranks
+    return ranks.max() - ranks
 
-    return np.argmin(ranks), ranks, metric
+
+class ZStackAnalyzer:
+    '''Analyze a z-stack one image at a time as it is captured.
+
+    Each image is converted to greyscale into a reused buffer and scored as it arrives, and only the
+    most in focus image seen so far is kept, so memory use does not grow with the size of the stack.
+    The results match analyze_z_stack called on the same images.
+    '''
+
+    def __init__(
+        self,
+        n_images: int = 16,
+        algorithm: str = "normed_var",
+        from_rgb=True,
+        roi: Optional[Roi] = None,
+        downsample: int = 1
+    ):
+        '''
+        :param n_images: The expected number of images in the stack. More images may be pushed.
+        :param algorithm: The name of the focus metric in algorithms.
+        :param from_rgb: Whether the images are RGB and must be converted to greyscale first.
+        :param roi: An optional (x, y, width, height) region of each image to use.
+        :param downsample: Use every downsample-th pixel in each direction.
+        '''
+        self.metric = algorithms[algorithm]
+        self.from_rgb = from_rgb
+        self.roi = roi
+        self.downsample = downsample
+
+        self._metrics = np.empty(n_images, dtype=np.float32)
+        self._count = 0
+        self._grey: Optional[np.ndarray] = None
+        self._best: Optional[np.ndarray] = None
+        self._best_index = -1
+
+    def __len__(self) -> int:
+        return self._count
+
+    def push(self, image: np.ndarray) -> float:
+        '''Score the next image in the stack.
+
+        :param image: The next image of the z-stack.
+        :returns: The focus metric of the image.
+        '''
+        grey = image
+        if self.from_rgb:
+            if self._grey is None or self._grey.shape != image.shape[:2]:
+                self._grey = np.empty(image.shape[:2], dtype=image.dtype)
+            with tracing.span("grayscale"):
+                cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=self._grey)
+            grey = self._grey
+
+        with tracing.span("metric"):
+            metric = self.metric(grey[np.newaxis], self.roi, self.downsample)[0]
+
+        if self._count == len(self._metrics):
+            self._metrics = np.resize(self._metrics, 2 * len(self._metrics))
+        self._metrics[self._count] = metric
+
+        if self._best_index < 0 or metric > self._metrics[self._best_index]:
+            if self._best is None or self._best.shape != image.shape:
+                self._best = np.empty_like(image)
+            np.copyto(self._best, image)
+            self._best_index = self._count
+
+        self._count += 1
+        return float(metric)
+
+    @property
+    def best_image(self) -> Optional[np.ndarray]:
+        '''The most in focus image pushed so far.'''
+        return self._best
+
+    @property
+    def best_index(self) -> int:
+        '''The index of the most in focus image pushed so far, or -1 if no image has been pushed.'''
+        return self._best_index
+
+    def result(self) -> Tuple[int, np.ndarray, np.ndarray]:
+        '''Return the analysis of the images pushed so far in the same form as analyze_z_stack.'''
+        metric = self._metrics[:self._count].copy()
+        ranks = _rank(metric)
+        return np.argmin(ranks), ranks, metric
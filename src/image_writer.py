@@ -0,0 +1,270 @@
+'''
+    Background image writer for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import io
+import os
+import threading
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Optional, Set
+import numpy as np
+import cv2
+import tracing
+
+# Formats images can be written in. "container" appends every image of a scan to one .npz file.
+formats = ("png", "tiff", "npy", "container")
+
+# File extension of each format written to its own file.
+extensions = {"png": ".png", "tiff": ".tiff", "npy": ".npy"}
+
+
+def read_image(path: Path) -> np.ndarray:
+    '''Read back an image written by an ImageWriter in the png, tiff or npy format.
+
+    :param path: the image file.
+    :returns: the image as it was written.
+    :raises OSError: when the file cannot be read.
+    '''
+    path = Path(path)
+    if path.suffix == ".npy":
+        return np.load(path)
+    image = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise OSError(f"OpenCV could not read {path}.")
+    return image
+
+
+class ImageWriter:
+    '''Writes images on a pool of worker threads so the control thread does not wait for the disk.
+
+    Every file is written under a temporary name and renamed into place once complete, so a crash or
+    a reader polling the output directory never sees a partial file. At most max_pending images are
+    queued or being written, and write blocks once that many are, which holds the scan back when the
+    disk cannot keep up instead of letting queued images use up memory.
+
+    The "container" format stores every image as an uncompressed .npy member of <container_name>.npz,
+    one chunk per image, which np.load reads back lazily by name. It is renamed into place on close.
+    '''
+
+    def __init__(
+        self,
+        output_dir: Path,
+        image_format: str = "png",
+        png_compression: int = 1,
+        n_workers: int = 2,
+        max_pending: int = 8,
+        container_name: str = "scan",
+        executor: Optional[ThreadPoolExecutor] = None
+    ):
+        '''
+        :param output_dir: the directory to write images to.
+        :param image_format: the default format, one of formats.
+        :param png_compression: the PNG compression level from 0, uncompressed, to 9, smallest.
+        :param n_workers: the number of worker threads.
+        :param max_pending: the maximum number of images queued or being written.
+        :param container_name: the file name, without extension, of the container.
+        :param executor: a thread pool shared with other writers to write on instead of n_workers threads
+        of this writer's own. It is left running on close.
+        '''
+        if image_format not in formats:
+            raise ValueError(f"Unknown image format {image_format}.")
+
+        self.output_dir = Path(output_dir)
+        self.image_format = image_format
+        self.png_compression = png_compression
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="image-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+        self._error: Optional[BaseException] = None
+
+        self._container_path = self.output_dir / f"{container_name}.npz"
+        self._container_tmp = self.output_dir / f".{container_name}.npz.tmp"
+        self._container: Optional[zipfile.ZipFile] = None
+        self._container_lock = threading.Lock()
+
+    def __enter__(self) -> "ImageWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(raise_errors=exc_type is None)
+
+    def write(
+        self,
+        name: str,
+        image: np.ndarray,
+        image_format: Optional[str] = None,
+        on_written: Optional[Callable[[], None]] = None
+    ) -> None:
+        '''Queue an image to be written. Blocks while max_pending images are already queued.
+
+        The image must not be modified until it has been written, so pass a copy of reused buffers.
+
+        :param name: the file name without extension, or the member name in the container.
+        :param image: the image.
+        :param image_format: the format to write this image in, or None for the default.
+        :param on_written: called on the worker thread once the image is in place. It is not called if
+        the write fails, and an exception it raises fails the write.
+        :raises RuntimeError: when an earlier write failed.
+        '''
+        image_format = image_format or self.image_format
+        if image_format not in formats:
+            raise ValueError(f"Unknown image format {image_format}.")
+
+        self._raise_if_failed()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, name, image, image_format, on_written)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def file_name(self, name: str, image_format: Optional[str] = None) -> str:
+        '''Return the name in the output directory of the file an image is written to.
+
+        :param name: the name the image is written with.
+        :param image_format: the format the image is written in, or None for the default.
+        :returns: the file name, which for the container is the name of the container.
+        '''
+        image_format = image_format or self.image_format
+        if image_format == "container":
+            return self._container_path.name
+        return name + extensions[image_format]
+
+    def flush(self) -> None:
+        '''Wait until every queued image has been written.
+
+        :raises RuntimeError: when a write failed.
+        '''
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        # Done callbacks can still be running once wait returns, so check the futures themselves.
+        for future in pending:
+            self._record_error(future)
+        self._raise_if_failed()
+
+    def close(self, raise_errors: bool = True) -> None:
+        '''Write every queued image, stop the workers and move the container into place.
+
+        :param raise_errors: whether to raise if a write failed.
+        :raises RuntimeError: when a write failed and raise_errors is set.
+        '''
+        if self._owns_executor:
+            self._executor.shutdown()
+        else:
+            with self._lock:
+                pending = list(self._pending)
+            wait(pending)
+            for future in pending:
+                self._record_error(future)
+        with self._container_lock:
+            if self._container is not None:
+                self._container.close()
+                self._container = None
+                _fsync_file(self._container_tmp)
+                os.replace(self._container_tmp, self._container_path)
+                _fsync_dir(self.output_dir)
+        if raise_errors:
+            self._raise_if_failed()
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Image writer failed.") from self._error
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+        self._record_error(future)
+
+    def _record_error(self, future: Future) -> None:
+        error = future.exception()
+        with self._lock:
+            if error is not None and self._error is None:
+                print(f"Error writing image. {error}")
+                self._error = error
+
+    def _write(
+        self, name: str, image: np.ndarray, image_format: str, on_written: Optional[Callable[[], None]]
+    ) -> None:
+        with tracing.span("write", format=image_format):
+            self._write_file(name, image, image_format)
+        if on_written is not None:
+            on_written()
+
+    def _write_file(self, name: str, image: np.ndarray, image_format: str) -> None:
+        if image_format == "container":
+            self._append(name, image)
+            return
+
+        extension = extensions[image_format]
+        path = self.output_dir / (name + extension)
+        # Keep the extension on the temporary name, since cv2.imwrite picks the encoder from it.
+        tmp = path.with_name(f".{name}.tmp{extension}")
+        try:
+            if image_format == "npy":
+                with open(tmp, "wb") as f:
+                    np.save(f, image)
+                    f.flush()
+                    os.fsync(f.fileno())
+            else:
+                params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression] if image_format == "png" else \
+                    [cv2.IMWRITE_TIFF_COMPRESSION, 1]
+                if not cv2.imwrite(str(tmp), image, params):
+                    raise OSError(f"OpenCV could not write {path}.")
+                _fsync_file(tmp)
+            os.replace(tmp, path)
+            _fsync_dir(self.output_dir)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    def _append(self, name: str, image: np.ndarray) -> None:
+        # Encode the .npy on the worker thread so only the append to the shared zip file holds the lock.
+        buffer = io.BytesIO()
+        np.lib.format.write_array(buffer, np.asanyarray(image), allow_pickle=False)
+        with self._container_lock:
+            if self._container is None:
+                self._container = zipfile.ZipFile(self._container_tmp, "w", zipfile.ZIP_STORED, allowZip64=True)
+            self._container.writestr(name + ".npy", buffer.getvalue())
+
+
+def _fsync_file(path: Path) -> None:
+    '''Make a file's contents durable before it is renamed into place.'''
+    # Opened for writing, since Windows only flushes handles with write access.
+    with open(path, "r+b") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(directory: Path) -> None:
+    '''Make the renames in a directory durable, so a power loss cannot undo them.'''
+    # Windows cannot open directories, and NTFS journals renames itself.
+    if os.name == "nt":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,191 @@
+'''
+    Scan checkpoint journal for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import jsonl
+
+# Name of the journal file in a scan's output directory.
+file_name = "journal.jsonl"
+
+Position = Tuple[float, float, float]
+
+
+@dataclass
+class FieldRecord:
+    '''A field which has been imaged and written.
+
+    :param i: the index of the field in the x direction.
+    :param j: the index of the field in the y direction.
+    :param x_mm: the x position of the field in mm relative to the start.
+    :param y_mm: the y position of the field in mm relative to the start.
+    :param focus: the best focused fine focus position in degrees relative to the start.
+    :param metrics: the focus metric of every image taken of the field.
+    :param file: the name of the best focused image in the output directory.
+    '''
+    i: int
+    j: int
+    x_mm: float
+    y_mm: float
+    focus: float
+    metrics: List[float] = field(default_factory=list)
+    file: str = ""
+
+
+@dataclass
+class JournalState:
+    '''What a journal says about a scan.
+
+    :param params: the planner.ScanConfig the scan was started with, as its keyword arguments.
+    :param fields: the (i, j, x_mm, y_mm) of every field the scan planned to image, or None if it
+    stopped before planning.
+    :param done: the fields which were imaged and written, by (i, j), in the order they finished.
+    :param position: the last known (x mm, y mm, fine focus degrees) the stage was commanded to, or None
+    if unknown.
+    '''
+    params: dict
+    fields: Optional[List[Tuple[int, int, float, float]]] = None
+    done: Dict[Tuple[int, int], FieldRecord] = field(default_factory=dict)
+    position: Optional[Position] = None
+
+    @property
+    def last(self) -> Optional[FieldRecord]:
+        "The field which finished last, or None."
+        return next(reversed(self.done.values()), None)
+
+
+class ScanJournal:
+    '''An append-only record of a scan's progress, from which an interrupted scan can be resumed.
+
+    Every event is one JSON line, flushed and fsync'd before the call returns, so a crash loses at
+    most the event being written. Fields are only recorded once their image is on disk. Resumed
+    scans append to the journal of the scan they continue.
+    '''
+
+    def __init__(self, path: Path):
+        '''
+        :param path: the journal file, appended to if it exists.
+        '''
+        self.path = Path(path)
+        self._file = jsonl.open_for_append(self.path)
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "ScanJournal":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def start(self, params: dict, resumed: bool = False) -> None:
+        '''Record the start of a scan.
+
+        :param params: the planner.ScanConfig which reproduces the scan, see ScanConfig.params.
+        :param resumed: whether this continues a scan already in the journal.
+        '''
+        self._append({"event": "resume" if resumed else "start", "params": params})
+
+    def plan(self, fields: Sequence[Tuple[int, int, float, float]]) -> None:
+        '''Record the (i, j, x_mm, y_mm) of every field the scan will image.'''
+        self._append({"event": "plan", "fields": [list(f) for f in fields]})
+
+    def move(self, position: Position) -> None:
+        '''Record the (x mm, y mm, fine focus degrees) the stage is about to be commanded to.'''
+        self._append({"event": "move", "position": list(position)})
+
+    def field(self, record: FieldRecord) -> None:
+        '''Record a field whose image is on disk.'''
+        self._append({"event": "field", **asdict(record)})
+
+    def after_writes(self, n_writes: int, record: FieldRecord) -> Callable[[], None]:
+        '''Return a callback which records a field once every one of its images has been written.
+
+        :param n_writes: the number of images written for the field.
+        :param record: the field.
+        :returns: a callback to pass as on_written to image_writer.ImageWriter.write for each image of
+        the field. The field is recorded on the n_writes-th call, so not at all if a write fails.
+        '''
+        remaining = [n_writes]
+        lock = threading.Lock()
+
+        def written() -> None:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.field(record)
+
+        return written
+
+    def stopped(self, position: Position, error: BaseException) -> None:
+        '''Record that the scan stopped on an error, and where the stage was left.'''
+        self._append({"event": "stopped", "position": list(position), "error": repr(error)})
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def _append(self, event: dict) -> None:
+        event["time"] = time.time()
+        line = json.dumps(event) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+def read(path: Path) -> JournalState:
+    '''Read back what a journal recorded.
+
+    A torn last line, left by a crash while it was being written, is ignored.
+
+    :param path: the journal file.
+    :returns: the state of the scan.
+    :raises ValueError: when the journal does not record the start of a scan.
+    '''
+    state = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            kind = event.pop("event")
+            if kind == "start":
+                state = JournalState(event["params"])
+            elif state is None:
+                continue
+            elif kind == "plan":
+                state.fields = [(int(i), int(j), x, y) for i, j, x, y in event["fields"]]
+            elif kind in ("move", "stopped"):
+                state.position = tuple(event["position"])
+            elif kind == "field":
+                event.pop("time")
+                record = FieldRecord(**event)
+                # A field imaged again after a resume replaces its earlier record.
+                state.done.pop((record.i, record.j), None)
+                state.done[(record.i, record.j)] = record
+
+    if state is None:
+        raise ValueError(f"{path} does not record the start of a scan.")
+    return state
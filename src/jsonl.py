@@ -0,0 +1,42 @@
+'''
+    Append-only JSON lines files for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+from pathlib import Path
+from typing import TextIO
+
+
+def open_for_append(path: Path) -> TextIO:
+    '''Open a JSON lines file for appending, ending a line torn by a crash so the next line starts on its own.
+
+    A file which already ends in a newline is appended to as is.
+
+    :param path: the file, created if it does not exist.
+    :returns: the file, open for appending text.
+    '''
+    path = Path(path)
+    torn = False
+    if path.exists() and path.stat().st_size:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+
+    f = open(path, "a", encoding="utf-8")
+    if torn:
+        f.write("\n")
+    return f
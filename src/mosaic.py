@@ -0,0 +1,174 @@
+'''
+    Streaming mosaic stitching for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import math
+from pathlib import Path
+from typing import List, Optional, Tuple
+import numpy as np
+import cv2
+
+# Extent of the field positions in mm as (x_min, y_min, x_max, y_max).
+Extent = Tuple[float, float, float, float]
+
+
+class Mosaic:
+    '''Stitches field images into a whole-slide image on disk as they are taken.
+
+    Each image is placed at the position the stage moved to, then the placement is corrected by phase
+    correlating the strips where it overlaps images already placed, which absorbs stage positioning
+    error. The canvas and each level of a pyramid of 2x downsampled copies are .npy files opened with
+    np.lib.format.open_memmap, and only the region under each new image is updated, so memory use does
+    not grow with the size of the slide. level_0.npy is the full resolution canvas.
+    '''
+
+    def __init__(
+        self,
+        output_dir: Path,
+        extent_mm: Extent,
+        pixel_size_um: float,
+        n_levels: int = 4,
+        max_shift_px: int = 64,
+        min_overlap_px: int = 32,
+        min_response: float = 0.1
+    ):
+        '''
+        :param output_dir: the directory to write the canvas and pyramid levels to.
+        :param extent_mm: the smallest and largest stage positions of the images to place.
+        :param pixel_size_um: the size of an image pixel on the slide in micrometres.
+        :param n_levels: the number of downsampled levels to build on top of the full resolution canvas.
+        :param max_shift_px: the largest correction to a placement to accept. The canvas has a margin
+        this wide so corrected images stay on it.
+        :param min_overlap_px: the narrowest overlap strip to register against.
+        :param min_response: the smallest phase correlation peak response to accept a correction from.
+        '''
+        self.output_dir = Path(output_dir)
+        self.extent_mm = extent_mm
+        self.px_per_mm = 1000 / pixel_size_um
+        self.n_levels = n_levels
+        self.max_shift_px = max_shift_px
+        self.min_overlap_px = min_overlap_px
+        self.min_response = min_response
+
+        # Placed images as (row, column, stage x in mm, stage y in mm, phase correlation response).
+        self.placements: List[Tuple[int, int, float, float, float]] = []
+        self.levels: List[np.ndarray] = []
+        self._tile_shape: Optional[Tuple[int, int]] = None
+
+    def __enter__(self) -> "Mosaic":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def add(self, x_mm: float, y_mm: float, image: np.ndarray) -> Tuple[int, int]:
+        '''Register an image against its placed neighbours and write it into the canvas and pyramid.
+
+        :param x_mm: the x position of the stage when the image was taken in mm.
+        :param y_mm: the y position of the stage when the image was taken in mm.
+        :param image: the image, with the same shape and dtype as every other image in the mosaic.
+        :returns: the (row, column) of the image's top left corner in the canvas.
+        '''
+        if not self.levels:
+            self._allocate(image)
+
+        h, w = self._tile_shape
+        x_min, y_min, _, _ = self.extent_mm
+        row = self.max_shift_px + int(round((y_mm - y_min) * self.px_per_mm))
+        col = self.max_shift_px + int(round((x_mm - x_min) * self.px_per_mm))
+
+        dr, dc, response = self._register(row, col, image)
+        row, col = row + dr, col + dc
+
+        canvas = self.levels[0]
+        r0, c0 = max(row, 0), max(col, 0)
+        r1, c1 = min(row + h, canvas.shape[0]), min(col + w, canvas.shape[1])
+        canvas[r0:r1, c0:c1] = image[r0 - row:r1 - row, c0 - col:c1 - col]
+        self._update_pyramid(r0, r1, c0, c1)
+
+        self.placements.append((row, col, x_mm, y_mm, response))
+        return row, col
+
+    def close(self) -> None:
+        '''Flush every level of the mosaic to disk.'''
+        for level in self.levels:
+            level.flush()
+
+    def _allocate(self, image: np.ndarray) -> None:
+        self._tile_shape = image.shape[:2]
+        h, w = self._tile_shape
+        x_min, y_min, x_max, y_max = self.extent_mm
+        height = int(math.ceil((y_max - y_min) * self.px_per_mm)) + h + 2 * self.max_shift_px
+        width = int(math.ceil((x_max - x_min) * self.px_per_mm)) + w + 2 * self.max_shift_px
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        for k in range(self.n_levels + 1):
+            shape = (max(1, -(-height // 2 ** k)), max(1, -(-width // 2 ** k))) + image.shape[2:]
+            self.levels.append(
+                np.lib.format.open_memmap(self.output_dir / f"level_{k}.npy", mode="w+", dtype=image.dtype, shape=shape)
+            )
+
+    def _register(self, row: int, col: int, image: np.ndarray) -> Tuple[int, int, float]:
+        '''Find the correction to a placement from the strips it overlaps placed images in.
+
+        :returns: the row and column correction, and the response of the correlation it came from, or
+        zero corrections and a response of 0 when no strip could be registered.
+        '''
+        h, w = self._tile_shape
+        canvas = self.levels[0]
+        shifts, weights = [], []
+        for placed_row, placed_col, _, _, _ in self.placements:
+            r0, r1 = max(row, placed_row), min(row, placed_row) + h
+            c0, c1 = max(col, placed_col), min(col, placed_col) + w
+            if r1 - r0 < self.min_overlap_px or c1 - c0 < self.min_overlap_px:
+                continue
+
+            reference = _grey(canvas[r0:r1, c0:c1])
+            moving = _grey(image[r0 - row:r1 - row, c0 - col:c1 - col])
+            window = cv2.createHanningWindow((c1 - c0, r1 - r0), cv2.CV_32F)
+            (sx, sy), response = cv2.phaseCorrelate(moving, reference, window)
+            if response < self.min_response or max(abs(sx), abs(sy)) > self.max_shift_px:
+                continue
+            shifts.append((sy, sx))
+            weights.append(response)
+
+        if not shifts:
+            return 0, 0, 0.0
+
+        dr, dc = np.average(np.array(shifts), axis=0, weights=weights)
+        return int(round(dr)), int(round(dc)), float(max(weights))
+
+    def _update_pyramid(self, r0: int, r1: int, c0: int, c1: int) -> None:
+        '''Recompute the region of each downsampled level covering rows r0:r1 and columns c0:c1 of the canvas.'''
+        for k in range(1, len(self.levels)):
+            src, dst = self.levels[k - 1], self.levels[k]
+            r0, c0 = r0 // 2, c0 // 2
+            r1, c1 = min(-(-r1 // 2), dst.shape[0]), min(-(-c1 // 2), dst.shape[1])
+            block = src[2 * r0:2 * r1, 2 * c0:2 * c1]
+            dst[r0:r1, c0:c1] = cv2.resize(block, (c1 - c0, r1 - r0), interpolation=cv2.INTER_AREA)
+
+
+def _grey(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 3:
+        image = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_RGB2GRAY)
+    return image.astype(np.float32)
+
+
+def extent(positions_mm: List[Tuple[float, float]]) -> Extent:
+    '''Return the extent of a list of (x, y) stage positions in mm.'''
+    xs, ys = zip(*positions_mm)
+    return min(xs), min(ys), max(xs), max(ys)
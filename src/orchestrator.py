@@ -0,0 +1,150 @@
+'''
+    Multi-widget orchestration for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional, Sequence
+import api
+import cameras
+import journal
+import planner
+
+
+@dataclass
+class Rig:
+    '''One widget on the bench and the scan to run on it.
+
+    :param name: a name for the widget used in messages.
+    :param port: the serial port of the widget's stepper controller.
+    :param output_dir: the directory to write the scan's images to.
+    :param camera_num: the Lucam camera number of the widget's camera.
+    :param scan: keyword arguments for planner.main other than output_dir, port, widget and the shared
+    pools, such as x_travel_mm and n_fields_x. Setting "resume" continues the interrupted scan in
+    output_dir instead.
+    :param camera: a camera to use instead of camera camera_num, such as a simulator.SyntheticCamera.
+    '''
+    name: str
+    port: str
+    output_dir: str
+    camera_num: int = 0
+    scan: dict = field(default_factory=dict)
+    camera: Optional[cameras.CameraBackend] = None
+
+
+@dataclass
+class RigResult:
+    '''How the scan of one rig went.
+
+    :param name: the name of the rig.
+    :param output_dir: the directory the images were written to, or None if the scan failed.
+    :param error: the exception the scan failed with, or None.
+    :param elapsed_s: how long the scan ran in seconds.
+    '''
+    name: str
+    output_dir: Optional[Path] = None
+    error: Optional[BaseException] = None
+    elapsed_s: float = 0.0
+
+
+def run(rigs: Sequence[Rig], analysis_workers: Optional[int] = None, writer_workers: int = 4) -> List[RigResult]:
+    '''Scan with several widgets at once from this process.
+
+    Each rig is driven by its own thread through its own api.Widget, so its stage and camera are never
+    waiting on another rig's. The rigs share one process pool which scores the z-stacks of pipelined
+    scans (other scans score theirs on the rig's own thread), one thread pool which writes every rig's
+    images, and the one MATLAB engine every cameras.MatlabCamera uses. A rig whose scan fails does not stop the others.
+
+    :param rigs: the rigs and their scans.
+    :param analysis_workers: the number of processes scoring z-stacks, or None for one per CPU.
+    :param writer_workers: the number of threads writing images.
+    :returns: the result of each rig's scan, in the order of rigs.
+    '''
+    results = [RigResult(rig.name) for rig in rigs]
+
+    with ProcessPoolExecutor(analysis_workers) as analysis_pool, \
+            ThreadPoolExecutor(writer_workers, thread_name_prefix="image-writer") as write_pool:
+        threads = [
+            threading.Thread(
+                target=_run_rig, args=(rig, result, analysis_pool, write_pool), name=f"rig-{rig.name}"
+            )
+            for rig, result in zip(rigs, results)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for result in results:
+        if result.error is None:
+            print(f"{result.name}: finished in {result.elapsed_s:.1f} s, images in {result.output_dir}.")
+        else:
+            print(f"{result.name}: failed after {result.elapsed_s:.1f} s. {result.error}")
+    return results
+
+
+def _run_rig(rig: Rig, result: RigResult, analysis_pool: Optional[Executor], write_pool: ThreadPoolExecutor) -> None:
+    widget = api.Widget(rig.port, rig.camera, rig.camera_num)
+    scan = dict(rig.scan)
+    resume = scan.pop("resume", False)
+
+    start = time.perf_counter()
+    try:
+        # Only pipelined scans hand their z-stacks to a pool; planner.main rejects one for any other scan.
+        params = journal.read(Path(rig.output_dir) / journal.file_name).params if resume else scan
+        if not params.get("pipelined", False):
+            analysis_pool = None
+        if resume:
+            result.output_dir = planner.resume(
+                rig.output_dir, widget=widget, analysis_pool=analysis_pool, write_executor=write_pool
+            )
+        else:
+            result.output_dir = planner.main(
+                output_dir=rig.output_dir, widget=widget, analysis_pool=analysis_pool, write_executor=write_pool,
+                **scan
+            )
+    except Exception as e:
+        print(f"Error scanning with {rig.name}. {e}")
+        result.error = e
+    finally:
+        result.elapsed_s = time.perf_counter() - start
+        widget.stepper.close()
+
+
+def load_rigs(path: Path) -> List[Rig]:
+    '''Read rigs from a JSON file holding a list of objects with the fields of Rig other than camera.
+
+    :param path: the JSON file.
+    :returns: the rigs.
+    '''
+    with open(path) as f:
+        return [Rig(**entry) for entry in json.load(f)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan with several widgets at once.")
+    parser.add_argument("rigs", help="A JSON file listing the rigs, see load_rigs.")
+    parser.add_argument("--analysis-workers", type=int, help="Processes scoring z-stacks, one per CPU by default.")
+    parser.add_argument("--writer-workers", type=int, default=4, help="Threads writing images.")
+    args = parser.parse_args()
+
+    run(load_rigs(Path(args.rigs)), args.analysis_workers, args.writer_workers)
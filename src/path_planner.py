@@ -0,0 +1,244 @@
+'''
+    Scan path planning for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+import api
+
+# Ways fields can be ordered by plan.
+orders = ("serpentine", "optimized")
+
+
+@dataclass
+class FieldPosition:
+    "A field to image, indexed by i and j for its output file name, at a position relative to the start in mm."
+    i: int
+    j: int
+    x_mm: float
+    y_mm: float
+
+
+@dataclass
+class Waypoint:
+    '''A position the stage moves to in mm relative to the start.
+
+    field is the field imaged once the stage arrives, or None for a waypoint which only positions the
+    stage, such as the overshoot before a backlash-free approach or the return to the start.
+    '''
+    x_mm: float
+    y_mm: float
+    field: Optional[FieldPosition] = None
+
+
+@dataclass
+class MovePlan:
+    "An ordered list of waypoints and the estimated time a scan following them takes."
+    waypoints: List[Waypoint]
+    estimated_time_s: float
+
+    @property
+    def fields(self) -> List[FieldPosition]:
+        "The fields in the order they are imaged."
+        return [waypoint.field for waypoint in self.waypoints if waypoint.field is not None]
+
+
+def grid_fields(x_travel_mm: float, y_travel_mm: float, n_fields_x: int, n_fields_y: int) -> List[FieldPosition]:
+    '''Lay out a rectangular grid of fields starting at the current position.
+
+    :param x_travel_mm: the distance to travel in the x direction on the sample.
+    :param y_travel_mm: the distance to travel in the y direction on the sample.
+    :param n_fields_x: the number of fields to take in the x direction.
+    :param n_fields_y: the number of fields to take in the y direction.
+    :returns: the fields, column by column.
+    '''
+    x_step_mm = x_travel_mm / n_fields_x
+    y_step_mm = y_travel_mm / n_fields_y
+    return [
+        FieldPosition(i, j, i * x_step_mm, j * y_step_mm) for i in range(n_fields_x) for j in range(n_fields_y)
+    ]
+
+
+def polygon_fields(polygon_mm: Sequence[Tuple[float, float]], x_step_mm: float, y_step_mm: float) -> List[FieldPosition]:
+    '''Lay out the fields of a grid whose centres fall inside a polygonal region of interest.
+
+    The grid is aligned to the start position, so field (i, j) is at (i * x_step_mm, j * y_step_mm) and
+    indices can be negative when the polygon extends behind the start.
+
+    :param polygon_mm: the vertices of the polygon in mm relative to the start, in order.
+    :param x_step_mm: the distance between fields in the x direction.
+    :param y_step_mm: the distance between fields in the y direction.
+    :returns: the fields inside the polygon, column by column.
+    '''
+    polygon = np.asarray(polygon_mm, dtype=float)
+    if polygon.ndim != 2 or polygon.shape[0] < 3 or polygon.shape[1] != 2:
+        raise ValueError("A polygon needs at least three (x, y) vertices.")
+
+    lo = np.floor(polygon.min(axis=0) / (x_step_mm, y_step_mm)).astype(int)
+    hi = np.ceil(polygon.max(axis=0) / (x_step_mm, y_step_mm)).astype(int)
+    i, j = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1), indexing="ij")
+    i, j = i.ravel(), j.ravel()
+    x, y = i * x_step_mm, j * y_step_mm
+
+    # Even-odd rule: count the polygon edges a ray in the +x direction from each centre crosses.
+    inside = np.zeros(len(x), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        straddles = (y0 > y) != (y1 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= straddles & (x < crossing)
+
+    return [
+        FieldPosition(int(a), int(b), float(c), float(d))
+        for a, b, c, d in zip(i[inside], j[inside], x[inside], y[inside])
+    ]
+
+
+def list_fields(positions_mm: Sequence[Tuple[float, float]]) -> List[FieldPosition]:
+    '''Make fields from a list of positions, such as the fields kept by a survey pass.
+
+    :param positions_mm: the (x, y) position of each field in mm relative to the start.
+    :returns: the fields, indexed (k, 0) in the order given.
+    '''
+    return [FieldPosition(k, 0, float(x), float(y)) for k, (x, y) in enumerate(positions_mm)]
+
+
+def move_time(dx_mm, dy_mm):
+    '''Estimate how long a coordinated move of the x and y axes takes.
+
+    The axes move together as in api.move_xyz, so the move takes as long as its slowest axis.
+
+    :param dx_mm: the distance to move the x axis in mm, or an ndarray of them.
+    :param dy_mm: the distance to move the y axis in mm, or an ndarray of them.
+    :returns: the duration of the move in seconds.
+    '''
+    x_steps = np.rint(np.abs(dx_mm) / (api.x_dist_factor * api.step_degrees))
+    y_steps = np.rint(np.abs(dy_mm) / (api.y_dist_factor * api.step_degrees))
+    return np.maximum(api.estimate_move_time("x", x_steps), api.estimate_move_time("y", y_steps))
+
+
+def plan(
+    fields: Sequence[FieldPosition],
+    order: str = "optimized",
+    backlash_mm: float = 0.0,
+    return_home: bool = True,
+    field_time_s: float = 0.0,
+    move_overhead_s: float = 0.0,
+    max_passes: int = 50
+) -> MovePlan:
+    '''Order fields and plan the moves between them.
+
+    "serpentine" images the fields column by column, alternating the direction in y. "optimized"
+    builds a nearest neighbour tour from the start and shortens it with 2-opt, using the estimated
+    move time between fields as the cost rather than the distance, since the axes move at different
+    speeds and together.
+
+    With backlash_mm, every field is approached moving in the +x and +y directions: a move which would
+    arrive moving backwards first overshoots the field by backlash_mm on that axis, so the leadscrew
+    slack is always taken up on the same side. Overshoots are kept inside the travel envelope, the box
+    around the start and the fields, so a field on its lower edge which would be approached moving
+    backwards, and the return to the start, are approached directly instead. The overshoot is left out
+    of the ordering cost.
+
+    :param fields: the fields to image.
+    :param order: one of orders.
+    :param backlash_mm: the overshoot used to approach fields from a consistent direction, or 0 to
+    approach them directly.
+    :param return_home: whether to finish with a move back to the start.
+    :param field_time_s: the time spent focusing and imaging each field, added to the estimate.
+    :param move_overhead_s: the time each move takes on top of the motion itself, such as settling.
+    :param max_passes: the maximum number of 2-opt passes over the tour.
+    :returns: the move plan.
+    '''
+    if order not in orders:
+        raise ValueError(f"Unknown field order {order}.")
+
+    if order == "serpentine":
+        ordered = sorted(fields, key=lambda f: (f.i, f.j if f.i % 2 == 0 else -f.j))
+    else:
+        ordered = [fields[k - 1] for k in _optimized_tour(fields, return_home, max_passes)[1:]]
+
+    waypoints = []
+    x, y = 0.0, 0.0
+    x_min = min([0.0] + [f.x_mm for f in ordered])
+    y_min = min([0.0] + [f.y_mm for f in ordered])
+    targets = [Waypoint(f.x_mm, f.y_mm, f) for f in ordered]
+    if return_home:
+        targets.append(Waypoint(0.0, 0.0))
+
+    for target in targets:
+        if backlash_mm > 0 and (target.x_mm < x or target.y_mm < y):
+            overshoot = Waypoint(
+                max(target.x_mm - backlash_mm, x_min) if target.x_mm < x else target.x_mm,
+                max(target.y_mm - backlash_mm, y_min) if target.y_mm < y else target.y_mm
+            )
+            if (overshoot.x_mm, overshoot.y_mm) != (target.x_mm, target.y_mm):
+                waypoints.append(overshoot)
+        waypoints.append(target)
+        x, y = target.x_mm, target.y_mm
+
+    path = np.array([(0.0, 0.0)] + [(w.x_mm, w.y_mm) for w in waypoints])
+    steps = np.diff(path, axis=0)
+    times = move_time(steps[:, 0], steps[:, 1])
+    moving = np.any(steps != 0, axis=1)
+    estimated = float(times.sum()) + move_overhead_s * int(moving.sum()) + field_time_s * len(ordered)
+
+    return MovePlan(waypoints, estimated)
+
+
+def _optimized_tour(fields: Sequence[FieldPosition], return_home: bool, max_passes: int) -> np.ndarray:
+    '''Order the fields with a nearest neighbour tour improved by 2-opt.
+
+    :returns: the node indices of the tour, where node 0 is the start and node k is fields[k - 1].
+    '''
+    positions = np.array([(0.0, 0.0)] + [(f.x_mm, f.y_mm) for f in fields])
+    delta = positions[np.newaxis, :, :] - positions[:, np.newaxis, :]
+    cost = move_time(delta[..., 0], delta[..., 1])
+    if not return_home:
+        # The tour ends wherever the last field is, so returning to the start is free.
+        cost[:, 0] = 0.0
+
+    n = len(positions)
+    tour = np.empty(n, dtype=int)
+    tour[0] = 0
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    for k in range(1, n):
+        remaining = np.where(visited, np.inf, cost[tour[k - 1]])
+        tour[k] = int(np.argmin(remaining))
+        visited[tour[k]] = True
+
+    # Reversing tour[a:b + 1] replaces edges (tour[a - 1], tour[a]) and (tour[b], tour[b + 1]) with
+    # (tour[a - 1], tour[b]) and (tour[a], tour[b + 1]). Edges inside the segment are reversed, which
+    # does not change their cost since moves between fields cost the same both ways.
+    for _ in range(max_passes):
+        improved = False
+        for a in range(1, n - 1):
+            b = np.arange(a + 1, n)
+            before, first = tour[a - 1], tour[a]
+            last, after = tour[b], tour[(b + 1) % n]
+            gain = cost[before, last] + cost[first, after] - cost[before, first] - cost[last, after]
+            best = int(np.argmin(gain))
+            if gain[best] < -1e-9:
+                end = b[best]
+                tour[a:end + 1] = tour[a:end + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+
+    return tour
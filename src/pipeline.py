@@ -0,0 +1,229 @@
+'''
+    Pipelined acquisition for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import queue
+import threading
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import List, Optional
+import numpy as np
+import api
+import detection
+import edf
+import image_writer
+import journal
+
+# Sentinel placed on a queue to tell a worker thread to exit.
+_STOP = object()
+
+
+@dataclass
+class Field:
+    '''A captured z-stack of one microscope field waiting to be analyzed.
+
+    :param i: the index of the field in the x direction.
+    :param j: the index of the field in the y direction.
+    :param images: the z-stack, ordered from the top of the stack down.
+    :param focus: the fine focus position in degrees at the centre of the stack.
+    :param z_step_size: the number of degrees the fine focus knob turned per z-step.
+    :param x_mm: the x position of the field in mm relative to the start.
+    :param y_mm: the y position of the field in mm relative to the start.
+    '''
+    i: int
+    j: int
+    images: List[api.OpenCVImage]
+    focus: float
+    z_step_size: float
+    x_mm: float = 0.0
+    y_mm: float = 0.0
+
+
+@dataclass
+class FieldResult:
+    '''The analyzed result for one microscope field.
+
+    :param i: the index of the field in the x direction.
+    :param j: the index of the field in the y direction.
+    :param best_focused: the index of the most in-focus image in the z-stack.
+    :param metrics: the focus metric for each image in the z-stack.
+    :param focus: the fine focus position in degrees of the most in-focus image.
+    :param x_mm: the x position of the field in mm relative to the start.
+    :param y_mm: the y position of the field in mm relative to the start.
+    '''
+    i: int
+    j: int
+    best_focused: int
+    metrics: np.ndarray
+    focus: float
+    x_mm: float = 0.0
+    y_mm: float = 0.0
+
+
+class ScanPipeline:
+    '''Overlaps stage motion and capture with focus analysis and disk writes.
+
+    The control thread submits each field as soon as its z-stack is captured and carries on moving
+    to the next field. An analysis thread scores each z-stack and a writer thread hands the best
+    focused image to an image_writer.ImageWriter. The queues between the stages hold at most max_in_flight items, so at most
+    max_in_flight + 1 z-stacks are in memory at once and submit blocks when analysis falls behind.
+
+    With edf_workers, the analysis thread also hands each z-stack to an edf.EdfPool, and the writer
+    saves the fused image and depth map once fusion finishes. The pool holds at most max_in_flight
+    z-stacks, so backpressure still reaches submit. With a journal, each field is recorded once all
+    of its images are written. With an analysis pool, such as a process pool shared by the scans of
+    several widgets, z-stacks are scored on it instead of on the analysis thread. With a detector,
+    the analysis thread hands it each best focused image as soon as the z-stack is scored.
+    '''
+
+    def __init__(
+        self,
+        writer: image_writer.ImageWriter,
+        max_in_flight: int = 2,
+        edf_workers: int = 0,
+        scan_journal: Optional[journal.ScanJournal] = None,
+        analysis_pool: Optional[Executor] = None,
+        detector: Optional[detection.Detector] = None
+    ):
+        '''
+        :param writer: the writer the best focused images are written with.
+        :param max_in_flight: the maximum number of fields queued between each stage.
+        :param edf_workers: the number of threads fusing each z-stack into an all-in-focus image, or
+        0 to skip fusion.
+        :param scan_journal: the journal to record written fields in, or None.
+        :param analysis_pool: the executor to score z-stacks on, or None to score them on the analysis thread.
+        :param detector: the detector to hand each best focused image to, or None.
+        '''
+        self.writer = writer
+        self.journal = scan_journal
+        self.analysis_pool = analysis_pool
+        self.detector = detector
+        self._edf_pool = edf.EdfPool(edf_workers, max_in_flight) if edf_workers > 0 else None
+        self._analysis_queue = queue.Queue(maxsize=max_in_flight)
+        self._write_queue = queue.Queue(maxsize=max_in_flight)
+        self._lock = threading.Lock()
+        self._latest: Optional[FieldResult] = None
+        self._error: Optional[BaseException] = None
+        self._threads = [
+            threading.Thread(target=self._analysis_worker, daemon=True),
+            threading.Thread(target=self._write_worker, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self) -> "ScanPipeline":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(raise_errors=exc_type is None)
+
+    def submit(self, field: Field) -> None:
+        '''Queue a captured field for analysis. Blocks while the analysis queue is full.
+
+        :param field: the captured field.
+        :raises RuntimeError: when a worker thread failed on an earlier field.
+        '''
+        self._raise_if_failed()
+        self._analysis_queue.put(field)
+
+    def latest_result(self) -> Optional[FieldResult]:
+        '''Return the most recently analyzed field, or None if no field has been analyzed yet.'''
+        with self._lock:
+            return self._latest
+
+    def close(self, raise_errors: bool = True) -> None:
+        '''Wait for every submitted field to be analyzed and written, then stop the workers.
+
+        :param raise_errors: whether to raise if a worker thread failed.
+        :raises RuntimeError: when a worker thread failed and raise_errors is set.
+        '''
+        self._analysis_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        if self._edf_pool is not None:
+            self._edf_pool.close()
+        if raise_errors:
+            self._raise_if_failed()
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Scan pipeline worker failed.") from self._error
+
+    def _analysis_worker(self) -> None:
+        while True:
+            field = self._analysis_queue.get()
+            if field is _STOP:
+                self._write_queue.put(_STOP)
+                return
+
+            # Keep draining the queue after a failure so the control thread never blocks forever.
+            if self._error is not None:
+                continue
+
+            try:
+                if self.analysis_pool is not None:
+                    metrics, best_focused = self.analysis_pool.submit(api.analyze_z_stack, field.images).result()
+                else:
+                    metrics, best_focused = api.analyze_z_stack(field.images)
+                offset = (len(field.images) - 1) / 2.0 - best_focused
+                result = FieldResult(
+                    field.i, field.j, best_focused, metrics, field.focus + field.z_step_size * offset,
+                    field.x_mm, field.y_mm
+                )
+                with self._lock:
+                    self._latest = result
+
+                if self.detector is not None:
+                    self.detector.submit(f"field_{field.i}_{field.j}", field.images[best_focused])
+
+                # Only the best image moves on, the rest of the z-stack is released here unless it
+                # is being fused.
+                fusion = self._edf_pool.submit(field.images) if self._edf_pool is not None else None
+                self._write_queue.put((result, field.images[best_focused], fusion))
+            except Exception as e:
+                print(f"Error analyzing field ({field.i}, {field.j}). {e}")
+                self._error = e
+
+    def _write_worker(self) -> None:
+        while True:
+            item = self._write_queue.get()
+            if item is _STOP:
+                return
+
+            if self._error is not None:
+                continue
+
+            result, image, fusion = item
+            name = f"field_{result.i}_{result.j}"
+            try:
+                written = None
+                if self.journal is not None:
+                    written = self.journal.after_writes(1 if fusion is None else 3, journal.FieldRecord(
+                        result.i, result.j, result.x_mm, result.y_mm, result.focus,
+                        result.metrics.tolist(), self.writer.file_name(name)
+                    ))
+
+                self.writer.write(name, image, on_written=written)
+                if fusion is not None:
+                    fused, depth = fusion.result()
+                    self.writer.write(f"{name}_edf", fused, on_written=written)
+                    # Depth maps are float32, which only the array formats hold.
+                    array_format = "container" if self.writer.image_format == "container" else "npy"
+                    self.writer.write(f"{name}_depth", depth, array_format, written)
+            except Exception as e:
+                print(f"Error writing field ({result.i}, {result.j}). {e}")
+                self._error = e
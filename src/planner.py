@@ -16,12 +16,32 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
+import argparse
+import asyncio
+import contextlib
 import sys
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
 from pathlib import Path
-from typing import List
+from typing import Callable, Collection, Dict, List, Optional, Sequence, Tuple
 from time import sleep
-import cv2
 import api
+import async_api
+import autofocus
+import detection
+import focus_index
+import focus_map
+import image_writer
+import journal
+import mosaic
+import path_planner
+import pipeline
+import settle
+import survey
+import tracing
+
+# Ways main can focus each field.
+focus_modes = ("stack", "parabolic", "golden")
 
 
 def _ack(prompt: str):
@@ -75,46 +95,433 @@ def _create_out_dir(output_dir: str) -> Path:
             ix += 1
             out_path = out_path.parent / (root + str(ix))
 
+    return out_path
 
-def _take_z_stack(n_z_stack: int, z_step_size: float, movement_sleep: float = 0.5) -> List[api.OpenCVImage]:
+
+def _settled_image(delay: float, settle_detector: Optional[settle.SettleDetector] = None) -> api.OpenCVImage:
+    '''Take an image once the stage has settled after a move.
+
+    :param delay: how long to wait for the stage to settle in seconds.
+    :param settle_detector: if given, wait until it sees the stage has settled instead of for delay.
+    :returns: the image.
+    '''
+    if settle_detector is not None:
+        return settle_detector.wait()[0]
+
+    with tracing.span("settle"):
+        sleep(delay)
+    return api.take_image()
+
+
+def _take_z_stack(
+    n_z_stack: int,
+    z_step_size: float,
+    movement_sleep: float = 0.5,
+    analyzer: Optional[api.ZStackAnalyzer] = None,
+    settle_detector: Optional[settle.SettleDetector] = None
+) -> List[api.OpenCVImage]:
     '''Take a z-stack of images. Assumes the microscope is initially in the best guess for focus.
 
     :param n_z_stack: how many images in a z-stack to take per field.
     :param z_step_size: the number of degrees to turn the fine focus knob per z-step.
     :param movement_sleep: how long to wait after moving to take an image in seconds.
+    :param analyzer: if given, each image is pushed to the analyzer as it is taken instead of being kept.
+    :param settle_detector: if given, wait for each move to settle with it instead of for movement_sleep.
+    :returns: the images of the z-stack from the top down, or an empty list when analyzer is given.
+
+    The move back to the initial focus is queued rather than sent, so it is made together with
+    whatever move comes next.
     '''
     images = []
+    keep = images.append if analyzer is None else analyzer.push
 
     # Move to the top of the z-stack
     api.move_fine_focus(z_step_size * (n_z_stack - 1) / 2.0)
 
-    # Wait extra long because it is a long movement
-    sleep(movement_sleep * 3)
-
-    # Take image at the top
-    #images.append(api.take_image())
+    # Take image at the top, waiting extra long because it is a long movement
+    keep(_settled_image(movement_sleep * 3, settle_detector))
 
     # Step down one step size and take image.
     for i in range(n_z_stack - 1):
         api.move_fine_focus(-z_step_size)
-        sleep(movement_sleep)
-        #images.append(api.take_image())
+        keep(_settled_image(movement_sleep, settle_detector))
 
-    # Move back to initial position.
-    api.move_fine_focus(z_step_size * (n_z_stack - 1) / 2.0)
+    # Move back to initial position with the next move.
+    api.queue_move("focus_fine", z_step_size * (n_z_stack - 1) / 2.0)
     return images
 
 
-def main(
+def _scan_sequential(
+    writer: image_writer.ImageWriter,
+    plan: path_planner.MovePlan,
+    n_z_stack: int,
+    z_step_size: float,
+    focus_mode: str,
+    movement_sleep: float,
+    surface: Optional[focus_map.FocusMap] = None,
+    stitcher: Optional[mosaic.Mosaic] = None,
+    settle_detector: Optional[settle.SettleDetector] = None,
+    scan_journal: Optional[journal.ScanJournal] = None,
+    start_focus: float = 0.0,
+    priors: Optional[Dict[Tuple[int, int], focus_index.FocusPrior]] = None,
+    confirm_stack: int = 3,
+    index: Optional[focus_index.FocusIndex] = None,
+    slide_id: Optional[str] = None,
+    detector: Optional[detection.Detector] = None
+):
+    '''Image the fields of a move plan one after the other, waiting for each field to be analyzed and written.
+
+    Each move to the next field also moves the microscope to the best focused position of the last
+    field, or with a focus map to the best focus the map predicts there, in which case z-stacks shrink
+    as the prediction becomes more certain. With a mosaic, each field is also stitched into it. With a
+    settle detector, images are taken as soon as the stage settles instead of after movement_sleep.
+    With a journal, each move to a field and each written field is recorded. start_focus is the
+    best focus to image the first field at, such as that of the last field before a scan was resumed.
+
+    A field with a prior is imaged at the focus the prior records, shifted by how far the last field's
+    best focus was from its prior, as when the slide has been put back a little higher or lower. In
+    the "stack" focus_mode it takes a confirming stack of confirm_stack images, followed by a full
+    stack around the best of them only if it is at either end. With an index, each written field is
+    recorded in it under slide_id. With a detector, the best focused image of each field is handed to it.
+    '''
+    priors = priors or {}
+    prior_offset = 0.0
+
+    # Stage position relative to the starting field, which stepper_controller_init made the origin of
+    # api.move_to, and fine focus position relative to the start.
+    x_mm, y_mm, focus = api.get_position()
+    best_focus = start_focus
+
+    for waypoint in plan.waypoints:
+        field = waypoint.field
+        prior = priors.get((field.i, field.j)) if field is not None else None
+        if field is None:
+            target = focus
+        elif prior is not None:
+            target = prior.focus + prior_offset
+        elif surface is not None:
+            target = surface.predict(field.x_mm, field.y_mm)[0]
+        else:
+            target = best_focus
+
+        # A single move from wherever the last field's focusing left the stage.
+        if scan_journal is not None and field is not None:
+            scan_journal.move((waypoint.x_mm, waypoint.y_mm, target))
+        api.move_to(waypoint.x_mm, waypoint.y_mm, target)
+        x_mm, y_mm, focus = waypoint.x_mm, waypoint.y_mm, target
+
+        if field is None:
+            continue
+
+        with tracing.span("field", i=field.i, j=field.j):
+            if focus_mode == "stack":
+                if prior is not None:
+                    n = min(confirm_stack, n_z_stack)
+                elif surface is not None:
+                    n = surface.stack_size(x_mm, y_mm, z_step_size, n_z_stack)
+                else:
+                    n = n_z_stack
+
+                # Score each image as it is taken so only the best one is held in memory.
+                analyzer = api.create_z_stack_analyzer(n)
+                _take_z_stack(n, z_step_size, movement_sleep, analyzer, settle_detector)
+                best_focus = focus + z_step_size * ((n - 1) / 2.0 - analyzer.best_index)
+
+                # The peak may lie beyond a confirming stack whose best image is at one end.
+                if prior is not None and n < n_z_stack and analyzer.best_index in (0, n - 1):
+                    api.move_to(focus_deg=best_focus)
+                    focus = best_focus
+                    n = n_z_stack
+                    analyzer = api.create_z_stack_analyzer(n)
+                    _take_z_stack(n, z_step_size, movement_sleep, analyzer, settle_detector)
+                    best_focus = focus + z_step_size * ((n - 1) / 2.0 - analyzer.best_index)
+
+                image = analyzer.best_image
+                metrics = analyzer.result()[2].tolist()
+            else:
+                # The search finishes at the best focused position.
+                result = autofocus.search(
+                    z_step_size, max_steps=n_z_stack, method=focus_mode, movement_sleep=movement_sleep,
+                    settle_detector=settle_detector, max_captures=max(n_z_stack, 3)
+                )
+                focus += result.focus
+                best_focus = focus
+                image = result.image
+                metrics = result.metrics
+
+            if surface is not None:
+                surface.add(x_mm, y_mm, best_focus)
+            if prior is not None:
+                prior_offset = best_focus - prior.focus
+
+            name = f"field_{field.i}_{field.j}"
+            callbacks = []
+            if scan_journal is not None:
+                callbacks.append(scan_journal.after_writes(1, journal.FieldRecord(
+                    field.i, field.j, x_mm, y_mm, best_focus, metrics, writer.file_name(name)
+                )))
+            if index is not None:
+                callbacks.append(index.after_write(focus_index.FocusPrior(
+                    slide_id, field.i, field.j, x_mm, y_mm, best_focus, metrics
+                ), image))
+            writer.write(name, image, on_written=_call_all(callbacks))
+            if detector is not None:
+                detector.submit(name, image)
+            if stitcher is not None:
+                stitcher.add(x_mm, y_mm, image)
+
+
+def _call_all(callbacks: List[Callable[[], None]]) -> Optional[Callable[[], None]]:
+    '''Combine callbacks into one which calls each in turn, or None when there are none.'''
+    if not callbacks:
+        return None
+
+    def call_all() -> None:
+        for callback in callbacks:
+            callback()
+
+    return call_all
+
+
+def _scan_pipelined(
+    writer: image_writer.ImageWriter,
+    x_step_mm: float,
+    y_step_mm: float,
+    n_fields_x: int,
+    n_fields_y: int,
+    n_z_stack: int,
+    z_step_size: float,
+    focus_mode: str,
+    movement_sleep: float,
+    max_in_flight: int,
+    edf_workers: int = 0,
+    settle_detector: Optional[settle.SettleDetector] = None,
+    scan_journal: Optional[journal.ScanJournal] = None,
+    done: Collection[Tuple[int, int]] = (),
+    start_focus: float = 0.0,
+    analysis_pool: Optional[Executor] = None,
+    detector: Optional[detection.Detector] = None
+):
+    '''Image every field, analyzing and writing each field while the stage moves to the next one.
+
+    Focus tracking lags by however many fields are still being analyzed: before each z-stack the
+    fine focus is moved to the best focused position of the most recently analyzed field. Autofocus
+    searches score images as they are captured and finish in focus, so only their best image is queued.
+    With a journal, each field is recorded as the stage moves to it and once it is written. Fields
+    whose (i, j) is in done are passed over, starting from the fine focus position start_focus.
+    Z-stacks are scored on analysis_pool when it is given, and the best focused image of each field
+    is handed to detector when it is given.
+    '''
+
+    # Fine focus position in degrees relative to the starting position.
+    focus = start_focus
+    # Stage position relative to the starting field.
+    x_mm, y_mm = 0.0, 0.0
+
+    # A resumed scan can start anywhere, a new one is already there.
+    api.move_to(x_mm, y_mm, focus)
+
+    y_direction = 1
+    with pipeline.ScanPipeline(
+        writer, max_in_flight, edf_workers, scan_journal, analysis_pool, detector
+    ) as scan:
+        for i in range(n_fields_x):
+            for j in range(n_fields_y):
+                if (i, j) not in done:
+                    if focus_mode == "stack":
+                        latest = scan.latest_result()
+                        if latest is not None and latest.focus != focus:
+                            api.move_fine_focus(latest.focus - focus)
+                            focus = latest.focus
+
+                    if scan_journal is not None:
+                        scan_journal.move((x_mm, y_mm, focus))
+
+                    if focus_mode == "stack":
+                        images = _take_z_stack(n_z_stack, z_step_size, movement_sleep, settle_detector=settle_detector)
+                    else:
+                        result = autofocus.search(
+                            z_step_size, max_steps=n_z_stack, method=focus_mode, movement_sleep=movement_sleep,
+                            settle_detector=settle_detector, max_captures=max(n_z_stack, 3)
+                        )
+                        images = [result.image]
+                        focus += result.focus
+                    scan.submit(pipeline.Field(i, j, images, focus, z_step_size, x_mm, y_mm))
+
+                # Step one position, together with the next field's focus moves.
+                api.queue_move("y", y_step_mm * y_direction)
+                y_mm += y_step_mm * y_direction
+
+            # Change directions in y.
+            y_direction *= -1
+
+            # Step over one position
+            api.queue_move("x", x_step_mm)
+            x_mm += x_step_mm
+
+    # Return to home position.
+    api.queue_move("x", -x_step_mm * n_fields_x)
+    api.flush_moves()
+
+
+async def _scan_async(
+    writer: image_writer.ImageWriter,
+    x_step_mm: float,
+    y_step_mm: float,
+    n_fields_x: int,
+    n_fields_y: int,
+    n_z_stack: int,
+    z_step_size: float,
+    movement_sleep: float,
+    detector: Optional[detection.Detector] = None
+):
+    '''Image every field with the asynchronous API, overlapping analysis and writes with stage moves.
+
+    Each image of a z-stack is scored while the fine focus moves to the next plane, and each field is
+    written, and handed to detector when it is given, while the stage moves on to the next field and
+    back to the best focused plane.
+    '''
+
+    loop = asyncio.get_running_loop()
+    camera = async_api.AsyncCamera()
+
+    async with async_api.AsyncStage() as stage:
+        y_direction = 1
+        for i in range(n_fields_x):
+            for j in range(n_fields_y):
+                analyzer = api.create_z_stack_analyzer(n_z_stack)
+
+                # Move to the top of the z-stack, waiting extra long because it is a long movement.
+                await stage.move_fine_focus(z_step_size * (n_z_stack - 1) / 2.0)
+                with tracing.span("settle"):
+                    await asyncio.sleep(movement_sleep * 3)
+                image = await camera.snap()
+
+                # Step down one step size, scoring the previous image during the move, and take an image.
+                for _ in range(n_z_stack - 1):
+                    move = stage.move_fine_focus(-z_step_size)
+                    await loop.run_in_executor(None, analyzer.push, image)
+                    await move
+                    with tracing.span("settle"):
+                        await asyncio.sleep(movement_sleep)
+                    image = await camera.snap()
+                await loop.run_in_executor(None, analyzer.push, image)
+
+                # The stage is at the bottom of the z-stack. Step one position and move straight to the
+                # best focused plane while the best image is written.
+                name = f"field_{i}_{j}"
+                handoffs = [loop.run_in_executor(None, writer.write, name, analyzer.best_image)]
+                if detector is not None:
+                    handoffs.append(loop.run_in_executor(None, detector.submit, name, analyzer.best_image))
+                await asyncio.gather(
+                    stage.move_xyz(0, y_step_mm * y_direction, z_step_size * (n_z_stack - 1 - analyzer.best_index)),
+                    *handoffs
+                )
+
+            # Change directions in y.
+            y_direction *= -1
+
+            # Step over one position
+            await stage.move_x(x_step_mm)
+
+        # Return to home position.
+        await stage.move_x(-x_step_mm * n_fields_x)
+
+    camera.close()
+
+
+def _scan_planned(
+    writer: image_writer.ImageWriter,
+    output_dir: Path,
     x_travel_mm: float,
     y_travel_mm: float,
     n_fields_x: int,
     n_fields_y: int,
     n_z_stack: int,
     z_step_size: float,
-    output_dir: str
+    focus_mode: str,
+    movement_sleep: float,
+    use_focus_map: bool,
+    path: str,
+    fields: Optional[Sequence[Tuple[float, float]]],
+    backlash_mm: float,
+    use_survey: bool,
+    mosaic_pixel_size_um: Optional[float],
+    settle_detector: Optional[settle.SettleDetector],
+    scan_journal: journal.ScanJournal,
+    done: Dict[Tuple[int, int], journal.FieldRecord],
+    state: Optional[journal.JournalState] = None,
+    index: Optional[focus_index.FocusIndex] = None,
+    slide_id: Optional[str] = None,
+    prior_max_age_s: float = 0.0,
+    confirm_stack: int = 3,
+    detector: Optional[detection.Detector] = None
 ):
-    '''The main control loop for the widget.
+    '''Lay out, survey and plan the fields of a sequential scan, then image them. See main.
+
+    When resuming from a journal state, the fields it planned are reused, and the fields in done are
+    skipped after seeding the focus map and mosaic with them. With an index, the fields with fresh
+    priors from earlier scans of the slide only take confirming stacks.
+    '''
+    if state is not None and state.fields is not None:
+        field_set = [path_planner.FieldPosition(i, j, x_mm, y_mm) for i, j, x_mm, y_mm in state.fields]
+    else:
+        if fields is None:
+            field_set = path_planner.grid_fields(x_travel_mm, y_travel_mm, n_fields_x, n_fields_y)
+        else:
+            field_set = path_planner.list_fields(fields)
+
+        if use_survey:
+            result = survey.run(
+                field_set, movement_sleep=movement_sleep, backlash_mm=backlash_mm, settle_detector=settle_detector
+            )
+            result.write_csv(output_dir / "survey.csv")
+            field_set = result.kept
+            print(f"Survey kept {len(field_set)} of {len(result.fields)} fields.")
+        scan_journal.plan([(field.i, field.j, field.x_mm, field.y_mm) for field in field_set])
+
+    remaining = [field for field in field_set if (field.i, field.j) not in done]
+    if len(remaining) < len(field_set):
+        print(f"Resuming with {len(field_set) - len(remaining)} of {len(field_set)} fields already imaged.")
+
+    # The plan finishes with the return to the home position.
+    plan = path_planner.plan(remaining, path, backlash_mm)
+    print(f"Planned {len(remaining)} fields with an estimated {plan.estimated_time_s:.1f} s of stage travel.")
+
+    priors = {}
+    if index is not None:
+        priors = index.priors(
+            slide_id, [(field.i, field.j, field.x_mm, field.y_mm) for field in remaining], prior_max_age_s
+        )
+        print(f"Found focus from earlier scans of {slide_id} for {len(priors)} of {len(remaining)} fields.")
+
+    surface = focus_map.FocusMap(min_sigma=api.step_degrees) if use_focus_map else None
+    stitcher = None
+    if mosaic_pixel_size_um is not None and field_set:
+        extent = mosaic.extent([(field.x_mm, field.y_mm) for field in field_set])
+        stitcher = mosaic.Mosaic(output_dir / "mosaic", extent, mosaic_pixel_size_um)
+
+    for record in done.values():
+        if surface is not None:
+            surface.add(record.x_mm, record.y_mm, record.focus)
+        if stitcher is not None:
+            stitcher.add(record.x_mm, record.y_mm, image_writer.read_image(output_dir / record.file))
+
+    last = next(reversed(done.values()), None)
+    _scan_sequential(
+        writer, plan, n_z_stack, z_step_size, focus_mode, movement_sleep, surface, stitcher, settle_detector,
+        scan_journal, last.focus if last is not None else 0.0, priors, confirm_stack, index, slide_id, detector
+    )
+    if stitcher is not None:
+        stitcher.close()
+
+
+@dataclass
+class ScanConfig:
+    '''The settings of a scan, which its journal records so it can be resumed with the same settings.
+
+    A ScanConfig is checked when it is made, so every combination a scan does not support raises
+    ValueError in one place rather than partway through the scan.
 
     :param x_travel_mm: the distance to travel in the x direction on the sample.
     :param y_travel_mm: the distance to travel in the y direction on the sample.
@@ -122,61 +529,408 @@ def main(
     :param n_fields_y: the number of fields to take in the y direction.
     :param n_z_stack: how many images in a z-stack to take per field.
     :param z_step_size: the number of degrees to turn the fine focus knob per z-step.
+    :param pipelined: analyze and write each field while the stage moves on to the next field.
+    :param max_in_flight: the maximum number of z-stacks queued for analysis when pipelined.
+    :param focus_mode: "stack" to take a fixed z-stack of n_z_stack images per field, or "parabolic" or
+    "golden" to run an autofocus search of at most n_z_stack images (3 when fewer) that stops once the
+    peak is found.
+    :param asynchronous: drive the stage and camera with the asyncio API, which overlaps analysis and
+    writes with stage moves. Only supports the "stack" focus_mode.
+    :param movement_sleep: how long to wait after moving the fine focus to take an image in seconds.
+    :param use_focus_map: predict each field's focus from a surface fitted to the fields already
+    imaged, and shrink z-stacks as the prediction improves. Only supported by sequential scans.
+    :param path: the order to image fields in, one of path_planner.orders. "optimized" orders fields to
+    minimise the estimated stage travel time. Only sequential scans support orders other than "serpentine".
+    :param fields: the (x, y) positions in mm relative to the start of the fields to image instead of
+    the grid, such as those found by a survey pass. Only supported by sequential scans.
+    :param backlash_mm: approach every field moving in +x and +y, overshooting by this distance when
+    needed to take up leadscrew backlash. Only supported by sequential scans.
+    :param use_survey: take one quick image of every field first, and only focus and image the fields
+    whose occupancy shows they hold a thin film. The survey is written to survey.csv in the output
+    directory. Only supported by sequential scans.
+    :param mosaic_pixel_size_um: the size of an image pixel on the slide in micrometres. When given,
+    fields are stitched into a whole-slide mosaic in the mosaic directory of the output directory as
+    they are imaged. Only supported by sequential scans.
+    :param edf_workers: the number of threads fusing each z-stack into an all-in-focus image, written
+    next to the best focused image with its depth map. Only supported by pipelined scans in the "stack"
+    focus_mode, which keep every z-stack.
+    :param image_format: the format to write images in, one of image_writer.formats.
+    :param png_compression: the PNG compression level from 0, uncompressed, to 9, smallest.
+    :param writer_workers: the number of threads writing images.
+    :param adaptive_settle: stream images from the camera and take each image as soon as consecutive
+    frames show the stage has stopped moving, instead of waiting movement_sleep after every move.
+    Not supported by asynchronous scans.
+    :param slide_id: an ID of the slide, such as its label. When given, the best focus of each field is
+    recorded in the focus index, and fields which an earlier scan of the slide imaged at most
+    prior_max_age_h hours ago start from the focus found then. In the "stack" focus_mode they take a
+    confirming stack of confirm_stack images instead of n_z_stack. Only supported by sequential scans.
+    :param focus_index_path: the focus index file, see focus_index.FocusIndex.
+    :param prior_max_age_h: the age in hours past which an earlier scan's focus is not reused.
+    :param confirm_stack: how many images the z-stack confirming an earlier scan's focus takes.
+    :param detection_workers: the number of threads counting red blood cells and finding parasite
+    candidates in the best focused image of each field as it is imaged, or 0 to not detect. The counts
+    and candidates of each field, and the parasitemia of the slide, are written to detections.jsonl in
+    the output directory, and the crops of the candidates next to each image, see detection.Detector.
+    :param cell_radius_px: the typical radius of a red blood cell in image pixels.
+    :raises ValueError: when a setting is out of range, when edf_workers is set without a pipelined
+    "stack" scan, when asynchronous is set with a focus_mode other than "stack" or with adaptive_settle,
+    or when use_focus_map, path, fields, backlash_mm, use_survey, mosaic_pixel_size_um or slide_id is
+    set with asynchronous or pipelined.
     '''
+    x_travel_mm: float
+    y_travel_mm: float
+    n_fields_x: int
+    n_fields_y: int
+    n_z_stack: int
+    z_step_size: float
+    pipelined: bool = False
+    max_in_flight: int = 2
+    focus_mode: str = "stack"
+    asynchronous: bool = False
+    movement_sleep: float = 0.5
+    use_focus_map: bool = False
+    path: str = "serpentine"
+    fields: Optional[Sequence[Tuple[float, float]]] = None
+    backlash_mm: float = 0.0
+    use_survey: bool = False
+    mosaic_pixel_size_um: Optional[float] = None
+    edf_workers: int = 0
+    image_format: str = "png"
+    png_compression: int = 1
+    writer_workers: int = 2
+    adaptive_settle: bool = False
+    slide_id: Optional[str] = None
+    focus_index_path: str = focus_index.default_path
+    prior_max_age_h: float = 168.0
+    confirm_stack: int = 3
+    detection_workers: int = 0
+    cell_radius_px: float = 18.0
+
+    def __post_init__(self):
+        if self.n_fields_x < 1 or self.n_fields_y < 1 or self.n_z_stack < 1:
+            raise ValueError("A scan needs at least one field in each direction and one image per field.")
+        if self.focus_mode not in focus_modes:
+            raise ValueError(f"Unknown focus mode {self.focus_mode}, expected one of {list(focus_modes)}.")
+        if self.path not in path_planner.orders:
+            raise ValueError(f"Unknown field order {self.path}, expected one of {list(path_planner.orders)}.")
+        if self.image_format not in image_writer.formats:
+            raise ValueError(f"Unknown image format {self.image_format}, expected one of {list(image_writer.formats)}.")
+
+        if self.edf_workers and (not self.pipelined or self.asynchronous or self.focus_mode != "stack"):
+            raise ValueError("Extended depth of field fusion is only supported by pipelined stack scans.")
+        if self.asynchronous and self.focus_mode != "stack":
+            raise ValueError("Asynchronous scans only support the stack focus mode.")
+        if self.asynchronous and self.adaptive_settle:
+            raise ValueError("Asynchronous scans do not support adaptive settling.")
+        if self.use_focus_map and (self.asynchronous or self.pipelined):
+            raise ValueError("Focus maps are only supported by sequential scans.")
+        if self.planned and (self.asynchronous or self.pipelined):
+            raise ValueError("Path planning is only supported by sequential scans.")
+        if self.slide_id is not None and (self.asynchronous or self.pipelined):
+            raise ValueError("Focus priors are only supported by sequential scans.")
+
+    @property
+    def planned(self) -> bool:
+        "Whether the scan images anything other than the grid in serpentine order."
+        return bool(
+            self.path != "serpentine" or self.fields is not None or self.backlash_mm or self.use_survey
+            or self.mosaic_pixel_size_um
+        )
+
+    @property
+    def resumable(self) -> bool:
+        "Whether the scan keeps a journal it can be resumed from."
+        # The container is only moved into place once a scan finishes, so a crash loses it.
+        return not self.asynchronous and self.image_format != "container"
+
+    def params(self) -> dict:
+        "The settings as the keyword arguments of ScanConfig, in a form which can be written as JSON."
+        params = asdict(self)
+        if self.fields is not None:
+            params["fields"] = [[float(x), float(y)] for x, y in self.fields]
+        return params
+
+
+def main(
+    config: Optional[ScanConfig] = None,
+    output_dir: str = "out",
+    port: Optional[str] = None,
+    trace_path: Optional[str] = None,
+    resume: bool = False,
+    widget: Optional[api.Widget] = None,
+    analysis_pool: Optional[Executor] = None,
+    write_executor: Optional[ThreadPoolExecutor] = None,
+    **settings
+) -> Path:
+    '''The main control loop for the widget.
+
+    Sequential and pipelined scans record their progress in a journal in the output directory, from
+    which they can be resumed.
+
+    :param config: the settings of the scan.
+    :param output_dir: the directory to write the best focused image of each field to.
+    :param port: the serial port of the stepper controller, or None for the widget's port.
+    :param trace_path: record how long each phase of the scan takes and write a Chrome trace, which
+    Perfetto opens, to this file, then print a summary of the phases. None to not trace.
+    :param resume: continue the interrupted scan in output_dir from its journal instead of starting a
+    new scan in a new directory. The settings must match the interrupted scan's, see resume.
+    :param widget: the widget to scan with, or None for the current widget, see api.using. The api
+    functions act on it in the calling thread for the duration of the scan.
+    :param analysis_pool: an executor, such as a process pool shared with other scans, to score the
+    z-stacks of a pipelined scan on. None to score them on the pipeline's analysis thread, and the only
+    choice for other scans, which score their z-stacks on the thread driving the stage.
+    :param write_executor: a thread pool shared with other scans to write images on instead of
+    writer_workers threads of this scan's own.
+    :param settings: fields of ScanConfig, which replace those of config, or make up the whole of it
+    when config is None.
+    :returns: the directory the images were written to.
+    :raises ValueError: when the settings are not a valid ScanConfig, when resume is set for a scan
+    which is not resumable, or when analysis_pool is given without pipelined.
+    '''
+    config = replace(config, **settings) if config is not None else ScanConfig(**settings)
+
+    # Drive the given widget from this thread for the whole scan.
+    if widget is not None:
+        with api.using(widget):
+            return main(
+                config, output_dir, port, trace_path, resume, None, analysis_pool, write_executor
+            )
+
+    if analysis_pool is not None and not config.pipelined:
+        raise ValueError("Only pipelined scans score their z-stacks on an analysis pool.")
+    if resume and not config.resumable:
+        raise ValueError("Only sequential and pipelined scans which write one file per image can be resumed.")
+
+    state = journal.read(Path(output_dir) / journal.file_name) if resume else None
 
     #_user_setup()
-    best_focused = 2
+
+    if trace_path is not None:
+        tracing.enable()
 
     print("Initializing camera module...")
-    #api.camera_controller_init()
+    api.camera_controller_init()
     print("Camera module initialized successfully!\n")
 
     print("Initializing stepper controller...")
-    api.stepper_controller_init()
+    position = None
+    if state is not None:
+        # Re-home from where the interrupted scan left the stage.
+        if state.position is None:
+            print("The journal does not record where the stage stopped, assuming it is at the start.")
+        position = state.position
+    api.stepper_controller_init(port, position)
     print("Stepper controller initialized successfully!\n")
 
-    # Create the output directory for images after everything has successfully initialized.
-    # Sets output_dir in case the directory already existed so _create_out_dir changed the name.
-    #output_dir = _create_out_dir(output_dir)
+    done = {}
+    if state is not None:
+        output_dir = Path(output_dir)
+        # Fields whose image has gone missing are imaged again.
+        done = {key: record for key, record in state.done.items() if (output_dir / record.file).exists()}
+        print(f"Resuming the scan in {output_dir}.")
+    else:
+        # Create the output directory for images after everything has successfully initialized.
+        # Sets output_dir in case the directory already existed so _create_out_dir changed the name.
+        output_dir = _create_out_dir(output_dir)
+    last = next(reversed(done.values()), None)
+
+    # Asynchronous scans cannot be resumed, so they keep no journal.
+    scan_journal = None if config.asynchronous else journal.ScanJournal(output_dir / journal.file_name)
+    if scan_journal is not None:
+        scan_journal.start(config.params(), resumed=state is not None)
 
     print("Beginning imaging.")
 
-    x_step_mm = x_travel_mm / n_fields_x
-    y_step_mm = y_travel_mm / n_fields_y
-
-    y_direction = 1
-    for i in range(n_fields_x):
-        for j in range(n_fields_y):
-            images = _take_z_stack(n_z_stack, z_step_size)
-            #_, best_focused = api.analyze_z_stack(images)
-
-            # Move the microscope to the best focused position
-            assert(z_step_size * ((n_z_stack - 1) / 2.0 - best_focused) == 0)
-            api.move_fine_focus(z_step_size * ((n_z_stack - 1) / 2.0 - best_focused))
-            #cv2.imwrite(str(output_dir / f"field_{i}_{j}.png"), images[best_focused])
-
-            # Step one position
-            api.move_y_axis(y_step_mm * y_direction)
-
-        # Change directions in y.
-        y_direction *= -1
+    x_step_mm = config.x_travel_mm / config.n_fields_x
+    y_step_mm = config.y_travel_mm / config.n_fields_y
+
+    # Images are taken from the stream while adaptive settling is on, since take_image cannot be
+    # called while a stream is running.
+    stream = api.start_camera_stream() if config.adaptive_settle else contextlib.nullcontext()
+    settle_detector = settle.SettleDetector(stream) if config.adaptive_settle else None
+
+    index = focus_index.FocusIndex(config.focus_index_path) if config.slide_id is not None else None
+
+    # Every image is on disk, and recorded in the journal and focus index, once the writer closes. The
+    # detector closes first, since its crops are written by the writer.
+    with scan_journal or contextlib.nullcontext(), index or contextlib.nullcontext(), stream, \
+            image_writer.ImageWriter(
+                output_dir, config.image_format, config.png_compression, config.writer_workers,
+                executor=write_executor
+            ) as writer, \
+            detection.Detector(
+                output_dir, writer, config.detection_workers,
+                params=detection.DetectionParams(config.cell_radius_px)
+            ) if config.detection_workers else contextlib.nullcontext() as detector:
+        try:
+            if config.asynchronous:
+                asyncio.run(
+                    _scan_async(
+                        writer, x_step_mm, y_step_mm, config.n_fields_x, config.n_fields_y, config.n_z_stack,
+                        config.z_step_size, config.movement_sleep, detector
+                    )
+                )
+            elif config.pipelined:
+                _scan_pipelined(
+                    writer, x_step_mm, y_step_mm, config.n_fields_x, config.n_fields_y, config.n_z_stack,
+                    config.z_step_size, config.focus_mode, config.movement_sleep, config.max_in_flight,
+                    config.edf_workers, settle_detector, scan_journal, done,
+                    last.focus if last is not None else 0.0, analysis_pool, detector
+                )
+            else:
+                _scan_planned(
+                    writer, output_dir, config.x_travel_mm, config.y_travel_mm, config.n_fields_x,
+                    config.n_fields_y, config.n_z_stack, config.z_step_size, config.focus_mode,
+                    config.movement_sleep, config.use_focus_map, config.path, config.fields, config.backlash_mm,
+                    config.use_survey, config.mosaic_pixel_size_um, settle_detector, scan_journal, done, state,
+                    index, config.slide_id, config.prior_max_age_h * 3600, config.confirm_stack, detector
+                )
+
+            # Send any move still queued, such as the return to the centre of the last z-stack.
+            api.flush_moves()
+        except BaseException as e:
+            # Record where the stage was left so a resumed scan can re-home from there.
+            if scan_journal is not None:
+                scan_journal.stopped(api.get_position(), e)
+            raise
 
-        # Step over one position
-        api.move_x_axis(x_step_mm)
+    print(f"Imaging complete. Files written to {output_dir}.")
+    if detector is not None:
+        summary = detector.summary
+        print(
+            f"Found {summary.n_infected} infected of {summary.n_cells} red blood cells in {summary.n_fields} "
+            f"fields, a parasitemia of {100 * summary.parasitemia:.2f}%."
+        )
+
+    if trace_path is not None:
+        tracing.disable()
+        tracing.export_chrome(Path(trace_path))
+        tracing.print_summary()
+    return output_dir
+
+
+def resume(
+    output_dir: str,
+    port: Optional[str] = None,
+    trace_path: Optional[str] = None,
+    widget: Optional[api.Widget] = None,
+    analysis_pool: Optional[Executor] = None,
+    write_executor: Optional[ThreadPoolExecutor] = None
+) -> Path:
+    '''Continue a sequential or pipelined scan which stopped before finishing, such as on a serial
+    timeout or camera error.
+
+    The scan's settings are read back from the journal in its output directory. The stage is re-homed
+    from the position the journal last recorded, the fields already written are skipped, and the rest
+    are imaged into the same directory.
+
+    :param output_dir: the output directory of the interrupted scan.
+    :param port: the serial port of the stepper controller, or None for the widget's port.
+    :param trace_path: see main.
+    :param widget: see main.
+    :param analysis_pool: see main.
+    :param write_executor: see main.
+    :returns: the directory the images were written to.
+    '''
+    state = journal.read(Path(output_dir) / journal.file_name)
+    return main(
+        ScanConfig(**state.params), output_dir, port, trace_path, True, widget, analysis_pool, write_executor
+    )
 
-    # Return to home position.
-    api.move_x_axis(-x_travel_mm)
 
-    print(f"Imaging complete. Files written to {output_dir}.")
+def _parser() -> argparse.ArgumentParser:
+    '''The command line of planner.py, with a flag for each field of ScanConfig.'''
+    defaults = ScanConfig(10, 10, 2, 10, 5, 9)
+    parser = argparse.ArgumentParser(description="Image a slide with the widget.")
+    parser.add_argument("--resume", metavar="OUTPUT_DIR", help="Continue the interrupted scan in this directory.")
+    parser.add_argument("--port", help="The serial port of the stepper controller.")
+    parser.add_argument("--output-dir", default="out", help="The directory to write the images to.")
+    parser.add_argument("--trace", help="Write a Chrome trace of the scan to this file.")
+
+    grid = parser.add_argument_group("grid")
+    grid.add_argument("--x-travel", type=float, default=defaults.x_travel_mm, help="Distance to scan in x in mm.")
+    grid.add_argument("--y-travel", type=float, default=defaults.y_travel_mm, help="Distance to scan in y in mm.")
+    grid.add_argument("--fields-x", type=int, default=defaults.n_fields_x)
+    grid.add_argument("--fields-y", type=int, default=defaults.n_fields_y)
+    grid.add_argument("--n-z-stack", type=int, default=defaults.n_z_stack, help="Images per z-stack.")
+    grid.add_argument("--z-step-size", type=float, default=defaults.z_step_size, help="Degrees per z-step.")
+
+    mode = parser.add_argument_group("mode")
+    mode.add_argument("--pipelined", action="store_true", help="Analyze and write while the stage moves on.")
+    mode.add_argument("--max-in-flight", type=int, default=defaults.max_in_flight)
+    mode.add_argument("--asynchronous", action="store_true", help="Drive the stage with the asyncio API.")
+    mode.add_argument("--focus-mode", default=defaults.focus_mode, choices=focus_modes)
+    mode.add_argument("--movement-sleep", type=float, default=defaults.movement_sleep)
+    mode.add_argument("--adaptive-settle", action="store_true", help="Take images once the stage stops moving.")
+    mode.add_argument("--focus-map", action="store_true", help="Predict each field's focus from the others.")
+
+    path = parser.add_argument_group("path")
+    path.add_argument("--path", default=defaults.path, choices=path_planner.orders)
+    path.add_argument("--backlash-mm", type=float, default=defaults.backlash_mm)
+    path.add_argument("--survey", action="store_true", help="Skip fields without a thin film.")
+    path.add_argument("--mosaic-pixel-size", type=float, metavar="UM",
+                      help="Stitch the fields into a mosaic, with image pixels this many micrometres across.")
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--edf-workers", type=int, default=defaults.edf_workers,
+                        help="Fuse z-stacks into all-in-focus images with this many threads.")
+    output.add_argument("--image-format", default=defaults.image_format, choices=image_writer.formats)
+    output.add_argument("--png-compression", type=int, default=defaults.png_compression)
+    output.add_argument("--writer-workers", type=int, default=defaults.writer_workers)
+    output.add_argument("--detection-workers", type=int, default=defaults.detection_workers,
+                        help="Count cells and parasites with this many threads.")
+    output.add_argument("--cell-radius", type=float, default=defaults.cell_radius_px, help="In image pixels.")
+
+    priors = parser.add_argument_group("focus priors")
+    priors.add_argument("--slide-id", help="Reuse and record each field's focus in the focus index under this ID.")
+    priors.add_argument("--focus-index", default=defaults.focus_index_path, help="The focus index file.")
+    priors.add_argument("--prior-max-age-h", type=float, default=defaults.prior_max_age_h)
+    priors.add_argument("--confirm-stack", type=int, default=defaults.confirm_stack)
+    return parser
+
+
+def _config(args: argparse.Namespace) -> ScanConfig:
+    '''Make the ScanConfig given on the command line.'''
+    return ScanConfig(
+        x_travel_mm=args.x_travel,
+        y_travel_mm=args.y_travel,
+        n_fields_x=args.fields_x,
+        n_fields_y=args.fields_y,
+        n_z_stack=args.n_z_stack,
+        z_step_size=args.z_step_size,
+        pipelined=args.pipelined,
+        max_in_flight=args.max_in_flight,
+        focus_mode=args.focus_mode,
+        asynchronous=args.asynchronous,
+        movement_sleep=args.movement_sleep,
+        use_focus_map=args.focus_map,
+        path=args.path,
+        backlash_mm=args.backlash_mm,
+        use_survey=args.survey,
+        mosaic_pixel_size_um=args.mosaic_pixel_size,
+        edf_workers=args.edf_workers,
+        image_format=args.image_format,
+        png_compression=args.png_compression,
+        writer_workers=args.writer_workers,
+        adaptive_settle=args.adaptive_settle,
+        slide_id=args.slide_id,
+        focus_index_path=args.focus_index,
+        prior_max_age_h=args.prior_max_age_h,
+        confirm_stack=args.confirm_stack,
+        detection_workers=args.detection_workers,
+        cell_radius_px=args.cell_radius,
+    )
 
 
 if __name__ == "__main__":
-    main(
-        x_travel_mm=10,
-        y_travel_mm=10,
-        n_fields_x=2,
-        n_fields_y=10,
-        n_z_stack=5,
-        z_step_size=9,
-        output_dir="out"
-    )
+    parser = _parser()
+    args = parser.parse_args()
+
+    if args.resume is not None:
+        resume(args.resume, args.port, args.trace)
+    else:
+        try:
+            config = _config(args)
+        except ValueError as e:
+            parser.error(str(e))
+        main(config, args.output_dir, args.port, args.trace)
@@ -0,0 +1,444 @@
+'''
+    Batch z-stack re-analysis for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import json
+import os
+import re
+import struct
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+import cv2
+import detection
+import image_processing
+import journal
+import jsonl
+
+# Suffixes of the image files of a stack stored as a directory with one image per plane.
+image_suffixes = {".png", ".tif", ".tiff", ".jpg", ".jpeg", ".bmp"}
+
+# The name of each plane of a stack stored as a directory: a prefix shared by every plane, then the
+# plane's number, such as z_0.png, z_1.png, ...
+plane_pattern = re.compile(r"(.*?)(\d+)")
+
+# Names of the images planner.py writes of each field, which mark a scan's output directory.
+_field_pattern = re.compile(r"field_\d+_\d+")
+
+# Suffix added to the results file's name for the log of stacks analyzed so far.
+progress_suffix = ".progress.jsonl"
+
+# Seconds between progress reports.
+report_interval = 2.0
+
+# Planes of a stack converted to float32 at once for the focus metric, so a worker never holds a
+# float32 copy of a whole memory-mapped stack, see image_processing.chunked_metric.
+default_chunk_size = 4
+
+
+@dataclass(frozen=True)
+class StackRef:
+    '''Where to read one z-stack from.
+
+    :param name: the name of the stack, its path relative to the root it was found under.
+    :param path: the .npy file, .npz file or directory of images holding the stack.
+    :param member: the name of the array in an .npz file, or "" otherwise.
+    '''
+    name: str
+    path: Path
+    member: str = ""
+
+
+@dataclass
+class StackResult:
+    '''The analysis of one z-stack, in the form of image_processing.analyze_z_stack.
+
+    :param name: the name of the stack.
+    :param index: the index of the most in focus image.
+    :param ranks: the rank of each image, with 0 the most in focus.
+    :param metrics: the focus metric of each image.
+    :param pixels: the number of pixels in the stack.
+    '''
+    name: str
+    index: int
+    ranks: List[int]
+    metrics: List[float]
+    pixels: int = 0
+
+
+def find_stacks(root: Path) -> Iterator[StackRef]:
+    '''Find every z-stack under a directory.
+
+    A stack is an .npy file of an (N, H, W) greyscale or (N, H, W, 3) RGB array with at least two
+    planes, an array of that shape in an .npz file, or a directory holding one image file per plane
+    named after plane_pattern and numbered in sequence. Anything else, such as single images, mosaic
+    levels and the output directories of scans, is skipped with the reason printed.
+
+    :param root: the directory to search.
+    :returns: the stacks, directory by directory in name order.
+    '''
+    root = Path(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        directory = Path(dirpath)
+        if _is_scan_output(filenames):
+            # The images of a scan are of different fields, and the arrays beside them are crops and mosaics.
+            print(f"Skipping {directory}: it is the output directory of a scan, not a z-stack.")
+            dirnames.clear()
+            continue
+
+        planes = [f for f in filenames if Path(f).suffix.lower() in image_suffixes]
+        if planes:
+            problem = _plane_names_problem(planes)
+            if problem is None:
+                name = directory.relative_to(root).as_posix()
+                yield StackRef(root.name if name == "." else name, directory)
+            else:
+                print(f"Skipping the images in {directory}: {problem}.")
+
+        for filename in sorted(filenames):
+            path = directory / filename
+            name = path.relative_to(root).with_suffix("").as_posix()
+            if path.suffix == ".npy":
+                with open(path, "rb") as f:
+                    problem = _array_problem(f)
+                if problem is None:
+                    yield StackRef(name, path)
+                else:
+                    print(f"Skipping {path}: {problem}.")
+            elif path.suffix == ".npz":
+                with zipfile.ZipFile(path) as container:
+                    for member in sorted(container.namelist()):
+                        if not member.endswith(".npy"):
+                            continue
+                        with container.open(member) as f:
+                            problem = _array_problem(f)
+                        if problem is None:
+                            yield StackRef(f"{name}/{member[:-4]}", path, member[:-4])
+                        else:
+                            print(f"Skipping {member[:-4]} in {path}: {problem}.")
+
+
+def _is_scan_output(filenames: List[str]) -> bool:
+    return journal.file_name in filenames or detection.file_name in filenames or any(
+        _field_pattern.fullmatch(Path(f).stem) for f in filenames
+    )
+
+
+def _plane_names_problem(planes: List[str]) -> Optional[str]:
+    '''Why image files are not the planes of one z-stack, or None if they are.'''
+    if len(planes) < 2:
+        return "a z-stack needs at least two planes"
+    matches = [plane_pattern.fullmatch(Path(f).stem) for f in planes]
+    if not all(matches):
+        return "not every image is named with its plane number"
+    if len({(m.group(1), Path(f).suffix.lower()) for m, f in zip(matches, planes)}) > 1:
+        return "the images do not share one name and format"
+    numbers = sorted(int(m.group(2)) for m in matches)
+    if numbers != list(range(numbers[0], numbers[0] + len(numbers))):
+        return "the plane numbers are not in sequence"
+    return None
+
+
+def _read_npy_header(f) -> tuple:
+    '''Read the header of the .npy data at the position of f.
+
+    :returns: the shape, whether it is in Fortran order and the dtype of the array, leaving f at its data.
+    '''
+    if np.lib.format.read_magic(f) == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def _array_problem(f) -> Optional[str]:
+    '''Why the .npy data at the position of f is not a z-stack, or None if it is.'''
+    try:
+        shape, _, dtype = _read_npy_header(f)
+    except ValueError as e:
+        return f"it is not a readable .npy array ({e})"
+    if not (len(shape) == 3 or (len(shape) == 4 and shape[-1] == 3)):
+        return f"its shape {shape} is not (N, H, W) or (N, H, W, 3)"
+    if len(shape) == 3 and shape[-1] in (3, 4):
+        return f"its shape {shape} is a single colour image"
+    if shape[0] < 2:
+        return "a z-stack needs at least two planes"
+    if not (np.issubdtype(dtype, np.integer) or np.issubdtype(dtype, np.floating)):
+        return f"its dtype {dtype} is not numeric"
+    return None
+
+
+def read_stack(stack: StackRef) -> np.ndarray:
+    '''Read a z-stack, memory-mapping it where the file format allows.
+
+    .npy files and the arrays of uncompressed .npz files, such as those np.savez writes, are
+    memory-mapped so only the pages the focus metric touches are read.
+    Compressed arrays are decompressed and the planes of image directories are decoded straight to
+    greyscale.
+
+    :param stack: the stack.
+    :returns: an (N, H, W) greyscale or (N, H, W, 3) RGB array.
+    :raises OSError: when the stack cannot be read.
+    '''
+    if stack.path.is_dir():
+        planes = sorted(
+            (p for p in stack.path.iterdir() if p.suffix.lower() in image_suffixes), key=_natural_key
+        )
+        images = [cv2.imread(str(p), cv2.IMREAD_GRAYSCALE) for p in planes]
+        if any(image is None for image in images):
+            raise OSError(f"Could not read every image in {stack.path}.")
+        return np.stack(images)
+
+    if not stack.member:
+        return np.load(stack.path, mmap_mode="r")
+
+    with zipfile.ZipFile(stack.path) as container:
+        info = container.getinfo(stack.member + ".npy")
+        if info.compress_type != zipfile.ZIP_STORED:
+            with container.open(info) as f:
+                return np.lib.format.read_array(f)
+
+    # The member is stored as is, so its .npy data can be mapped at its offset in the container.
+    with open(stack.path, "rb") as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        shape, fortran_order, dtype = _read_npy_header(f)
+        offset = f.tell()
+    return np.memmap(stack.path, dtype, "r", offset, shape, "F" if fortran_order else "C")
+
+
+def _natural_key(path: Path) -> list:
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path.name)]
+
+
+def _init_worker() -> None:
+    # One OpenCV thread per process so the pool, not OpenCV, spreads the work over the cores.
+    cv2.setNumThreads(1)
+
+
+def analyze(
+    stack: StackRef,
+    algorithm: str = "normed_var",
+    roi: Optional[image_processing.Roi] = None,
+    downsample: int = 1,
+    chunk_size: Optional[int] = default_chunk_size
+) -> StackResult:
+    '''Read and analyze one z-stack.
+
+    :param stack: the stack.
+    :param algorithm: the name of the focus metric in image_processing.algorithms.
+    :param roi: an optional (x, y, width, height) region of each image to use.
+    :param downsample: use every downsample-th pixel in each direction.
+    :param chunk_size: the number of planes to calculate the metric of at once, or None for every plane.
+    :returns: the analysis of the stack.
+    '''
+    images = read_stack(stack)
+    if images.ndim not in (3, 4) or (images.ndim == 3 and images.shape[-1] in (3, 4)):
+        raise ValueError(f"{stack.name} has shape {images.shape}, which is not a z-stack.")
+    from_rgb = images.ndim == 4
+    index, ranks, metrics = image_processing.analyze_z_stack(
+        images, algorithm, from_rgb, roi, downsample, chunk_size
+    )
+    return StackResult(
+        stack.name, int(index), ranks.tolist(), metrics.tolist(), int(np.prod(images.shape[:3]))
+    )
+
+
+def _read_progress(path: Path, params: dict) -> Dict[str, StackResult]:
+    done = {}
+    if not path.exists():
+        return done
+
+    with open(path, encoding="utf-8") as f:
+        try:
+            header = json.loads(f.readline())
+        except json.JSONDecodeError:
+            header = None
+        if header is not None:
+            if header != params:
+                raise ValueError(
+                    f"{path} was written with {header}, not {params}. Choose another results file."
+                )
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn line left by an interrupted run.
+                    continue
+                done[entry["name"]] = StackResult(**entry)
+
+    if header is None:
+        # The run which started the log stopped while writing its settings, so none of the results in
+        # it can be checked against params. Start the log again, so run writes the settings first.
+        print(f"{path} does not start with the settings it was written with, analyzing every stack again.")
+        path.unlink()
+    return done
+
+
+def _write_results(path: Path, results: Dict[str, StackResult], params: dict) -> None:
+    names = sorted(results)
+    depth = max((len(results[name].metrics) for name in names), default=0)
+    metrics = np.full((len(names), depth), np.nan, dtype=np.float32)
+    ranks = np.full((len(names), depth), -1, dtype=np.int32)
+    for row, name in enumerate(names):
+        result = results[name]
+        metrics[row, :len(result.metrics)] = result.metrics
+        ranks[row, :len(result.ranks)] = result.ranks
+
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        np.savez(
+            f,
+            name=np.array(names, dtype=str),
+            n_images=np.array([len(results[name].metrics) for name in names], dtype=np.int32),
+            index=np.array([results[name].index for name in names], dtype=np.int32),
+            ranks=ranks,
+            metrics=metrics,
+            params=np.array(json.dumps(params)),
+        )
+    os.replace(tmp, path)
+
+
+def run(
+    root: Path,
+    results_path: Optional[Path] = None,
+    algorithm: str = "normed_var",
+    roi: Optional[image_processing.Roi] = None,
+    downsample: int = 1,
+    workers: Optional[int] = None,
+    chunk_size: Optional[int] = default_chunk_size
+) -> Path:
+    '''Re-analyze every z-stack under a directory on a pool of processes.
+
+    Each worker reads its own stacks, see read_stack, so no image data passes between processes. Each
+    finished stack is appended to a progress log next to the results file, and stacks already in the
+    log are skipped, so an interrupted run continues where it stopped when run again. Once every stack
+    is analyzed, the results of all of them are written to one .npz file with a column per quantity:
+    name, n_images, index, and ranks and metrics padded to the deepest stack with -1 and NaN.
+
+    :param root: the directory to search for stacks, see find_stacks.
+    :param results_path: the results file, by default <root>_focus_<algorithm>.npz next to root.
+    :param algorithm: the name of the focus metric in image_processing.algorithms.
+    :param roi: an optional (x, y, width, height) region of each image to use.
+    :param downsample: use every downsample-th pixel in each direction.
+    :param workers: the number of processes, or None for one per CPU.
+    :param chunk_size: the number of planes each worker calculates the metric of at once, see analyze.
+    It does not change the results.
+    :returns: the results file.
+    '''
+    if algorithm not in image_processing.algorithms:
+        raise ValueError(f"Unknown focus metric {algorithm}, expected one of {list(image_processing.algorithms)}.")
+
+    root = Path(root)
+    if results_path is None:
+        results_path = root.with_name(f"{root.name}_focus_{algorithm}.npz")
+    results_path = Path(results_path)
+    progress_path = results_path.with_name(results_path.name + progress_suffix)
+    params = {"algorithm": algorithm, "roi": list(roi) if roi is not None else None, "downsample": downsample}
+
+    results = _read_progress(progress_path, params)
+    todo = [stack for stack in find_stacks(root) if stack.name not in results]
+    if results:
+        print(f"Resuming with {len(results)} stacks already analyzed.")
+    print(f"Analyzing {len(todo)} stacks.")
+
+    workers = workers or os.cpu_count() or 1
+    n_failed = 0
+    n_done = 0
+    pixels = 0
+    start = last_report = time.perf_counter()
+
+    with jsonl.open_for_append(progress_path) as log, \
+            ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        if log.tell() == 0:
+            log.write(json.dumps(params) + "\n")
+
+        # Keep a few stacks queued per worker rather than submitting every stack up front.
+        pending = {}
+        stacks = iter(todo)
+        while True:
+            while len(pending) < 2 * workers:
+                stack = next(stacks, None)
+                if stack is None:
+                    break
+                pending[pool.submit(analyze, stack, algorithm, roi, downsample, chunk_size)] = stack
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stack = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error analyzing {stack.name}. {e}")
+                    n_failed += 1
+                    continue
+                results[result.name] = result
+                log.write(json.dumps(result.__dict__) + "\n")
+                n_done += 1
+                pixels += result.pixels
+
+            now = time.perf_counter()
+            if now - last_report >= report_interval or not pending:
+                log.flush()
+                os.fsync(log.fileno())
+                elapsed = now - start
+                print(
+                    f"{n_done + n_failed}/{len(todo)} stacks, {n_done / elapsed:.1f} stacks/s, "
+                    f"{pixels / elapsed / 1e6:.1f} MPix/s"
+                )
+                last_report = now
+
+    _write_results(results_path, results, params)
+    if n_failed:
+        print(f"{n_failed} stacks could not be analyzed, run again to retry them.")
+    print(f"Results for {len(results)} stacks written to {results_path}.")
+    return results_path
+
+
+def read_results(path: Path) -> Dict[str, np.ndarray]:
+    '''Read a results file written by run.
+
+    :param path: the results file.
+    :returns: its columns by name, with params parsed to a dict.
+    '''
+    with np.load(path) as f:
+        columns = {name: f[name] for name in f.files}
+    columns["params"] = json.loads(str(columns["params"]))
+    return columns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-analyze every z-stack under a directory.")
+    parser.add_argument("root", help="A directory of .npy stacks, .npz archives of stacks or image directories.")
+    parser.add_argument("--results", help="The results file, <root>_focus_<algorithm>.npz by default.")
+    parser.add_argument("--algorithm", default="normed_var", choices=list(image_processing.algorithms))
+    parser.add_argument("--roi", type=int, nargs=4, metavar=("X", "Y", "W", "H"))
+    parser.add_argument("--downsample", type=int, default=1)
+    parser.add_argument("--workers", type=int, help="Processes to analyze with, one per CPU by default.")
+    parser.add_argument("--chunk-size", type=int, default=default_chunk_size,
+                        help="Planes per stack converted to float32 at once.")
+    args = parser.parse_args()
+
+    run(Path(args.root), args.results, args.algorithm, args.roi, args.downsample, args.workers, args.chunk_size)
@@ -0,0 +1,113 @@
+'''
+    Adaptive settle detection for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import time
+from typing import Tuple
+import numpy as np
+import api
+import cameras
+import image_processing
+import tracing
+
+
+def frame_motion(previous: np.ndarray, current: np.ndarray) -> float:
+    '''Measure how much the scene changed between two frames.
+
+    :param previous: a greyscale thumbnail of the earlier frame.
+    :param current: a greyscale thumbnail of the later frame, with the same shape.
+    :returns: the mean absolute difference between the frames relative to their mean brightness.
+    '''
+    a = previous.astype(np.float32)
+    b = current.astype(np.float32)
+    return float(np.abs(b - a).mean() / max(float(a.mean()), 1.0))
+
+
+class SettleDetector:
+    '''Waits for the stage to stop vibrating after a move by watching a camera stream.
+
+    Instead of sleeping for a fixed time, consecutive frames are shrunk to thumbnails and compared, and
+    the stage counts as settled once they differ by less than threshold. Frames finished before the
+    move did are never compared, and the frame being exposed when it finished is only compared with the
+    one after it, which is returned if they match. The settled frame is returned so it can be used as
+    the capture, since take_image cannot be called while streaming.
+
+    Every wait takes at least two new frames. The camera streams frames back to back, during moves too,
+    so a scan with a SettleDetector snaps several times as many frames per field as one sleeping for a
+    fixed time. Only the time per field is comparable between the two, and it is shorter whenever the
+    stage settles before the fixed sleep would have ended.
+    '''
+
+    def __init__(
+        self,
+        stream: cameras.CameraStream,
+        threshold: float = 0.005,
+        timeout_s: float = 1.5,
+        downsample: int = 8,
+        from_rgb=True
+    ):
+        '''
+        :param stream: the running camera stream to watch.
+        :param threshold: the frame_motion below which the stage counts as settled. It should sit
+        above the change sensor noise alone causes.
+        :param timeout_s: the longest to wait before giving up and returning the latest frame.
+        :param downsample: the factor to shrink each side of the frames by before comparing them.
+        :param from_rgb: whether the frames are RGB.
+        '''
+        self.stream = stream
+        self.threshold = threshold
+        self.timeout_s = timeout_s
+        self.downsample = downsample
+        self.from_rgb = from_rgb
+        self.n_timeouts = 0
+
+    def wait(self) -> Tuple[api.OpenCVImage, float, bool]:
+        '''Send any queued moves, then wait for the stage to settle after the move which has just finished.
+
+        :returns: a copy of the first frame taken once settled, how long the wait took in seconds, and
+        whether the stage settled before the timeout. On timeout the frame is the latest one.
+        '''
+        api.flush_moves()
+        start = time.perf_counter()
+        deadline = start + self.timeout_s
+
+        with tracing.span("settle"):
+            seq, _ = self.stream.latest()
+            # Start from the frame in progress when the move finished, not the last finished one.
+            seq, frame = self.stream.wait_for(seq, self.timeout_s)
+            previous = None
+            while frame is not None:
+                # Copy first, the ring slot is reused once the stream wraps around.
+                frame = frame.copy()
+                current = image_processing.thumbnail(frame, self.downsample, self.from_rgb)
+                if previous is not None and frame_motion(previous, current) < self.threshold:
+                    return frame, time.perf_counter() - start, True
+
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                previous = current
+                seq, next_frame = self.stream.wait_for(seq, remaining)
+                if next_frame is None:
+                    break
+                frame = next_frame
+
+        self.n_timeouts += 1
+        tracing.count("settle_timeouts")
+        if frame is None:
+            raise RuntimeError("Camera stream produced no frames while waiting for the stage to settle.")
+        return frame, time.perf_counter() - start, False
@@ -0,0 +1,435 @@
+'''
+    Hardware simulator for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import tty
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import cv2
+import api
+import cameras
+import detection
+import focus_index
+import planner
+import synthetic
+
+
+class SimulatedStage:
+    '''A virtual stepper controller which speaks the microcontroller/code.py serial protocol over a pty.
+
+    Pass port to api.Widget to use it in place of the microscope. Moves take as long as
+    the motion profile of the moving axes would on the real widget, multiplied by time_scale.
+    '''
+
+    def __init__(self, time_scale: float = 1.0):
+        '''
+        :param time_scale: the factor to multiply the duration of every move by.
+        '''
+        self.time_scale = time_scale
+        self.profiles = dict(api.default_motion_profiles)
+        self.n_moves = 0
+        self.move_time = 0.0
+        # The steps of each axis of every move made, and the command of every version 2 frame received.
+        self.moves: List[Dict[str, int]] = []
+        self.frames: List[int] = []
+        # time.monotonic() when the last move finished.
+        self.last_move_end = 0.0
+
+        # Absolute position of each axis in full steps.
+        self._steps = {axis: 0 for axis in api.motor_axes}
+        self._axes = {axis_byte[0]: axis for axis, axis_byte in api.motor_axes.items()}
+        self._lock = threading.Lock()
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def position(self) -> Tuple[float, float, float]:
+        '''Return the current x and y position in mm and fine focus position in degrees.'''
+        with self._lock:
+            return (
+                self._steps["x"] * api.step_degrees * api.x_dist_factor,
+                self._steps["y"] * api.step_degrees * api.y_dist_factor,
+                self._steps["focus_fine"] * api.step_degrees,
+            )
+
+    def close(self) -> None:
+        '''Close the pty, which stops the simulated controller. Close the serial port using it first.'''
+        # Reads from the master fail once every handle on the slave is closed, which stops the thread.
+        # The master must stay open until then, or the thread could read from a file reusing its fd.
+        os.close(self._slave)
+        self._thread.join(timeout=1.0)
+        os.close(self._master)
+
+    def _read_exact(self, n: int) -> bytes:
+        data = b""
+        while len(data) < n:
+            chunk = os.read(self._master, n - len(data))
+            if not chunk:
+                raise OSError("pty closed")
+            data += chunk
+        return data
+
+    def _reply(self, command: int, status: int, payload: bytes = b"") -> None:
+        body = struct.pack(">BBHB", 2, command | api._reply_flag, len(payload) + 1, status) + payload
+        os.write(self._master, bytes([api._sync]) + body + bytes([api._checksum(body)]))
+
+    def _move(self, moves: Dict[str, int]) -> None:
+        '''Move axes together, taking as long as the slowest axis, and update the position at the end.'''
+        # Timed from the profiles this controller was sent, not those of whichever widget is current.
+        duration = max(
+            (api.move_time(steps, *self.profiles[axis][:2]) for axis, steps in moves.items()), default=0.0
+        )
+        time.sleep(duration * self.time_scale)
+        with self._lock:
+            for axis, steps in moves.items():
+                self._steps[axis] += steps
+            self.n_moves += 1
+            self.moves.append(dict(moves))
+            self.move_time += duration
+            self.last_move_end = time.monotonic()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                first = self._read_exact(1)[0]
+                if first == api._sync:
+                    self._handle_frame()
+                elif first in self._axes:
+                    direction, steps = self._read_exact(2)
+                    self._move({self._axes[first]: steps if direction else -steps})
+                    os.write(self._master, b"\x00")
+        except OSError:
+            return
+
+    def _handle_frame(self) -> None:
+        version, command, length = struct.unpack(">BBH", self._read_exact(4))
+        payload = self._read_exact(length)
+        check = self._read_exact(1)[0]
+        self.frames.append(command)
+        if api._checksum(struct.pack(">BBH", version, command, length) + payload) != check:
+            self._reply(command, 1)
+            return
+        if version != 2:
+            self._reply(command, 5)
+            return
+
+        if command == api._cmd_move_batch:
+            size = struct.calcsize(api._move_format)
+            if length % size:
+                self._reply(command, 4, struct.pack(">H", 0))
+                return
+            moves = [struct.unpack_from(api._move_format, payload, i) for i in range(0, length, size)]
+            if any(axis not in self._axes for axis, _, _ in moves):
+                self._reply(command, 3, struct.pack(">H", 0))
+                return
+            for axis, steps, dwell_ms in moves:
+                self._move({self._axes[axis]: steps})
+                time.sleep(dwell_ms / 1000)
+            self._reply(command, 0, struct.pack(">H", len(moves)))
+        elif command == api._cmd_set_profile:
+            if length != struct.calcsize(api._profile_format):
+                self._reply(command, 4)
+                return
+            axis, max_speed, accel, microsteps = struct.unpack(api._profile_format, payload)
+            if axis not in self._axes:
+                self._reply(command, 3)
+            elif max_speed == 0 or accel == 0 or microsteps == 0:
+                self._reply(command, 6)
+            else:
+                self.profiles[self._axes[axis]] = (max_speed, accel, microsteps)
+                self._reply(command, 0)
+        elif command == api._cmd_move_coordinated:
+            size = struct.calcsize(api._axis_move_format)
+            if length % size or length > size * len(self._axes):
+                self._reply(command, 4)
+                return
+            moves = [struct.unpack_from(api._axis_move_format, payload, i) for i in range(0, length, size)]
+            axes = [axis for axis, _ in moves]
+            if any(axis not in self._axes for axis in axes) or len(set(axes)) != len(axes):
+                self._reply(command, 3)
+                return
+            self._move({self._axes[axis]: steps for axis, steps in moves})
+            self._reply(command, 0)
+        else:
+            self._reply(command, 2)
+
+
+class SyntheticCamera(cameras.CameraBackend):
+    '''A virtual camera which images a synthetic slide on a SimulatedStage.
+
+    Pass it to api.Widget to use it in place of the microscope camera. Each image is the part of the
+    slide under the stage, blurred in proportion to the distance of the fine focus from a tilted focal
+    plane, with sensor noise added. Every image taken is remembered by its hash along with its
+    distance from focus, so the focus error of saved images can be measured afterwards.
+    '''
+
+    def __init__(
+        self,
+        stage: SimulatedStage,
+        slide: Optional[api.OpenCVImage] = None,
+        shape: Tuple[int, int] = (480, 640),
+        pixel_size_um: float = 1.0,
+        focal_plane: Tuple[float, float, float] = (0.0, 2.0, -1.0),
+        blur_per_degree: float = 0.2,
+        noise: float = 2.0,
+        exposure_s: float = 0.0,
+        settle_time_s: float = 0.0,
+        vibration_px: float = 6.0,
+        seed: int = 0
+    ):
+        '''
+        :param stage: the simulated stage the camera is mounted on.
+        :param slide: the RGB slide image, which tiles, or None to render one with synthetic.make_slide.
+        :param shape: the (height, width) of each image in pixels.
+        :param pixel_size_um: the size of a slide pixel in micrometres.
+        :param focal_plane: the best fine focus in degrees at the origin and its slope in degrees per
+        mm of x and of y.
+        :param blur_per_degree: the Gaussian blur sigma in pixels per degree of defocus.
+        :param noise: the standard deviation of the sensor noise in grey levels.
+        :param exposure_s: how long each snapshot takes in seconds.
+        :param settle_time_s: how long the stage vibrates after each move in seconds.
+        :param vibration_px: the initial amplitude of the vibration in pixels, which decays linearly
+        to nothing over settle_time_s.
+        :param seed: the random seed for the sensor noise.
+        '''
+        self.stage = stage
+        self.slide = synthetic.make_slide(seed=seed) if slide is None else slide
+        self.shape = shape
+        self.pixel_size_um = pixel_size_um
+        self.focal_plane = focal_plane
+        self.blur_per_degree = blur_per_degree
+        self.noise = noise
+        self.exposure_s = exposure_s
+        self.settle_time_s = settle_time_s
+        self.vibration_px = vibration_px
+        self.n_snapshots = 0
+        self.defocus: Dict[str, float] = {}
+        self._rng = np.random.default_rng(seed)
+
+    def best_focus(self, x_mm: float, y_mm: float) -> float:
+        '''Return the best fine focus position in degrees at a stage position.'''
+        z0, tilt_x, tilt_y = self.focal_plane
+        return z0 + tilt_x * x_mm + tilt_y * y_mm
+
+    def connect(self) -> None:
+        print("Connected to synthetic camera.")
+
+    def snapshot_into(self, out: Optional[api.OpenCVImage] = None) -> api.OpenCVImage:
+        x_mm, y_mm, focus = self.stage.position()
+        defocus = focus - self.best_focus(x_mm, y_mm)
+
+        # The stage shakes along x after a move.
+        shake = 0
+        since_move = time.monotonic() - self.stage.last_move_end
+        if since_move < self.settle_time_s:
+            amplitude = self.vibration_px * (1 - since_move / self.settle_time_s)
+            shake = int(round(amplitude * np.sin(2 * np.pi * 25 * since_move)))
+
+        h, w = self.shape
+        rows = (np.arange(h) + int(y_mm * 1000 / self.pixel_size_um)) % self.slide.shape[0]
+        cols = (np.arange(w) + int(x_mm * 1000 / self.pixel_size_um) + shake) % self.slide.shape[1]
+        image = self.slide[rows[:, np.newaxis], cols[np.newaxis, :]]
+
+        sigma = abs(defocus) * self.blur_per_degree
+        if sigma > 0.1:
+            image = cv2.GaussianBlur(image, (0, 0), sigma)
+        if self.noise > 0:
+            noisy = image + self._rng.normal(0, self.noise, image.shape).astype(np.float32)
+            image = np.clip(noisy, 0, 255).astype(np.uint8)
+
+        time.sleep(self.exposure_s)
+        self.n_snapshots += 1
+        self.defocus[_digest(image)] = defocus
+        if out is None:
+            return image
+        np.copyto(out, image)
+        return out
+
+    def focus_errors(self, output_dir: Path) -> Dict[str, float]:
+        '''Look up the defocus in degrees of every image written to an output directory.
+
+        :param output_dir: the directory of saved field images, in any image_writer format.
+        :returns: the defocus of each file or container member which matches an image taken by this camera.
+        '''
+        images = {}
+        for path in sorted(Path(output_dir).glob("*")):
+            if path.suffix in (".png", ".tiff"):
+                images[path.name] = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+            elif path.suffix == ".npy":
+                images[path.name] = np.load(path)
+            elif path.suffix == ".npz":
+                with np.load(path) as container:
+                    images.update((name, container[name]) for name in container.files)
+
+        errors = {}
+        for name, image in images.items():
+            digest = _digest(image)
+            if digest in self.defocus:
+                errors[name] = self.defocus[digest]
+        return errors
+
+
+def _digest(image: api.OpenCVImage) -> str:
+    return hashlib.blake2b(np.ascontiguousarray(image).tobytes(), digest_size=16).hexdigest()
+
+
+def run(
+    n_fields_x: int = 2,
+    n_fields_y: int = 5,
+    n_z_stack: int = 5,
+    z_step_size: float = 9,
+    output_dir: str = "sim_out",
+    time_scale: float = 1.0,
+    camera_kwargs: Optional[dict] = None,
+    **planner_kwargs
+) -> dict:
+    '''Run planner.main end to end against a simulated stage and camera.
+
+    :param n_fields_x: the number of fields to take in the x direction.
+    :param n_fields_y: the number of fields to take in the y direction.
+    :param n_z_stack: how many images in a z-stack to take per field.
+    :param z_step_size: the number of degrees to turn the fine focus knob per z-step.
+    :param output_dir: the directory to write the best focused images to.
+    :param time_scale: the factor to multiply the duration of every simulated move by.
+    :param camera_kwargs: keyword arguments for SyntheticCamera.
+    :param planner_kwargs: any other keyword arguments for planner.main.
+    :returns: a dict of throughput and focus accuracy results, and the detection totals when detecting.
+    With adaptive_settle, snapshots counts every frame the camera streamed, not just the images used,
+    so compare time_per_field_s with other runs instead.
+    '''
+    stage = SimulatedStage(time_scale)
+    camera = SyntheticCamera(stage, **(camera_kwargs or {}))
+    widget = api.Widget(stage.port, camera)
+
+    start = time.perf_counter()
+    try:
+        output_dir = planner.main(
+            x_travel_mm=1.0 * n_fields_x,
+            y_travel_mm=0.5 * n_fields_y,
+            n_fields_x=n_fields_x,
+            n_fields_y=n_fields_y,
+            n_z_stack=n_z_stack,
+            z_step_size=z_step_size,
+            output_dir=output_dir,
+            widget=widget,
+            **planner_kwargs
+        )
+    finally:
+        elapsed = time.perf_counter() - start
+        widget.stepper.close()
+        stage.close()
+
+    errors = np.array(list(camera.focus_errors(output_dir).values()))
+    n_fields = n_fields_x * n_fields_y
+    detections = {}
+    if (Path(output_dir) / detection.file_name).exists():
+        summary = detection.read(Path(output_dir) / detection.file_name)[0]
+        detections = {
+            "cells": summary.n_cells, "infected_cells": summary.n_infected, "parasitemia": summary.parasitemia
+        }
+    return {
+        "fields": n_fields,
+        "wall_time_s": elapsed,
+        "time_per_field_s": elapsed / n_fields,
+        "simulated_move_time_s": stage.move_time,
+        "moves": stage.n_moves,
+        "snapshots": camera.n_snapshots,
+        "snapshots_per_field": camera.n_snapshots / n_fields,
+        "fields_scored": int(errors.size),
+        "mean_abs_focus_error_deg": float(np.abs(errors).mean()) if errors.size else None,
+        "max_abs_focus_error_deg": float(np.abs(errors).max()) if errors.size else None,
+        **detections,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a scan against a simulated widget and report throughput.")
+    parser.add_argument("--fields-x", type=int, default=2)
+    parser.add_argument("--fields-y", type=int, default=5)
+    parser.add_argument("--n-z-stack", type=int, default=5)
+    parser.add_argument("--z-step-size", type=float, default=9)
+    parser.add_argument("--output-dir", default="sim_out")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Multiplies the duration of moves.")
+    parser.add_argument("--movement-sleep", type=float, default=0.5)
+    parser.add_argument("--focus-mode", default="stack", choices=["stack", "parabolic", "golden"])
+    parser.add_argument("--pipelined", action="store_true")
+    parser.add_argument("--asynchronous", action="store_true")
+    parser.add_argument("--focus-map", action="store_true")
+    parser.add_argument("--path", default="serpentine", choices=["serpentine", "optimized"])
+    parser.add_argument("--backlash-mm", type=float, default=0.0)
+    parser.add_argument("--survey", action="store_true")
+    parser.add_argument("--mosaic", action="store_true", help="Stitch the fields into a mosaic.")
+    parser.add_argument("--edf-workers", type=int, default=0, help="Fuse z-stacks with this many threads.")
+    parser.add_argument("--image-format", default="png", choices=["png", "tiff", "npy", "container"])
+    parser.add_argument("--png-compression", type=int, default=1)
+    parser.add_argument("--trace", help="Write a Chrome trace of the scan to this file.")
+    parser.add_argument("--settle-time", type=float, default=0.0, help="How long the stage vibrates after moves.")
+    parser.add_argument("--exposure", type=float, default=0.0, help="How long each snapshot takes.")
+    parser.add_argument("--adaptive-settle", action="store_true")
+    parser.add_argument("--slide-id", help="Reuse and record each field's focus in the focus index under this ID.")
+    parser.add_argument("--focus-index", default=focus_index.default_path, help="The focus index file.")
+    parser.add_argument("--detection-workers", type=int, default=0, help="Count cells and parasites with this many threads.")
+    parser.add_argument("--parasite-rate", type=float, default=0.02, help="Fraction of cells holding a parasite.")
+    parser.add_argument("--empty-fraction", type=float, default=0.0, help="Fraction of the slide left bare.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    results = run(
+        n_fields_x=args.fields_x,
+        n_fields_y=args.fields_y,
+        n_z_stack=args.n_z_stack,
+        z_step_size=args.z_step_size,
+        output_dir=args.output_dir,
+        time_scale=args.time_scale,
+        focus_mode=args.focus_mode,
+        pipelined=args.pipelined,
+        asynchronous=args.asynchronous,
+        movement_sleep=args.movement_sleep,
+        use_focus_map=args.focus_map,
+        path=args.path,
+        backlash_mm=args.backlash_mm,
+        use_survey=args.survey,
+        mosaic_pixel_size_um=1.0 if args.mosaic else None,
+        edf_workers=args.edf_workers,
+        image_format=args.image_format,
+        png_compression=args.png_compression,
+        trace_path=args.trace,
+        adaptive_settle=args.adaptive_settle,
+        slide_id=args.slide_id,
+        focus_index_path=args.focus_index,
+        detection_workers=args.detection_workers,
+        camera_kwargs={
+            "slide": synthetic.make_slide(parasite_rate=args.parasite_rate, empty_fraction=args.empty_fraction),
+            "settle_time_s": args.settle_time,
+            "exposure_s": args.exposure,
+        },
+    )
+    print(json.dumps(results, indent=4))
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=4))
@@ -0,0 +1,115 @@
+'''
+    Survey pre-pass for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import csv
+from dataclasses import dataclass
+from pathlib import Path
+from time import sleep
+from typing import List, Optional, Sequence
+import numpy as np
+import api
+import image_processing
+import path_planner
+import settle
+import tracing
+
+
+@dataclass
+class SurveyResult:
+    '''The occupancy of every surveyed field and whether it is worth imaging.
+
+    occupancy and passed are indexed like fields. background is the grey level taken as empty glass.
+    '''
+    fields: List[path_planner.FieldPosition]
+    occupancy: np.ndarray
+    passed: np.ndarray
+    background: float
+
+    @property
+    def kept(self) -> List[path_planner.FieldPosition]:
+        "The fields which passed, in the order they were given."
+        return [field for field, passed in zip(self.fields, self.passed) if passed]
+
+    def write_csv(self, path: Path) -> None:
+        '''Write the position, occupancy and pass/skip decision of every field to a CSV file.'''
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["i", "j", "x_mm", "y_mm", "occupancy", "passed"])
+            for field, occupancy, passed in zip(self.fields, self.occupancy, self.passed):
+                writer.writerow([field.i, field.j, field.x_mm, field.y_mm, f"{occupancy:.4f}", int(passed)])
+
+
+def run(
+    fields: Sequence[path_planner.FieldPosition],
+    downsample: int = 8,
+    contrast: float = 0.1,
+    min_occupancy: float = 0.05,
+    max_occupancy: float = 0.9,
+    movement_sleep: float = 0.0,
+    backlash_mm: float = 0.0,
+    settle_detector: Optional[settle.SettleDetector] = None
+) -> SurveyResult:
+    '''Take one quick image of every field at the current focus and decide which fields to image fully.
+
+    Fields are visited in travel-time order and the stage returns to the start afterwards. Field
+    positions are relative to the origin of api.move_to. Each image is
+    shrunk to a thumbnail as soon as it is taken, so the survey only holds thumbnails in memory. Most
+    fields of a smear show some glass between cells, so the background is the median over fields of
+    each thumbnail's bright level. Fields with too little sample are blank glass and fields with too
+    much are thick edge where cells overlap, and both are skipped.
+
+    :param fields: the fields to survey.
+    :param downsample: the factor to shrink each side of the images by before scoring.
+    :param contrast: how much darker than the background a pixel must be to count as sample.
+    :param min_occupancy: the smallest fraction of a field covered by sample to image it.
+    :param max_occupancy: the largest fraction of a field covered by sample to image it.
+    :param movement_sleep: how long to wait after each move to take an image in seconds.
+    :param backlash_mm: see path_planner.plan.
+    :param settle_detector: if given, wait for each move to settle with it and use its frames instead of
+    sleeping for movement_sleep and calling api.take_image.
+    :returns: the survey result.
+    '''
+    fields = list(fields)
+    plan = path_planner.plan(fields, "optimized", backlash_mm)
+    index = {id(field): k for k, field in enumerate(fields)}
+
+    thumbnails = None
+    for waypoint in plan.waypoints:
+        api.move_to(waypoint.x_mm, waypoint.y_mm)
+
+        if waypoint.field is None:
+            continue
+
+        if settle_detector is None:
+            with tracing.span("settle"):
+                sleep(movement_sleep)
+            image = api.take_image()
+        else:
+            image, _, _ = settle_detector.wait()
+        small = image_processing.thumbnail(image, downsample)
+        if thumbnails is None:
+            thumbnails = np.empty((len(fields),) + small.shape, dtype=small.dtype)
+        thumbnails[index[id(waypoint.field)]] = small
+
+    if thumbnails is None:
+        return SurveyResult(fields, np.zeros(0), np.zeros(0, dtype=bool), 0.0)
+
+    background = float(np.median(np.percentile(thumbnails, 95, axis=(1, 2))))
+    occupancy = image_processing.occupancy(thumbnails, background, contrast)
+    passed = (occupancy >= min_occupancy) & (occupancy <= max_occupancy)
+    return SurveyResult(fields, occupancy, passed, background)
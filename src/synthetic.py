@@ -0,0 +1,67 @@
+'''
+    Synthetic blood films for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# This module only depends on NumPy and OpenCV so slides can be rendered for benchmark.py on any
+# host, without the pty, serial port and camera stack simulator.py needs.
+import numpy as np
+import cv2
+
+
+def make_slide(
+    height: int = 2048,
+    width: int = 2048,
+    cell_radius: int = 18,
+    density: float = 0.6,
+    parasite_rate: float = 0.02,
+    empty_fraction: float = 0.0,
+    seed: int = 0
+) -> np.ndarray:
+    '''Render a synthetic thin blood film.
+
+    :param height: the height of the slide in pixels.
+    :param width: the width of the slide in pixels.
+    :param cell_radius: the mean red blood cell radius in pixels.
+    :param density: the approximate fraction of the slide covered by cells.
+    :param parasite_rate: the fraction of cells containing a stained parasite.
+    :param empty_fraction: the fraction of rows at the top of the slide left as bare glass.
+    :param seed: the random seed.
+    :returns: an (height, width, 3) uint8 RGB image which tiles seamlessly.
+    '''
+    rng = np.random.default_rng(seed)
+    slide = np.empty((height, width, 3), dtype=np.uint8)
+    slide[:] = (232, 222, 228)
+
+    top = int(empty_fraction * height)
+    n_cells = int(density * (height - top) * width / (np.pi * cell_radius ** 2))
+    for _ in range(n_cells):
+        x = int(rng.integers(width))
+        # Keep cells, including their wrapped copies, out of the bare rows.
+        y = int(rng.integers(top + cell_radius, height - cell_radius)) if top else int(rng.integers(height))
+        r = max(4, int(rng.normal(cell_radius, cell_radius / 8)))
+        # Draw wrapped copies so the slide tiles without seams.
+        for dx in (-width, 0, width):
+            for dy in (-height, 0, height):
+                centre = (x + dx, y + dy)
+                cv2.circle(slide, centre, r, (205, 128, 140), -1)
+                cv2.circle(slide, centre, r // 2, (218, 160, 170), -1)
+                cv2.circle(slide, centre, r, (180, 100, 115), 1)
+        if rng.random() < parasite_rate:
+            offset = rng.integers(-r // 2, r // 2 + 1, size=2)
+            cv2.circle(slide, (x + int(offset[0]), y + int(offset[1])), max(2, r // 5), (90, 40, 120), -1)
+
+    return slide
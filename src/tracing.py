@@ -0,0 +1,174 @@
+'''
+    Scan timing instrumentation for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+
+# Tracing is off until enable is called. While it is off, span returns a shared no-op context
+# manager and count returns straight away, so instrumented code runs at close to full speed.
+enabled = False
+
+_lock = threading.Lock()
+_events: List[dict] = []
+_durations: Dict[str, List[float]] = {}
+_counters: Dict[str, float] = {}
+_start_ns = 0
+
+
+class _NullSpan:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        end = time.perf_counter_ns()
+        event = {
+            "name": self.name,
+            "ph": "X",
+            "ts": (self.start - _start_ns) / 1000,
+            "dur": (end - self.start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if self.args:
+            event["args"] = self.args
+        with _lock:
+            _events.append(event)
+            _durations.setdefault(self.name, []).append((end - self.start) / 1e9)
+
+
+def enable() -> None:
+    '''Clear anything recorded so far and start recording.'''
+    global enabled, _start_ns
+    with _lock:
+        _events.clear()
+        _durations.clear()
+        _counters.clear()
+        _start_ns = time.perf_counter_ns()
+    enabled = True
+
+
+def disable() -> None:
+    '''Stop recording. What was recorded is kept for export and summary.'''
+    global enabled
+    enabled = False
+
+
+def span(name: str, **args):
+    '''Time a block of code.
+
+        with tracing.span("capture", field="0_1"):
+            image = api.take_image()
+
+    :param name: the name of the phase, which spans are summarised by.
+    :param args: extra values shown with the span in the trace viewer.
+    :returns: a context manager.
+    '''
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def count(name: str, value: float = 1) -> None:
+    '''Add to a counter, such as the number of bytes sent.
+
+    :param name: the name of the counter.
+    :param value: the amount to add.
+    '''
+    if not enabled:
+        return
+    with _lock:
+        total = _counters.get(name, 0) + value
+        _counters[name] = total
+        _events.append({
+            "name": name,
+            "ph": "C",
+            "ts": (time.perf_counter_ns() - _start_ns) / 1000,
+            "pid": os.getpid(),
+            "args": {name: total},
+        })
+
+
+def export_chrome(path: Path) -> None:
+    '''Write everything recorded as Chrome trace event JSON, which Perfetto and chrome://tracing open.
+
+    :param path: the file to write.
+    '''
+    with _lock:
+        events = list(_events)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def summary() -> dict:
+    '''Summarise the recorded spans and counters.
+
+    :returns: a dict with "spans", mapping each span name to its count, total, mean and 50th, 90th and
+    99th percentile and maximum durations in seconds, and "counters", mapping each counter to its total.
+    '''
+    with _lock:
+        durations = {name: np.array(values) for name, values in _durations.items()}
+        counters = dict(_counters)
+
+    spans = {}
+    for name, values in sorted(durations.items()):
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        spans[name] = {
+            "count": len(values),
+            "total_s": float(values.sum()),
+            "mean_s": float(values.mean()),
+            "p50_s": float(p50),
+            "p90_s": float(p90),
+            "p99_s": float(p99),
+            "max_s": float(values.max()),
+        }
+    return {"spans": spans, "counters": counters}
+
+
+def print_summary() -> None:
+    '''Print a table of the recorded spans, slowest in total first, and the counters.'''
+    result = summary()
+    print(f"{'phase':<20}{'count':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for name, s in sorted(result["spans"].items(), key=lambda item: -item[1]["total_s"]):
+        print(
+            f"{name:<20}{s['count']:>8}{s['total_s']:>10.3f}{s['mean_s'] * 1e3:>10.2f}"
+            f"{s['p50_s'] * 1e3:>10.2f}{s['p90_s'] * 1e3:>10.2f}{s['p99_s'] * 1e3:>10.2f}"
+        )
+    for name, total in sorted(result["counters"].items()):
+        print(f"{name:<20}{total:>18g}")
@@ -0,0 +1,48 @@
+'''
+    Test configuration for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import sys
+from pathlib import Path
+import pytest
+
+# The modules import each other by name, as when run from src/ and from the microcontroller's drive.
+# The microcontroller's directory goes last, so its code.py does not hide the standard library's.
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root / "src"))
+sys.path.append(str(root / "microcontroller"))
+
+
+@pytest.fixture
+def stage():
+    '''A simulated stepper controller whose moves take no time.'''
+    # The simulated stage speaks the serial protocol over a pty.
+    simulator = pytest.importorskip("simulator", exc_type=ImportError)
+    stage = simulator.SimulatedStage(time_scale=0)
+    yield stage
+    stage.close()
+
+
+@pytest.fixture
+def stepper(stage):
+    '''A protocol version 2 stepper controller connected to the simulated stage.'''
+    import api
+
+    stepper = api.StepperController(stage.port)
+    stepper.open()
+    yield stepper
+    stepper.close()
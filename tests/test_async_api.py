@@ -0,0 +1,103 @@
+'''
+    Tests of the asynchronous interoperability layer for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import struct
+import pytest
+import api
+import async_api
+import synthetic
+
+
+def test_moves_resolve_once_the_stage_has_made_them(stage, stepper):
+    async def scan():
+        async with async_api.AsyncStage(stepper) as async_stage:
+            moves = [
+                async_stage.move_x(1.0),
+                async_stage.move_y(-0.5),
+                async_stage.move_fine_focus(9.0),
+                async_stage.move_xyz(0.5, 0.5, -3.6),
+                async_stage.move_sequence([("x", -1.5), ("focus_fine", 1.8)], dwell_s=0.001),
+            ]
+            await asyncio.gather(*moves)
+            assert all(move.done() for move in moves)
+
+    asyncio.run(scan())
+    assert stage.frames == [api._cmd_move_batch] * 3 + [api._cmd_move_coordinated, api._cmd_move_batch]
+    assert stepper.get_position() == pytest.approx(stage.position())
+    assert stepper.get_position() == pytest.approx((0.0, 0.0, 7.2), abs=api.step_degrees * api.y_dist_factor)
+
+
+def test_queued_moves_are_sent_with_the_next_move(stage, stepper):
+    async def scan():
+        async with async_api.AsyncStage(stepper) as async_stage:
+            stepper.queue_move("x", 10 * api.step_degrees * api.x_dist_factor)
+            await async_stage.move_fine_focus(3 * api.step_degrees)
+            stepper.queue_move("y", 4 * api.step_degrees * api.y_dist_factor)
+            await async_stage.move_xyz(0, 0, -api.step_degrees)
+
+    asyncio.run(scan())
+    assert stage.moves == [{"x": 10}, {"focus_fine": 3}, {"y": 4, "focus_fine": -1}]
+    assert stepper._queued_degrees == {axis: 0.0 for axis in api.motor_axes}
+
+
+def test_a_rejected_command_fails_its_future_only(stage, stepper):
+    async def scan():
+        async with async_api.AsyncStage(stepper) as async_stage:
+            rejected = async_stage._send(api._cmd_move_batch, struct.pack(api._move_format, 9, 1, 0))
+            accepted = async_stage.move_x(1.0)
+            with pytest.raises(api.StepperControllerError, match="bad axis"):
+                await rejected
+            await accepted
+
+    asyncio.run(scan())
+    assert stage.position()[0] == pytest.approx(stepper.get_position()[0])
+
+
+def test_a_closed_stage_can_be_started_again(stage, stepper):
+    async_stage = async_api.AsyncStage(stepper)
+
+    async def scan():
+        async_stage.start()
+        await async_stage.move_x(1.0)
+        await async_stage.close()
+
+    asyncio.run(scan())
+    with pytest.raises(RuntimeError):
+        async_stage.move_x(1.0)
+    asyncio.run(scan())
+    assert len(stage.moves) == 2
+
+
+def test_snap_takes_an_image_without_touching_the_stepper_controller(stage):
+    simulator = pytest.importorskip("simulator", exc_type=ImportError)
+    camera = simulator.SyntheticCamera(stage, synthetic.make_slide(256, 256), shape=(64, 96))
+    widget = api.Widget(stage.port, camera)
+    widget.stepper.open()
+    async_camera = async_api.AsyncCamera(widget)
+    try:
+        image = asyncio.run(async_camera.snap())
+        assert image.shape[:2] == (64, 96)
+
+        widget.stepper.queue_move("x", 1.0)
+        with pytest.raises(RuntimeError, match="queued moves"):
+            asyncio.run(async_camera.snap())
+        assert stage.frames == []
+    finally:
+        async_camera.close()
+        widget.stepper.close()
@@ -0,0 +1,76 @@
+'''
+    Tests of closed-loop autofocus for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+import pytest
+import api
+import autofocus
+import image_processing
+
+
+@pytest.fixture
+def focus_curve(monkeypatch):
+    '''Stand in for the stage and camera with a focus metric which peaks at a chosen fine focus position.
+
+    Each image holds the fine focus position it was taken at, and its metric is a Lorentzian in the
+    distance from the peak. Returns a function which sets the peak and the position of the fine focus.
+    '''
+    state = {"position": 0.0, "peak": 0.0}
+    monkeypatch.setattr(api, "move_fine_focus", lambda degrees: state.update(position=state["position"] + degrees))
+    monkeypatch.setattr(api, "take_image", lambda: np.full((1, 1), state["position"]))
+    monkeypatch.setattr(
+        image_processing, "score_image", lambda image, algorithm: 1 / (1 + ((image[0, 0] - state["peak"]) / 6) ** 2)
+    )
+
+    def at(peak):
+        state.update(position=0.0, peak=peak)
+        return state
+    return at
+
+
+@pytest.mark.parametrize("method, max_captures, focus, n_captures", [
+    ("parabolic", None, 2.484, 4),
+    ("golden", None, 2.225, 8),
+    ("golden", 5, 2.225, 5),
+])
+def test_search_finds_the_peak(focus_curve, method, max_captures, focus, n_captures):
+    state = focus_curve(2.3)
+    result = autofocus.search(3.6, 5, method, min_step=0.2, movement_sleep=0, max_captures=max_captures)
+
+    assert result.focus == pytest.approx(focus, abs=1e-3)
+    assert result.focus == pytest.approx(state["position"])
+    assert result.n_captures == n_captures
+    assert result.metric == max(result.metrics)
+
+
+@pytest.mark.parametrize("method", ["parabolic", "golden"])
+def test_search_takes_no_more_images_than_a_z_stack(focus_curve, method):
+    for peak in np.linspace(-12, 12, 25):
+        state = focus_curve(peak)
+        result = autofocus.search(3.6, 5, method, min_step=0.2, movement_sleep=0, max_captures=5)
+
+        assert result.n_captures <= 5
+        assert result.focus == pytest.approx(state["position"])
+        # A peak within reach of five captures is found to within one hill-climbing step.
+        if abs(peak) <= 7.2:
+            assert abs(result.focus - peak) < 3.6
+
+
+def test_search_rejects_too_few_captures(focus_curve):
+    with pytest.raises(ValueError):
+        autofocus.search(3.6, movement_sleep=0, max_captures=2)
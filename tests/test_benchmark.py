@@ -0,0 +1,68 @@
+'''
+    Tests of the focus metric benchmark for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+from dataclasses import asdict, replace
+import numpy as np
+import pytest
+import benchmark
+
+
+def test_the_in_focus_plane_of_clearly_blurred_stacks_is_found():
+    stacks, truth = benchmark.synthetic_stacks(4, 7, (48, 64), blur_per_plane=1.5, noise=1.0)
+
+    result = benchmark.measure("synthetic", stacks, truth, "normed_var", repeats=1)
+
+    assert (result.height, result.width, result.depth, result.n_stacks, result.n_scored) == (48, 64, 7, 4, 4)
+    assert (result.accuracy, result.mean_abs_error, result.max_abs_error) == (1.0, 0.0, 0)
+    assert result.stacks_per_s > 0 and result.mpix_per_s == pytest.approx(result.stacks_per_s * 7 * 48 * 64 / 1e6)
+
+
+def test_stored_stacks_are_read_as_they_are_measured(tmp_path):
+    stacks, truth = benchmark.synthetic_stacks(3, 5, (32, 48), blur_per_plane=1.5, noise=1.0, seed=1)
+    for k, stack in enumerate(stacks):
+        np.save(tmp_path / f"s{k}.npy", stack)
+    # The last stack has no ground truth, so it is timed but not scored.
+    truth_path = tmp_path / "truth.json"
+    truth_path.write_text(json.dumps({"s0": truth[0], "s1": truth[1]}))
+
+    stored, stored_truth = benchmark.stored_stacks(tmp_path, truth_path)
+
+    assert all(isinstance(stack, np.memmap) for stack in stored)
+    result = benchmark.measure("stored", stored, stored_truth, "normed_var", repeats=1)
+    assert (result.n_stacks, result.n_scored, result.accuracy, result.max_abs_error) == (3, 2, 1.0, 0)
+
+
+def _write_results(path, results):
+    path.write_text(json.dumps({"results": [asdict(result) for result in results]}))
+
+
+def test_runs_are_compared_result_by_result(tmp_path, capsys):
+    old = benchmark.Result("synthetic", "normed_var", 48, 64, 5, 1.0, 1, 4, 10.0, 1.0, 0, 4, 0.5, 1, 0.5)
+    faster = replace(old, stacks_per_s=20.0, mean_abs_error=0.25)
+    other = replace(old, algorithm="brenner", n_scored=0, mean_abs_error=None)
+    new_only = replace(old, downsample=2)
+    _write_results(tmp_path / "old.json", [old, replace(other, stacks_per_s=5.0)])
+    _write_results(tmp_path / "new.json", [faster, other, new_only])
+
+    changes = benchmark.compare(tmp_path / "old.json", tmp_path / "new.json")
+
+    assert changes == {old.key(): (2.0, -0.25), other.key(): (2.0, None)}
+    out = capsys.readouterr().out
+    assert "2.00x throughput, error -0.25 planes" in out
+    assert "Median throughput 2.00x the baseline." in out
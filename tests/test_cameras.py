@@ -0,0 +1,82 @@
+'''
+    Tests of the camera backends for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import threading
+import time
+import numpy as np
+import cameras
+
+
+class _SlowCamera(cameras.CameraBackend):
+    "A camera whose first image takes first_s and every later one takes then_s."
+
+    def __init__(self, first_s, then_s):
+        self.delays = [first_s]
+        self.then_s = then_s
+
+    def snapshot_into(self, out=None):
+        time.sleep(self.delays.pop() if self.delays else self.then_s)
+        image = np.zeros((4, 4), dtype=np.uint8)
+        if out is None:
+            return image
+        np.copyto(out, image)
+        return out
+
+
+def _publish(ring, value):
+    ring.write_slot()[...] = value
+    return ring.publish()
+
+
+def test_the_ring_wraps_around_and_overwrites_the_oldest_frames():
+    ring = cameras.FrameRingBuffer((2, 3), n_slots=3)
+    assert ring.latest() == (0, None)
+
+    seq, first = _publish(ring, 1), ring.latest()[1]
+    assert seq == 1 and (first == 1).all()
+    for value in range(2, 6):
+        seq = _publish(ring, value)
+
+    latest_seq, latest = ring.latest()
+    assert (latest_seq, int(latest[0, 0])) == (5, 5)
+    # The three newest frames fill the ring, and the view of the first now shows the fourth.
+    assert sorted(int(frame[0, 0]) for frame in ring.frames) == [3, 4, 5]
+    assert (first == 4).all()
+
+
+def test_wait_for_returns_newer_frames_and_times_out_without_them():
+    ring = cameras.FrameRingBuffer((2, 2), n_slots=2)
+    _publish(ring, 7)
+    assert ring.wait_for(0, timeout=0)[0] == 1
+
+    start = time.monotonic()
+    assert ring.wait_for(1, timeout=0.1) == (1, None)
+    assert time.monotonic() - start >= 0.1
+
+    threading.Timer(0.05, _publish, (ring, 9)).start()
+    seq, frame = ring.wait_for(1, timeout=5)
+    assert seq == 2 and (frame == 9).all()
+
+
+def test_stream_wait_for_has_one_deadline():
+    # The first image arrives 0.2 s in, and no image after it for a while.
+    with cameras.CameraStream(_SlowCamera(0.2, 0.6)) as stream:
+        start = time.monotonic()
+        assert stream.wait_for(1, timeout=0.3) == (1, None)
+        elapsed = time.monotonic() - start
+    assert 0.25 < elapsed < 0.45
@@ -0,0 +1,52 @@
+'''
+    Tests of red blood cell and parasite detection for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+import pytest
+import detection
+import image_writer
+import synthetic
+
+
+@pytest.mark.parametrize("shape", [(10, 12, 3), (40, 20, 3), (20, 40, 3), (64, 64, 3)])
+def test_crops_have_the_crop_size_whatever_the_image_size(shape):
+    image = np.arange(np.prod(shape), dtype=np.uint32).reshape(shape).astype(np.uint8) | 1
+    h, w = shape[:2]
+    candidates = [detection.Candidate(x, y, 4, 1.0, 1) for x, y in [(0, 0), (w - 1, h - 1), (w / 2, h / 2)]]
+
+    crops = detection.crop_candidates(image, candidates, 32)
+
+    assert crops.shape == (3, 32, 32, 3)
+    for crop in crops:
+        # Every pixel of the image that fits is in the crop, and only zeros pad it.
+        filled = crop[..., 0] != 0
+        assert filled.sum() == min(h, 32) * min(w, 32)
+        assert filled[:min(h, 32), :min(w, 32)].all()
+
+
+def test_resumed_detections_add_no_blank_lines(tmp_path):
+    slide = synthetic.make_slide(256, 256, parasite_rate=0.2, seed=1)
+    for k in range(3):
+        with image_writer.ImageWriter(tmp_path) as writer, detection.Detector(tmp_path, writer) as detector:
+            detector.submit(f"field_{k}_0", slide[:128, :128].copy())
+
+    lines = (tmp_path / detection.file_name).read_text(encoding="utf-8").splitlines()
+    assert "" not in lines
+    summary, fields = detection.read(tmp_path / detection.file_name)
+    assert sorted(fields) == ["field_0_0", "field_1_0", "field_2_0"]
+    assert summary.n_cells == 3 * fields["field_0_0"].n_cells
@@ -0,0 +1,78 @@
+'''
+    Tests of extended depth of field fusion for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+import cv2
+import pytest
+import edf
+
+
+def _tilted_stack(depth=6, shape=(301, 419), rgb=True):
+    '''A z-stack of a textured field tilted so each plane is in focus along a different band of columns.'''
+    rng = np.random.default_rng(0)
+    h, w = shape
+    texture = cv2.GaussianBlur(rng.uniform(0, 255, (h, w, 3) if rgb else (h, w)).astype(np.float32), (0, 0), 1.5)
+    blurred = [texture] + [cv2.GaussianBlur(texture, (0, 0), 0.8 * s) for s in range(1, depth)]
+    in_focus = np.linspace(0, depth - 1, w)
+    stack = []
+    for k in range(depth):
+        level = np.minimum(np.rint(np.abs(k - in_focus)).astype(int), depth - 1)
+        plane = np.empty_like(texture)
+        for s in np.unique(level):
+            plane[:, level == s] = blurred[s][:, level == s]
+        stack.append(np.clip(plane + rng.normal(0, 2, plane.shape), 0, 255).astype(np.uint8))
+    return stack
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(),
+    dict(block_size=8),
+    dict(block_size=5, smoothing=3),
+    dict(block_size=3, window=15, smoothing=1),
+    dict(pyramid_levels=3),
+    dict(pyramid_levels=2, block_size=4),
+])
+@pytest.mark.parametrize("tile_size", [64, 100, 257])
+def test_tiled_fusion_matches_untiled(kwargs, tile_size):
+    stack = _tilted_stack()
+    fused, depth = edf.fuse(stack, tile_size=10000, **kwargs)
+    tiled, tiled_depth = edf.fuse(stack, tile_size=tile_size, **kwargs)
+
+    assert np.array_equal(fused, tiled)
+    assert np.array_equal(depth, tiled_depth)
+
+
+def test_tiled_fusion_matches_untiled_greyscale():
+    stack = _tilted_stack(rgb=False)
+    kwargs = dict(block_size=6, pyramid_levels=2, from_rgb=False)
+
+    fused, depth = edf.fuse(stack, tile_size=10000, **kwargs)
+    tiled, tiled_depth = edf.fuse(stack, tile_size=50, **kwargs)
+
+    assert np.array_equal(fused, tiled)
+    assert np.array_equal(depth, tiled_depth)
+
+
+def test_depth_map_follows_the_tilt():
+    stack = _tilted_stack()
+    _, depth = edf.fuse(stack, block_size=4, tile_size=128)
+
+    # Each plane is in focus along its own band of columns, from the left for the top plane.
+    columns = depth[:, 20:-20].mean(axis=0)
+    assert columns[0] < 1 and columns[-1] > len(stack) - 2
+    assert np.all(np.diff(columns[::40]) >= 0)
@@ -0,0 +1,83 @@
+'''
+    Tests of the persistent focus index for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import time
+import numpy as np
+import pytest
+import focus_index
+
+
+def _prior(i=0, j=0, x_mm=1.0, y_mm=2.0, updated=0.0):
+    return focus_index.FocusPrior("slide", i, j, x_mm, y_mm, 3.6, [1.0, 2.5, 1.5], "", updated)
+
+
+def test_priors_past_their_age_are_stale(tmp_path):
+    with focus_index.FocusIndex(tmp_path / "index.sqlite") as index:
+        index.put(_prior(0, 0, updated=time.time() - 100))
+        index.put(_prior(1, 0, updated=time.time() - 10))
+        fields = [(0, 0, 1.0, 2.0), (1, 0, 1.0, 2.0)]
+
+        assert set(index.priors("slide", fields, max_age_s=50)) == {(1, 0)}
+        assert set(index.priors("slide", fields, max_age_s=200)) == {(0, 0), (1, 0)}
+        assert index.priors("other slide", fields, max_age_s=200) == {}
+
+
+def test_priors_of_fields_which_moved_do_not_apply(tmp_path):
+    tolerance = focus_index.position_tolerance_mm
+    with focus_index.FocusIndex(tmp_path / "index.sqlite") as index:
+        index.put(_prior())
+
+        assert (0, 0) in index.priors("slide", [(0, 0, 1.0 + tolerance / 2, 2.0 - tolerance / 2)], 60)
+        assert index.priors("slide", [(0, 0, 1.0 + 2 * tolerance, 2.0)], 60) == {}
+        assert index.priors("slide", [(0, 0, 1.0, 2.0 - 2 * tolerance)], 60) == {}
+
+
+def test_after_write_records_the_checksum_of_the_image(tmp_path):
+    image = np.arange(48, dtype=np.uint8).reshape(4, 4, 3)
+    with focus_index.FocusIndex(tmp_path / "index.sqlite") as index:
+        written = index.after_write(_prior(), image)
+        assert index.get("slide", 0, 0) is None
+
+        written()
+        prior = index.get("slide", 0, 0)
+        assert prior.checksum == focus_index.checksum(image)
+        assert prior.metrics == [1.0, 2.5, 1.5]
+        assert prior.updated == pytest.approx(time.time(), abs=60)
+
+    changed = image.copy()
+    changed[0, 0, 0] += 1
+    assert focus_index.checksum(changed) != prior.checksum
+    # The checksum is of the pixels, not of how they are laid out in memory.
+    assert focus_index.checksum(np.asfortranarray(image)) == prior.checksum
+
+
+def test_the_index_survives_reopening_in_wal_mode(tmp_path):
+    path = tmp_path / "index.sqlite"
+    with focus_index.FocusIndex(path) as index:
+        index.put(_prior(0, 0))
+        # A second connection, such as another scan's, sees what was recorded while the first is open.
+        with focus_index.FocusIndex(path) as other:
+            assert other.get("slide", 0, 0) is not None
+            other.put(_prior(1, 0))
+        assert index.get("slide", 1, 0) is not None
+
+    with focus_index.FocusIndex(path) as index:
+        assert index._db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        prior = index.get("slide", 0, 0)
+        assert (prior.focus, prior.metrics) == (3.6, [1.0, 2.5, 1.5])
+        assert set(index.priors("slide", [(0, 0, 1.0, 2.0), (1, 0, 1.0, 2.0)], 60)) == {(0, 0), (1, 0)}
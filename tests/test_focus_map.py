@@ -0,0 +1,77 @@
+'''
+    Tests of focus surface prediction for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import math
+import numpy as np
+import pytest
+import focus_map
+
+
+def _plane(x, y):
+    return 3.0 + 2.0 * x - 1.5 * y
+
+
+def _fields(noise, seed=0):
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(0, 4, 5), np.linspace(0, 3, 4))
+    x, y = x.ravel(), y.ravel()
+    return x, y, _plane(x, y) + rng.normal(0, noise, x.shape)
+
+
+def test_a_tilted_plane_is_recovered_despite_an_outlier():
+    x, y, z = _fields(0.2)
+    # A field focused on debris far above the slide.
+    z[7] += 40.0
+
+    surface = focus_map.FocusMap(order=1, min_sigma=0.1)
+    for field in zip(x, y, z):
+        surface.add(*field)
+
+    for px, py in [(0.5, 0.5), (2.0, 1.5), (3.5, 2.5)]:
+        predicted, sigma = surface.predict(px, py)
+        assert predicted == pytest.approx(_plane(px, py), abs=0.3)
+        assert sigma < 1.0
+
+    # An ordinary least squares fit is dragged well away from the plane by the same outlier.
+    design = np.stack([np.ones_like(x), x, y], axis=1)
+    coef = np.linalg.lstsq(design, z, rcond=None)[0]
+    assert abs(coef @ (1.0, 0.5, 0.5) - _plane(0.5, 0.5)) > 1.0
+
+
+def test_the_order_is_lowered_until_there_are_enough_fields():
+    surface = focus_map.FocusMap(order=2)
+    assert surface.predict(1.0, 1.0) == (0.0, math.inf)
+
+    surface.add(0.0, 0.0, 5.0)
+    assert surface.predict(1.0, 1.0) == (5.0, math.inf)
+    for field in [(1.0, 0.0, 7.0), (0.0, 1.0, 3.5), (1.0, 1.0, 5.5)]:
+        surface.add(*field)
+    assert surface._order == 1
+
+
+def test_stack_size_shrinks_as_the_uncertainty_falls():
+    sizes = []
+    for noise in (6.0, 3.0, 1.5, 0.5, 0.0):
+        surface = focus_map.FocusMap(order=1, min_sigma=0.2)
+        for field in zip(*_fields(noise)):
+            surface.add(*field)
+        sizes.append(surface.stack_size(2.0, 1.5, z_step_size=1.8, n_max=15))
+
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[0] > sizes[-1] == 3
+    assert focus_map.FocusMap().stack_size(0.0, 0.0, z_step_size=1.8, n_max=15) == 15
@@ -0,0 +1,81 @@
+'''
+    Tests of the image processing for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import cv2
+import numpy as np
+import pytest
+import image_processing
+
+
+def _fft_energy(image, cutoff=0.25):
+    image = image - image.mean()
+    power = np.abs(np.fft.rfft2(image)) ** 2
+    fy = np.fft.fftfreq(image.shape[0])[:, np.newaxis]
+    fx = np.fft.rfftfreq(image.shape[1])[np.newaxis, :]
+    return power[np.hypot(fx, fy) > cutoff * 0.5].sum() / power.sum()
+
+
+# Each metric of one float64 image, written plainly or with OpenCV's filters.
+references = {
+    "normed_var": lambda image: image.var() / image.mean(),
+    "laplacian_var": lambda image: cv2.Laplacian(image, cv2.CV_64F, ksize=1)[1:-1, 1:-1].var(),
+    "tenengrad": lambda image: (
+        cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=3) ** 2 + cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=3) ** 2
+    )[1:-1, 1:-1].mean(),
+    "brenner": lambda image: ((image[:, 2:] - image[:, :-2]) ** 2).mean(),
+    "fft_energy": _fft_energy,
+    "vollath_f4": lambda image: (image[:, :-2] * image[:, 1:-1]).mean() - (image[:, :-2] * image[:, 2:]).mean(),
+}
+
+
+@pytest.fixture
+def stack():
+    rng = np.random.default_rng(0)
+    sharp = rng.integers(20, 235, size=(48, 64)).astype(np.uint8)
+    return np.stack([cv2.GaussianBlur(sharp, (0, 0), sigma) if sigma else sharp for sigma in (0, 0.5, 1, 2, 3)])
+
+
+def test_every_metric_has_a_reference():
+    assert set(references) == set(image_processing.algorithms)
+
+
+@pytest.mark.parametrize("algorithm", list(image_processing.algorithms))
+@pytest.mark.parametrize("roi, downsample", [(None, 1), ((5, 3, 40, 30), 1), (None, 2)])
+def test_metrics_match_a_per_image_reference(stack, algorithm, roi, downsample):
+    metric = image_processing.algorithms[algorithm](stack, roi, downsample)
+
+    expected = []
+    for image in stack.astype(np.float64):
+        if roi is not None:
+            x, y, w, h = roi
+            image = image[y:y + h, x:x + w]
+        expected.append(references[algorithm](image[::downsample, ::downsample]))
+    # vollath_f4 is a small difference of two large float32 means, so allow for their rounding too.
+    rounding = 1e-6 * float((stack.astype(np.float64) ** 2).mean())
+    assert metric == pytest.approx(np.array(expected), rel=1e-4, abs=rounding)
+
+
+@pytest.mark.parametrize("algorithm", list(image_processing.algorithms))
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8])
+def test_chunked_metric_matches_the_whole_stack(stack, algorithm, chunk_size):
+    whole = image_processing.chunked_metric(stack, algorithm, (2, 2, 50, 40))
+    chunked = image_processing.chunked_metric(stack, algorithm, (2, 2, 50, 40), chunk_size=chunk_size)
+
+    assert chunked == pytest.approx(whole, rel=1e-6)
+    assert image_processing.analyze_z_stack(stack, algorithm, False, chunk_size=chunk_size)[0] == \
+        image_processing.analyze_z_stack(stack, algorithm, False)[0]
@@ -0,0 +1,51 @@
+'''
+    Tests of the background image writer for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import stat
+import numpy as np
+import pytest
+import image_writer
+
+
+@pytest.mark.parametrize("image_format", ["png", "tiff", "npy", "container"])
+def test_images_are_synced_before_and_after_they_are_renamed_into_place(tmp_path, monkeypatch, image_format):
+    events = []
+    fsync, replace = os.fsync, os.replace
+
+    def record_fsync(fd):
+        events.append(("fsync", "dir" if stat.S_ISDIR(os.fstat(fd).st_mode) else "file"))
+        fsync(fd)
+
+    def record_replace(src, dst):
+        events.append(("replace", os.path.basename(dst)))
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "fsync", record_fsync)
+    monkeypatch.setattr(os, "replace", record_replace)
+    image = np.arange(48 * 64 * 3, dtype=np.uint8).reshape(48, 64, 3)
+    with image_writer.ImageWriter(tmp_path, image_format=image_format, n_workers=1) as writer:
+        writer.write("field_0_0", image)
+        name = writer.file_name("field_0_0")
+
+    expected = [("fsync", "file"), ("replace", name)]
+    if os.name != "nt":
+        expected.append(("fsync", "dir"))
+    assert events == expected
+    if image_format != "container":
+        assert np.array_equal(image_writer.read_image(tmp_path / name), image)
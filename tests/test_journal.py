@@ -0,0 +1,49 @@
+'''
+    Tests of the scan journal for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import journal
+
+
+def _record(i):
+    return journal.FieldRecord(i, 0, float(i), 0.0, 0.0, [1.0, 2.0], f"field_{i}_0.png")
+
+
+def test_resume_after_a_torn_line_keeps_every_later_event(tmp_path):
+    path = tmp_path / journal.file_name
+    with journal.ScanJournal(path) as scan_journal:
+        scan_journal.start({"n_fields_x": 3})
+        scan_journal.field(_record(0))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"event": "field", "i": 1')
+
+    with journal.ScanJournal(path) as scan_journal:
+        scan_journal.start({"n_fields_x": 3}, resumed=True)
+        scan_journal.field(_record(2))
+
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert '"resume"' in lines[3] and lines[2].endswith('"i": 1')
+    assert sorted(journal.read(path).done) == [(0, 0), (2, 0)]
+
+
+def test_reopening_a_whole_journal_adds_no_blank_lines(tmp_path):
+    path = tmp_path / journal.file_name
+    for resumed in (False, True, True):
+        with journal.ScanJournal(path) as scan_journal:
+            scan_journal.start({}, resumed=resumed)
+
+    assert "" not in path.read_text(encoding="utf-8").splitlines()
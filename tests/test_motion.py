@@ -0,0 +1,80 @@
+'''
+    Tests of the stepper motion profile timing for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+import pytest
+import api
+import motion
+
+profiles = [(200, 400), (100, 200), (1000, 5000), (40, 100)]
+
+
+def _ramp_steps(max_speed, accel):
+    v0 = min(api.start_speed, max_speed)
+    return (max_speed ** 2 - v0 ** 2) / (2 * accel)
+
+
+# Profiles whose max_speed is above start_speed, so short moves never reach it.
+@pytest.mark.parametrize("max_speed, accel", profiles[:3])
+@pytest.mark.parametrize("fraction", [0.0, 0.05, 0.5, 1.0])
+def test_triangular_moves_match_estimate(fraction, max_speed, accel):
+    steps = max(1, int(fraction * 2 * _ramp_steps(max_speed, accel)))
+    intervals = list(motion.step_intervals(steps, max_speed, accel, api.start_speed))
+
+    assert len(intervals) == steps
+    assert sum(intervals) == pytest.approx(api.move_time(steps, max_speed, accel), rel=1e-9)
+    # Speeds up to the middle of the move and slows down symmetrically after it.
+    assert intervals == pytest.approx(intervals[::-1], rel=1e-9)
+    assert all(b <= a for a, b in zip(intervals, intervals[:(steps + 1) // 2][1:]))
+
+
+@pytest.mark.parametrize("max_speed, accel", profiles)
+@pytest.mark.parametrize("steps", [500, 2001, 20000])
+def test_trapezoidal_moves_match_estimate(steps, max_speed, accel):
+    assert 2 * _ramp_steps(max_speed, accel) < steps
+    intervals = list(motion.step_intervals(steps, max_speed, accel, api.start_speed))
+
+    assert len(intervals) == steps
+    assert sum(intervals) == pytest.approx(api.move_time(steps, max_speed, accel), rel=1e-9)
+    # Cruises at max_speed in the middle of the move and never exceeds it.
+    assert intervals[steps // 2] == pytest.approx(1 / max_speed)
+    assert min(intervals) >= 1 / max_speed * (1 - 1e-9)
+
+
+@pytest.mark.parametrize("max_speed, accel", profiles)
+def test_zero_step_moves_take_no_time(max_speed, accel):
+    assert list(motion.step_intervals(0, max_speed, accel, api.start_speed)) == []
+    assert api.move_time(0, max_speed, accel) == 0.0
+
+
+def test_estimate_matches_firmware_for_arrays_and_signs():
+    steps = np.array([0, -3, 40, -2500])
+    estimates = api.move_time(steps, 200, 400)
+
+    assert estimates.shape == steps.shape
+    for n, estimate in zip(steps, estimates):
+        assert sum(motion.step_intervals(abs(int(n)), 200, 400, api.start_speed)) == pytest.approx(estimate)
+
+
+def test_estimate_uses_the_widget_profile():
+    stepper = api.StepperController()
+    stepper.motion_profiles["x"] = (1000, 5000, 1)
+
+    assert stepper.estimate_move_time("x", 600) == pytest.approx(
+        sum(motion.step_intervals(600, 1000, 5000, api.start_speed))
+    )
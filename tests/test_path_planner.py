@@ -0,0 +1,79 @@
+'''
+    Tests of scan path planning for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+import pytest
+import path_planner
+
+
+def _scattered_fields(n, seed):
+    rng = np.random.default_rng(seed)
+    return path_planner.list_fields(rng.uniform(0, 5, size=(n, 2)))
+
+
+def _tour_time(fields, tour, return_home):
+    positions = np.array([(0.0, 0.0)] + [(f.x_mm, f.y_mm) for f in fields])[tour]
+    if return_home:
+        positions = np.vstack([positions, positions[:1]])
+    steps = np.diff(positions, axis=0)
+    return float(path_planner.move_time(steps[:, 0], steps[:, 1]).sum())
+
+
+@pytest.mark.parametrize("return_home", [True, False])
+def test_2_opt_never_makes_the_tour_slower(return_home):
+    for seed in range(5):
+        fields = _scattered_fields(30, seed)
+        nearest = path_planner._optimized_tour(fields, return_home, max_passes=0)
+        optimized = path_planner._optimized_tour(fields, return_home, max_passes=50)
+
+        assert optimized[0] == 0 and sorted(optimized) == list(range(len(fields) + 1))
+        assert _tour_time(fields, optimized, return_home) <= _tour_time(fields, nearest, return_home) + 1e-9
+
+
+@pytest.mark.parametrize("order", path_planner.orders)
+def test_every_field_is_imaged_once(order):
+    fields = path_planner.polygon_fields([(-1, -1), (3, 0), (2, 3), (-0.5, 2)], 0.4, 0.3)
+    move_plan = path_planner.plan(fields, order, backlash_mm=0.1)
+
+    key = lambda f: (f.i, f.j)
+    assert sorted(move_plan.fields, key=key) == sorted(fields, key=key)
+    assert (move_plan.waypoints[-1].x_mm, move_plan.waypoints[-1].y_mm) == (0.0, 0.0)
+
+
+@pytest.mark.parametrize("order", path_planner.orders)
+def test_backlash_overshoots_stay_inside_the_travel_envelope(order):
+    for fields in (path_planner.grid_fields(2, 2, 2, 2), _scattered_fields(20, 1)):
+        move_plan = path_planner.plan(fields, order, backlash_mm=0.1)
+        x_min = min([0.0] + [f.x_mm for f in fields])
+        y_min = min([0.0] + [f.y_mm for f in fields])
+
+        x, y = 0.0, 0.0
+        for waypoint in move_plan.waypoints:
+            assert waypoint.x_mm >= x_min and waypoint.y_mm >= y_min
+            # Fields are approached moving forwards unless that would leave the envelope.
+            if waypoint.field is not None:
+                assert waypoint.x_mm >= x or waypoint.x_mm == x_min
+                assert waypoint.y_mm >= y or waypoint.y_mm == y_min
+            x, y = waypoint.x_mm, waypoint.y_mm
+
+
+def test_serpentine_overshoots_only_moves_which_arrive_backwards():
+    move_plan = path_planner.plan(path_planner.grid_fields(3, 3, 3, 3), "serpentine", backlash_mm=0.1)
+
+    overshoots = [(w.x_mm, w.y_mm) for w in move_plan.waypoints if w.field is None][:-1]
+    assert overshoots == [(1.0, pytest.approx(0.9))]
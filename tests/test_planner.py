@@ -0,0 +1,82 @@
+'''
+    Tests of the scan planner for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import planner
+
+_grid = dict(x_travel_mm=1.0, y_travel_mm=1.0, n_fields_x=2, n_fields_y=2, n_z_stack=3, z_step_size=1.0)
+
+def test_an_analysis_pool_is_rejected_by_scans_which_would_not_use_it(tmp_path):
+    with ThreadPoolExecutor(1) as pool:
+        for asynchronous in (False, True):
+            with pytest.raises(ValueError, match="pipelined"):
+                planner.main(
+                    planner.ScanConfig(1.0, 1.0, 2, 2, 3, 1.0, asynchronous=asynchronous), str(tmp_path),
+                    analysis_pool=pool
+                )
+
+
+@pytest.mark.parametrize("settings, match", [
+    (dict(focus_mode="sharpest"), "focus mode"),
+    (dict(path="spiral"), "field order"),
+    (dict(image_format="jpeg"), "image format"),
+    (dict(n_z_stack=0), "at least one"),
+    (dict(edf_workers=2), "pipelined stack"),
+    (dict(asynchronous=True, focus_mode="golden"), "stack focus mode"),
+    (dict(asynchronous=True, adaptive_settle=True), "adaptive settling"),
+    (dict(pipelined=True, use_focus_map=True), "Focus maps"),
+    (dict(pipelined=True, backlash_mm=0.1), "Path planning"),
+    (dict(asynchronous=True, fields=[(0.0, 0.0)]), "Path planning"),
+    (dict(pipelined=True, slide_id="A1"), "Focus priors"),
+])
+def test_unsupported_settings_are_rejected_when_configured(settings, match):
+    with pytest.raises(ValueError, match=match):
+        planner.ScanConfig(**dict(_grid, **settings))
+
+
+def test_settings_replace_those_of_the_config_and_are_checked(tmp_path):
+    config = planner.ScanConfig(1.0, 1.0, 2, 2, 3, 1.0, pipelined=True)
+
+    with pytest.raises(ValueError, match="Focus maps"):
+        planner.main(config, str(tmp_path), use_focus_map=True)
+
+
+def test_params_are_the_keyword_arguments_of_the_config():
+    config = planner.ScanConfig(1.0, 1.0, 2, 2, 3, 1.0, fields=((0, 0), (0.5, 1)), slide_id="A1")
+
+    params = config.params()
+
+    assert params["fields"] == [[0.0, 0.0], [0.5, 1.0]]
+    assert planner.ScanConfig(**params).params() == params
+
+
+def test_the_command_line_sets_every_mode():
+    args = planner._parser().parse_args([
+        "--fields-x", "3", "--n-z-stack", "7", "--path", "optimized", "--backlash-mm", "0.05", "--survey",
+        "--mosaic-pixel-size", "0.5", "--focus-map", "--focus-mode", "golden", "--adaptive-settle",
+        "--detection-workers", "2", "--slide-id", "A1", "--image-format", "tiff", "--trace", "t.json"
+    ])
+
+    config = planner._config(args)
+
+    assert (config.n_fields_x, config.n_z_stack, config.path, config.backlash_mm) == (3, 7, "optimized", 0.05)
+    assert config.use_survey and config.use_focus_map and config.adaptive_settle
+    assert (config.mosaic_pixel_size_um, config.focus_mode, config.detection_workers) == (0.5, "golden", 2)
+    assert (config.slide_id, config.image_format, args.trace) == ("A1", "tiff", "t.json")
+    assert planner._config(planner._parser().parse_args(["--pipelined", "--edf-workers", "2"])).edf_workers == 2
@@ -0,0 +1,85 @@
+'''
+    Tests of absolute stage position tracking for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import pytest
+import api
+
+# One full step of each axis in the units the api moves it in.
+x_step_mm = api.step_degrees * api.x_dist_factor
+y_step_mm = api.step_degrees * api.y_dist_factor
+
+
+def test_sub_step_moves_do_not_drift(stage, stepper):
+    # Rounded on its own, each of these moves would be no step at all.
+    for _ in range(1000):
+        stepper.move_x_axis(0.3 * x_step_mm)
+    for _ in range(300):
+        stepper.move_fine_focus(-0.7 * api.step_degrees)
+
+    assert stage._steps["x"] == 300 and stage._steps["focus_fine"] == -210
+    assert stepper.position_steps["x"] == 300
+    assert stepper.get_position()[0] == pytest.approx(300 * x_step_mm)
+    assert sum(abs(move["x"]) for move in stage.moves if "x" in move) == 300
+
+
+def test_moves_which_cancel_out_are_never_sent(stage, stepper):
+    stepper.queue_move("x", 5 * x_step_mm)
+    stepper.queue_move("x", -5 * x_step_mm)
+    stepper.queue_move("focus_fine", 0.2 * api.step_degrees)
+    stepper.flush_moves()
+
+    assert stage.frames == [] and stage.moves == []
+
+
+def test_queued_moves_are_sent_as_one_coordinated_frame(stage, stepper):
+    stepper.queue_move("x", 4 * x_step_mm)
+    stepper.queue_move("y", -3 * y_step_mm)
+    stepper.move_fine_focus(2 * api.step_degrees)
+
+    assert stage.frames == [api._cmd_move_coordinated]
+    assert stage.moves == [{"x": 4, "y": -3, "focus_fine": 2}]
+
+
+def test_queued_moves_are_sent_as_separate_packets_with_version_1(stage):
+    stepper = api.StepperController(stage.port, version=1)
+    stepper.open()
+    try:
+        stepper.queue_move("x", 4 * x_step_mm)
+        stepper.queue_move("y", -3 * y_step_mm)
+        stepper.move_fine_focus(2 * api.step_degrees)
+    finally:
+        stepper.close()
+
+    assert stage.frames == []
+    assert stage.moves == [{"x": 4}, {"y": -3}, {"focus_fine": 2}]
+
+
+def test_move_to_lands_on_absolute_targets(stage, stepper):
+    stepper.queue_move("x", 7.4 * x_step_mm)
+    targets = [(1.0, 2.0, 30.0), (0.25, 2.0, -12.5), (3.333, 0.1, 0.0), (0.0, 0.0, 0.0)]
+    for x_mm, y_mm, focus_deg in targets:
+        stepper.move_to(x_mm, y_mm, focus_deg)
+
+        assert stage._steps["x"] == round(x_mm / x_step_mm)
+        assert stage._steps["y"] == round(y_mm / y_step_mm)
+        assert stage._steps["focus_fine"] == round(focus_deg / api.step_degrees)
+        assert stepper.get_position() == pytest.approx(stage.position())
+
+    # The queued move was folded into the first move to its target rather than made on its own.
+    assert stage.moves[0] == {"x": round(1.0 / x_step_mm), "y": round(2.0 / y_step_mm), "focus_fine": 17}
+    assert len(stage.moves) == len(targets)
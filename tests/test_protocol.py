@@ -0,0 +1,89 @@
+'''
+    Tests of the stepper controller serial protocol for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import struct
+import time
+import pytest
+import api
+
+
+def test_frames_carry_sync_version_length_and_checksum():
+    payload = struct.pack(api._move_format, 1, -70000, 250)
+    frame = api.StepperController()._encode_frame(api._cmd_move_batch, payload)
+
+    assert frame[0] == 0xA5
+    assert struct.unpack(">BBH", frame[1:5]) == (2, api._cmd_move_batch, len(payload))
+    assert frame[5:-1] == payload
+    assert frame[-1] == sum(frame[1:-1]) % 256
+    assert struct.unpack(api._move_format, frame[5:-1]) == (1, -70000, 250)
+
+
+def test_negative_and_long_moves_round_trip(stage, stepper):
+    # 70000 steps does not fit in 16 bits, let alone the 255 of a version 1 packet.
+    stepper.move_sequence([("x", -70000 * api.step_degrees * api.x_dist_factor), ("focus_fine", 3 * api.step_degrees)])
+
+    assert stage._steps["x"] == -70000 and stage._steps["focus_fine"] == 3
+    assert stage.n_moves == 2
+
+
+def test_rejected_frames_raise(stage, stepper):
+    frame = bytearray(stepper._encode_frame(api._cmd_move_batch, struct.pack(api._move_format, 0, 5, 0)))
+    frame[-1] ^= 0xFF
+    stepper.ser.write(bytes(frame))
+    _, status, _ = stepper._read_reply(stepper._wait_for_reply(1))
+    assert status == 1
+    with pytest.raises(api.StepperControllerError, match="bad checksum"):
+        api._check_status(api._cmd_move_batch, status)
+
+    with pytest.raises(api.StepperControllerError, match="bad axis"):
+        stepper._send_frame(api._cmd_move_batch, struct.pack(api._move_format, 9, 5, 0))
+    with pytest.raises(api.StepperControllerError, match="unknown command"):
+        stepper._send_frame(0x7F, b"")
+
+    # Nothing moved, and the controller still answers.
+    stepper.move_x_axis(api.step_degrees * api.x_dist_factor)
+    assert stage._steps["x"] == 1
+
+
+def test_missing_reply_raises_instead_of_hanging(stage, stepper):
+    stepper.reply_timeout = 0.3
+    stepper.ser.timeout = 0.1
+    # A frame cut short, so the controller is still waiting for the rest of it and never replies.
+    stepper.ser.write(stepper._encode_frame(api._cmd_move_batch, struct.pack(api._move_format, 0, 5, 0))[:6])
+
+    start = time.monotonic()
+    with pytest.raises(api.StepperControllerError, match="Timed out"):
+        stepper._wait_for_reply(1)
+    assert time.monotonic() - start < 2
+
+
+def test_version_1_sends_one_packet_per_255_steps(stage):
+    stepper = api.StepperController(stage.port, version=1)
+    stepper.open()
+    try:
+        stepper.move_x_axis(-600 * api.step_degrees * api.x_dist_factor)
+        stepper.move_xyz(2 * api.step_degrees * api.x_dist_factor, 300 * api.step_degrees * api.y_dist_factor, 0)
+        stepper.move_sequence([("focus_fine", -2 * api.step_degrees)])
+        with pytest.raises(NotImplementedError):
+            stepper.set_motion_profile("x", 100, 200)
+    finally:
+        stepper.close()
+
+    assert (stage._steps["x"], stage._steps["y"], stage._steps["focus_fine"]) == (-598, 300, -2)
+    # 255 + 255 + 90 steps of x, 2 of x, 255 + 45 of y and 2 of focus.
+    assert stage.n_moves == 3 + 1 + 2 + 1
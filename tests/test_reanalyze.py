@@ -0,0 +1,110 @@
+'''
+    Tests of the batch re-analysis of archived z-stacks for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+import numpy as np
+import cv2
+import pytest
+import journal
+import reanalyze
+
+
+def _write_planes(directory, names, shape=(24, 32)):
+    directory.mkdir(parents=True)
+    for name in names:
+        cv2.imwrite(str(directory / name), np.full(shape, 128, dtype=np.uint8))
+
+
+def test_find_stacks_yields_only_z_stacks(tmp_path):
+    _write_planes(tmp_path / "stacks" / "a", [f"z_{k}.png" for k in range(5)])
+    _write_planes(tmp_path / "stacks" / "gap", ["z_0.png", "z_1.png", "z_3.png"])
+    _write_planes(tmp_path / "stacks" / "single", ["z_0.png"])
+    _write_planes(tmp_path / "stacks" / "mixed", ["z_0.png", "z_1.tiff"])
+    np.save(tmp_path / "stacks" / "grey.npy", np.zeros((4, 8, 8), dtype=np.uint8))
+    np.save(tmp_path / "stacks" / "rgb.npy", np.zeros((4, 8, 8, 3), dtype=np.uint8))
+    np.save(tmp_path / "stacks" / "image.npy", np.zeros((8, 8, 3), dtype=np.uint8))
+    np.save(tmp_path / "stacks" / "one_plane.npy", np.zeros((1, 8, 8), dtype=np.uint8))
+    np.save(tmp_path / "stacks" / "labels.npy", np.full((3, 8, 8), "a"))
+    np.savez(
+        tmp_path / "stacks" / "archive.npz",
+        field=np.zeros((3, 8, 8, 3), dtype=np.uint8), image=np.zeros((8, 8), dtype=np.uint8)
+    )
+
+    # The output of a scan: one image per field, the journal, candidate crops and a mosaic.
+    scan = tmp_path / "stacks" / "scan"
+    _write_planes(scan, [f"field_0_{j}.png" for j in range(3)])
+    (scan / journal.file_name).write_text("{}\n")
+    np.save(scan / "field_0_0_candidates.npy", np.zeros((4, 32, 32, 3), dtype=np.uint8))
+    (scan / "mosaic").mkdir()
+    np.save(scan / "mosaic" / "level_0.npy", np.zeros((64, 64, 3), dtype=np.uint8))
+
+    names = [stack.name for stack in reanalyze.find_stacks(tmp_path / "stacks")]
+
+    assert names == ["archive/field", "grey", "rgb", "a"]
+
+
+def test_found_stacks_are_analyzed(tmp_path):
+    np.savez(tmp_path / "archive.npz", field=np.random.default_rng(0).integers(0, 255, (3, 16, 16, 3), dtype=np.uint8))
+    _write_planes(tmp_path / "planes", [f"plane{k}.tif" for k in range(8, 12)])
+
+    results = [reanalyze.analyze(stack) for stack in reanalyze.find_stacks(tmp_path)]
+
+    assert [(r.name, len(r.metrics)) for r in results] == [("archive/field", 3), ("planes", 4)]
+
+
+def test_resuming_keeps_one_result_per_line(tmp_path):
+    stacks = tmp_path / "stacks"
+    stacks.mkdir()
+    for k in range(3):
+        np.save(stacks / f"s{k}.npy", np.random.default_rng(k).integers(0, 255, (4, 16, 16), dtype=np.uint8))
+    results = tmp_path / "results.npz"
+    reanalyze.run(stacks, results, workers=1)
+    progress = tmp_path / ("results.npz" + reanalyze.progress_suffix)
+    with open(progress, "a", encoding="utf-8") as f:
+        f.write('{"name": "s9"')
+
+    reanalyze.run(stacks, results, workers=1)
+    reanalyze.run(stacks, results, workers=1)
+
+    lines = progress.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 5 and "" not in lines
+    assert len(reanalyze.read_results(results)["name"]) == 3
+
+
+def test_a_torn_header_starts_the_progress_log_again(tmp_path):
+    stacks = tmp_path / "stacks"
+    stacks.mkdir()
+    for k in range(2):
+        np.save(stacks / f"s{k}.npy", np.random.default_rng(k).integers(0, 255, (4, 16, 16), dtype=np.uint8))
+    results = tmp_path / "results.npz"
+    progress = tmp_path / ("results.npz" + reanalyze.progress_suffix)
+    # A run with other settings stopped while writing its header, and a later run logged a stack after it.
+    progress.write_text(
+        '{"algorithm": "brenner", "ro\n'
+        '{"name": "s0", "index": 9, "ranks": [], "metrics": [], "pixels": 0}\n'
+    )
+
+    reanalyze.run(stacks, results, workers=1)
+
+    lines = progress.read_text(encoding="utf-8").splitlines()
+    assert json.loads(lines[0]) == {"algorithm": "normed_var", "roi": None, "downsample": 1}
+    assert len(lines) == 3
+    assert all(0 <= index < 4 for index in reanalyze.read_results(results)["index"])
+    # Once the header is whole again, the settings are checked on every resume.
+    with pytest.raises(ValueError):
+        reanalyze.run(stacks, results, algorithm="brenner", workers=1)
@@ -0,0 +1,73 @@
+'''
+    Tests of settle detection for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import time
+import numpy as np
+import pytest
+import cameras
+import settle
+
+
+class _ShiftingCamera(cameras.CameraBackend):
+    "A camera streaming a random scene shifted by shift_px more on every frame."
+
+    def __init__(self, shift_px):
+        self.scene = np.random.default_rng(0).integers(40, 220, size=(64, 96)).astype(np.uint8)
+        self.shift_px = shift_px
+        self.n_snapshots = 0
+
+    def snapshot_into(self, out=None):
+        time.sleep(0.005)
+        image = np.roll(self.scene, self.shift_px * self.n_snapshots, axis=1)
+        self.n_snapshots += 1
+        if out is None:
+            return image
+        np.copyto(out, image)
+        return out
+
+
+def test_a_still_scene_settles_after_two_frames():
+    camera = _ShiftingCamera(0)
+    with cameras.CameraStream(camera) as stream:
+        stream.wait_for(0, timeout=5)
+        detector = settle.SettleDetector(stream, timeout_s=1.0, from_rgb=False)
+        before = stream.latest()[0]
+
+        frame, elapsed, settled = detector.wait()
+        seen = stream.latest()[0] - before
+
+    assert settled and detector.n_timeouts == 0
+    assert elapsed < 0.5 and seen >= 2
+    assert (frame == camera.scene).all()
+
+
+def test_a_moving_scene_times_out_with_the_latest_frame():
+    with cameras.CameraStream(_ShiftingCamera(3)) as stream:
+        detector = settle.SettleDetector(stream, timeout_s=0.2, from_rgb=False)
+
+        frame, elapsed, settled = detector.wait()
+
+    assert not settled and detector.n_timeouts == 1
+    assert elapsed == pytest.approx(0.2, abs=0.1)
+    assert frame.shape == (64, 96)
+
+
+def test_frame_motion_is_relative_to_brightness():
+    a = np.full((8, 8), 100, dtype=np.uint8)
+    assert settle.frame_motion(a, a) == 0
+    assert settle.frame_motion(a, a + 10) == pytest.approx(0.1)
@@ -0,0 +1,78 @@
+'''
+    Tests of the simulated widget for Team Dumbbell malaria microscopy widget.
+    Copyright (C) 2022 Jazim Akbar, Nidal Danial, Saeed Jan, Henry Prickett-Morgan, and Iliya Shofman
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import struct
+import threading
+import pytest
+import api
+
+# The simulated stage speaks the serial protocol over a pty.
+simulator = pytest.importorskip("simulator", exc_type=ImportError)
+
+
+def test_each_simulated_widget_times_moves_from_its_own_profile():
+    profiles = [(1000, 5000), (100, 200)]
+    stages = [simulator.SimulatedStage(time_scale=0.01) for _ in profiles]
+    widgets = [api.Widget(stage.port, simulator.SyntheticCamera(stage)) for stage in stages]
+    estimates = [None] * len(widgets)
+
+    def scan(k):
+        with api.using(widgets[k]):
+            api.stepper_controller_init()
+            api.set_motion_profile("x", *profiles[k])
+            estimates[k] = api.estimate_move_time("x", 600)
+            api.move_x_axis(600 * api.step_degrees * api.x_dist_factor)
+            api.current().stepper.close()
+
+    threads = [threading.Thread(target=scan, args=(k,)) for k in range(len(widgets))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for stage in stages:
+            stage.close()
+
+    for (max_speed, accel), stage, estimate in zip(profiles, stages, estimates):
+        assert stage.n_moves == 1
+        assert stage.move_time == pytest.approx(api.move_time(600, max_speed, accel))
+        assert stage.move_time == pytest.approx(estimate)
+    # Default widget untouched by either thread.
+    assert api.default_widget.stepper.motion_profiles["x"] == api.default_motion_profiles["x"]
+
+
+def test_rejected_frames_are_answered_and_the_stage_keeps_running(stage, stepper):
+    with pytest.raises(api.StepperControllerError, match="bad axis"):
+        stepper._send_frame(api._cmd_set_profile, struct.pack(api._profile_format, 9, 100, 200, 1))
+    with pytest.raises(api.StepperControllerError, match="bad axis"):
+        stepper._send_frame(api._cmd_move_coordinated, struct.pack(api._axis_move_format, 9, 10))
+    with pytest.raises(api.StepperControllerError, match="bad axis"):
+        stepper._send_frame(api._cmd_move_coordinated, struct.pack(api._axis_move_format, 0, 10) * 2)
+    with pytest.raises(api.StepperControllerError, match="bad length"):
+        stepper._send_frame(api._cmd_set_profile, b"\x00")
+    with pytest.raises(api.StepperControllerError, match="bad value"):
+        stepper.set_motion_profile("x", 0, 200)
+
+    stepper.protocol_version = 3
+    with pytest.raises(api.StepperControllerError, match="unsupported version"):
+        stepper.set_motion_profile("x", 100, 200)
+    stepper.protocol_version = 2
+
+    stepper.move_x_axis(10 * api.step_degrees * api.x_dist_factor)
+    assert stage.n_moves == 1 and stage.profiles["x"] == api.default_motion_profiles["x"]